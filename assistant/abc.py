@@ -1,6 +1,7 @@
+import asyncio
 from abc import ABC, ABCMeta, abstractmethod
-from multiprocessing.pool import Pool
-from typing import Callable, Dict, List, Optional, Union
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Union
 
 import discord
 from discord.ext.commands.cog import CogMeta
@@ -8,7 +9,15 @@ from openai.types.chat.chat_completion_message import ChatCompletionMessage
 from redbot.core import commands
 from redbot.core.bot import Red
 
-from .common.models import DB, GuildSettings
+from .common.cache import EmbeddingCache, ResponseCache
+from .common.coalesce import SingleFlight
+from .common.imports import ImportJob, ResyncJob, Row
+from .common.models import DB, Conversation, GuildSettings
+from .common.pool import WorkerPool
+from .common.regex import RegexEngine
+from .common.scheduler import FairScheduler
+from .common.storage import EmbeddingStore
+from .common.timings import StepTimings
 
 
 class CompositeMetaClass(CogMeta, ABCMeta):
@@ -21,7 +30,18 @@ class MixinMeta(ABC):
     def __init__(self, *_args):
         self.bot: Red
         self.db: DB
-        self.mp_pool: Pool
+        self.store: EmbeddingStore
+        self.embedding_cache: EmbeddingCache
+        self.embedding_cache_path: Path
+        self.import_path: Path
+        self.import_tasks: Dict[str, asyncio.Task]
+        self.resync_jobs: Dict[int, ResyncJob]
+        self.worker_pool: WorkerPool
+        self.regex_engine: RegexEngine
+        self.scheduler: FairScheduler
+        self.singleflight: SingleFlight
+        self.response_cache: ResponseCache
+        self.preflight_timings: StepTimings
         self.registry: Dict[str, Dict[str, dict]]
 
     @abstractmethod
@@ -38,6 +58,8 @@ class MixinMeta(ABC):
         response_token_override: int = None,
         model_override: Optional[str] = None,
         temperature_override: Optional[float] = None,
+        conversation: Optional[Conversation] = None,
+        stream_callback: Optional[Callable[[str], Awaitable[None]]] = None,
     ) -> Union[ChatCompletionMessage, str]:
         raise NotImplementedError
 
@@ -50,7 +72,43 @@ class MixinMeta(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def resync_embeddings(self, conf: GuildSettings) -> int:
+    async def resync_embeddings(
+        self,
+        conf: GuildSettings,
+        on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    ) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def embed_batch(self, texts: List[str], conf: GuildSettings) -> List[List[float]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def queue_import(self, ctx: commands.Context, files: List[str], rows: List[Row], overwrite: bool):
+        raise NotImplementedError
+
+    @abstractmethod
+    def start_import(self, job: ImportJob):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def resume_jobs(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def start_resync(self, job: ResyncJob):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def run_resync(self, job: ResyncJob):
+        raise NotImplementedError
+
+    @abstractmethod
+    def resync_status(self, job: ResyncJob) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def run_import(self, job: ImportJob):
         raise NotImplementedError
 
     @abstractmethod
@@ -62,7 +120,12 @@ class MixinMeta(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    async def count_payload_tokens(self, messages: List[dict], model: str = "gpt-4o-mini") -> int:
+    async def count_payload_tokens(
+        self,
+        messages: List[dict],
+        model: str = "gpt-4o-mini",
+        conversation: Optional[Conversation] = None,
+    ) -> int:
         raise NotImplementedError
 
     @abstractmethod
@@ -73,6 +136,10 @@ class MixinMeta(ABC):
     async def count_tokens(self, text: str, model: str) -> int:
         raise NotImplementedError
 
+    @abstractmethod
+    async def count_tokens_batch(self, texts: List[str], model: str) -> List[int]:
+        raise NotImplementedError
+
     @abstractmethod
     async def get_tokens(self, text: str, model: str = "gpt-4o-mini") -> list[int]:
         raise NotImplementedError
@@ -88,6 +155,7 @@ class MixinMeta(ABC):
         function_list: List[dict],
         conf: GuildSettings,
         user: Optional[discord.Member],
+        conversation: Optional[Conversation] = None,
     ) -> bool:
         raise NotImplementedError
 
@@ -145,6 +213,20 @@ class MixinMeta(ABC):
     async def save_conf(self):
         raise NotImplementedError
 
+    @abstractmethod
+    def configure_scheduler(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def handle_in_turn(
+        self,
+        message: discord.Message,
+        question: str,
+        conf: GuildSettings,
+        listener: bool = False,
+    ) -> None:
+        raise NotImplementedError
+
     @abstractmethod
     async def handle_message(
         self, message: discord.Message, question: str, conf: GuildSettings, listener: bool = False
@@ -1,6 +1,6 @@
 import asyncio
 import logging
-from multiprocessing.pool import Pool
+from contextlib import suppress
 from time import perf_counter
 from typing import Callable, Dict, List, Literal, Optional, Union
 
@@ -9,26 +9,46 @@ from discord.ext import tasks
 from pydantic import ValidationError
 from redbot.core import Config, commands
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
 
 from .abc import CompositeMetaClass
 from .commands import AssistantCommands
+from .common import tokenizer
 from .common.api import API
+from .common.cache import EmbeddingCache, ResponseCache
+from .common.calls import close_clients, set_pool_limits
 from .common.chat import ChatHandler
+from .common.coalesce import SingleFlight
 from .common.constants import (
     CREATE_MEMORY,
     EDIT_MEMORY,
     GENERATE_IMAGE,
     LIST_MEMORIES,
+    MODELS,
     SEARCH_INTERNET,
     SEARCH_MEMORIES,
 )
 from .common.functions import AssistantFunctions
-from .common.models import DB, Embedding, EmbeddingEntryExists, NoAPIKey
+from .common.imports import ResyncJob
+from .common.models import DB, Embedding, EmbeddingEntryExists, GuildSettings, NoAPIKey
+from .common.pool import WorkerPool
+from .common.regex import RegexEngine
+from .common.scheduler import FairScheduler
+from .common.storage import ConfigSnapshot, EmbeddingStore
+from .common.timings import StepTimings
 from .common.utils import json_schema_invalid
+from .common.vectors import Vector
 from .listener import AssistantListener
 
 log = logging.getLogger("red.vrt.assistant")
 
+# Embeddings live in the binary sidecar store, not Red's Config
+CONFIG_EXCLUDE = {"embeddings"}
+# Save requests made within this many seconds of each other share a single write
+SAVE_DELAY = 1
+# Past this many changed entries a single full write is cheaper than individual ones
+FULL_WRITE_THRESHOLD = 25
+
 
 # redgettext -D views.py commands/admin.py commands/base.py common/api.py common/chat.py common/utils.py --command-docstring
 
@@ -72,12 +92,36 @@ class Assistant(
         self.config = Config.get_conf(self, 117117117, force_registration=True)
         self.config.register_global(db={})
         self.db: DB = DB()
-        self.mp_pool = Pool()
+        self.store = EmbeddingStore(cog_data_path(self) / "embeddings")
+        self.embedding_cache = EmbeddingCache(self.db.embedding_cache_size * 1024**2)
+        self.embedding_cache_path = cog_data_path(self) / "embedding_cache.msgpack"
+        # Checkpoints for embedding imports and resyncs so they survive reloads
+        self.import_path = cog_data_path(self) / "imports"
+        self.import_tasks: Dict[str, asyncio.Task] = {}
+        self.resync_jobs: Dict[int, ResyncJob] = {}
+        # Only started once a risky regex blacklist pattern needs sandboxing
+        self.worker_pool = WorkerPool()
+        self.regex_engine = RegexEngine()
+        self.singleflight = SingleFlight()
+        self.response_cache = ResponseCache()
+        # How long _get_chat_response spends before its first request to the model
+        self.preflight_timings = StepTimings()
+        self.scheduler = FairScheduler(
+            self.db.max_concurrent_chats,
+            self.db.max_guild_chats,
+            self.db.max_queued_chats,
+            self.db.chat_queue_timeout,
+        )
 
         # {cog_name: {function_name: {"permission_level": "user", "schema": function_json_schema}}}
         self.registry: Dict[str, Dict[str, dict]] = {}
 
-        self.saving = False
+        # Write-behind state for save_conf
+        self.snapshot = ConfigSnapshot()
+        self.save_lock = asyncio.Lock()
+        self.pending_save: Optional[asyncio.Task] = None
+        self.save_now = asyncio.Event()  # Set on unload so pending writes skip SAVE_DELAY
+        self.full_write = False
         self.first_run = True
 
     async def cog_load(self) -> None:
@@ -85,13 +129,34 @@ class Assistant(
 
     async def cog_unload(self):
         self.save_loop.cancel()
-        self.mp_pool.close()
+        # Interrupted imports and resyncs resume from their checkpoint on next load
+        for task in self.import_tasks.values():
+            task.cancel()
+        for job in self.resync_jobs.values():
+            job.task.cancel()
+        # Write anything still waiting out SAVE_DELAY now, a leftover task could race the next load
+        self.save_now.set()
+        pending = self.pending_save
+        if pending is not None:
+            with suppress(asyncio.CancelledError):
+                await pending
+        async with self.save_lock:
+            # Lets a write that's already running finish, and writes here if the write-behind got cancelled
+            if pending is not None and pending.cancelled():
+                await self._flush()
+        await close_clients()
+        await self.worker_pool.close()
+        await self.save_embedding_cache()
         self.bot.dispatch("assistant_cog_remove")
 
     async def init_cog(self):
         await self.bot.wait_until_red_ready()
         start = perf_counter()
         data = await self.config.db()
+        Vector.precision = data.get("embedding_precision", "float32")
+        await asyncio.to_thread(self.snapshot.load, data)
+        # Guild settings are validated the first time they're accessed, see DB.get_conf and DB.load_conf
+        raw_configs = data.pop("configs", {})
         try:
             self.db = await asyncio.to_thread(DB.model_validate, data)
         except ValidationError:
@@ -99,9 +164,28 @@ class Assistant(
             if "conversations" in data:
                 del data["conversations"]
             self.db = await asyncio.to_thread(DB.model_validate, data)
+        self.db.defer_configs(raw_configs, self._load_conf)
 
-        log.info(f"Config loaded in {round((perf_counter() - start) * 1000, 2)}ms")
+        log.info(
+            f"Config loaded in {round((perf_counter() - start) * 1000, 2)}ms "
+            f"({len(raw_configs)} guild configs deferred until first use)"
+        )
+        # Embeddings still stored in Config from before the sidecar store existed need loading to be migrated
+        legacy = [gid for gid, raw in self.db.deferred_configs().items() if raw.get("embeddings")]
+        if legacy:
+            await asyncio.to_thread(lambda: [self.db.get_conf(gid) for gid in legacy])
         await asyncio.to_thread(self._cleanup_db)
+        if legacy:
+            log.warning(f"Migrating embeddings for {len(legacy)} guild(s) from Config to binary storage")
+            await self.save_conf()
+
+        await asyncio.to_thread(tokenizer.warm, MODELS)
+        self.embedding_cache.resize(self.db.embedding_cache_size * 1024**2)
+        self.worker_pool.resize(self.db.worker_pool_size)
+        self.configure_scheduler()
+        set_pool_limits(self.db.max_connections, self.db.max_keepalive_connections, self.db.keepalive_expiry)
+        if self.db.persist_embedding_cache:
+            await asyncio.to_thread(self.embedding_cache.load, self.embedding_cache_path)
 
         # Register internal functions
         await self.register_function(self.qualified_name, GENERATE_IMAGE)
@@ -111,6 +195,8 @@ class Assistant(
         await self.register_function(self.qualified_name, EDIT_MEMORY)
         await self.register_function(self.qualified_name, LIST_MEMORIES)
 
+        await self.resume_jobs()
+
         logging.getLogger("openai").setLevel(logging.WARNING)
         logging.getLogger("aiocache").setLevel(logging.WARNING)
         logging.getLogger("httpcore.http11").setLevel(logging.WARNING)
@@ -121,27 +207,78 @@ class Assistant(
         await asyncio.sleep(30)
         self.save_loop.start()
 
+    def configure_scheduler(self):
+        self.scheduler.configure(
+            self.db.max_concurrent_chats,
+            self.db.max_guild_chats,
+            self.db.max_queued_chats,
+            self.db.chat_queue_timeout,
+        )
+
     async def save_conf(self):
-        if self.saving:
-            return
+        """Request a save, returns once the write that covers this request has finished"""
+        if self.pending_save is None:
+            self.pending_save = asyncio.create_task(self._write_behind())
+        # Shielded so a cancelled caller doesn't cancel a write other callers are waiting on
+        await asyncio.shield(self.pending_save)
+
+    async def _write_behind(self):
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.save_now.wait(), SAVE_DELAY)
+        # Anything requested from here on needs a new write since this one may have already dumped
+        self.pending_save = None
+        async with self.save_lock:
+            await self._flush()
+
+    async def _flush(self):
         try:
-            self.saving = True
             start = perf_counter()
             if not self.db.persistent_conversations:
                 self.db.conversations.clear()
-            dump = await asyncio.to_thread(self.db.model_dump)
-            await self.config.db.set(dump)
-            txt = f"Config saved in {round((perf_counter() - start) * 1000, 2)}ms"
+            changed, removed = await asyncio.to_thread(self._diff_db)
+            if self.full_write or len(changed) + len(removed) > FULL_WRITE_THRESHOLD:
+                await self.config.db.set(self.snapshot.assemble(self.db))
+                self.full_write = False
+            else:
+                for path, value in changed.items():
+                    await self.config.db.set_raw(*path, value=value)
+                for path in removed:
+                    await self.config.db.clear_raw(*path)
+            txt = (
+                f"Config saved in {round((perf_counter() - start) * 1000, 2)}ms "
+                f"({len(changed)} changed, {len(removed)} removed)"
+            )
             if self.first_run:
                 log.info(txt)
                 self.first_run = False
+            else:
+                log.debug(txt)
         except Exception as e:
             log.error("Failed to save config", exc_info=e)
-        finally:
-            self.saving = False
+            # Forget what was written so the next save rewrites everything
+            self.snapshot.entries.clear()
+            self.full_write = True
         if not self.db.persistent_conversations and self.save_loop.is_running():
             self.save_loop.cancel()
 
+    def _diff_db(self):
+        # Sidecar goes first so Config never points at embeddings that aren't on disk yet
+        self.store.save_all(self.db.configs, self.db.guild_ids())
+        return self.snapshot.diff(self.db, CONFIG_EXCLUDE)
+
+    def _load_conf(self, guild_id: int, raw: dict) -> GuildSettings:
+        """Validate a guild's settings the first time they're accessed and attach its embeddings"""
+        try:
+            conf = GuildSettings.model_validate(raw)
+        except ValidationError as e:
+            log.error(f"Invalid settings for guild {guild_id}, falling back to defaults", exc_info=e)
+            conf = GuildSettings()
+        if not conf.embeddings:
+            conf.embeddings = self.store.load(guild_id)
+        if guild := self.bot.get_guild(guild_id):
+            self._cleanup_conf(guild, conf)
+        return conf
+
     def _cleanup_db(self):
         cleaned = False
         # Cleanup registry if any cogs no longer exist
@@ -149,68 +286,85 @@ class Assistant(
             cog = self.bot.get_cog(cog_name)
             if not cog:
                 log.debug(f"{cog_name} no longer loaded. Unregistering its functions")
+                tokenizer.forget_functions(i["schema"] for i in cog_functions.values())
                 del self.registry[cog_name]
                 cleaned = True
                 continue
             for function_name in cog_functions:
                 if not hasattr(cog, function_name):
                     log.debug(f"{cog_name} no longer has function named {function_name}, removing")
+                    tokenizer.forget_functions([cog_functions[function_name]["schema"]])
                     del self.registry[cog_name][function_name]
                     cleaned = True
 
         # Clean up any stale channels
-        for guild_id in self.db.configs.copy().keys():
+        for guild_id in self.db.guild_ids():
             guild = self.bot.get_guild(guild_id)
             if not guild:
                 log.debug("Cleaning up guild")
-                del self.db.configs[guild_id]
+                self.db.drop_conf(guild_id)
                 cleaned = True
                 continue
-            conf = self.db.get_conf(guild_id)
-            for role_id in conf.max_token_role_override.copy():
-                if not guild.get_role(role_id):
-                    log.debug("Cleaning deleted max token override role")
-                    del conf.max_token_role_override[role_id]
-                    cleaned = True
-            for role_id in conf.max_retention_role_override.copy():
-                if not guild.get_role(role_id):
-                    log.debug("Cleaning deleted max retention override role")
-                    del conf.max_retention_role_override[role_id]
-                    cleaned = True
-            for role_id in conf.role_overrides.copy():
-                if not guild.get_role(role_id):
-                    log.debug("Cleaning deleted model override role")
-                    del conf.role_overrides[role_id]
-                    cleaned = True
-            for role_id in conf.max_time_role_override.copy():
-                if not guild.get_role(role_id):
-                    log.debug("Cleaning deleted max time override role")
-                    del conf.max_time_role_override[role_id]
-                    cleaned = True
-            for obj_id in conf.blacklist.copy():
-                discord_obj = guild.get_role(obj_id) or guild.get_member(obj_id) or guild.get_channel_or_thread(obj_id)
-                if not discord_obj:
-                    log.debug("Cleaning up invalid blacklisted ID")
-                    conf.blacklist.remove(obj_id)
-                    cleaned = True
-
-            # Ensure embedding entry names arent too long
-            new_embeddings = {}
-            for entry_name, embedding in conf.embeddings.items():
-                if len(entry_name) > 100:
-                    log.debug(f"Embed entry more than 100 characters, truncating: {entry_name}")
-                    cleaned = True
-                new_embeddings[entry_name[:100]] = embedding
-            conf.embeddings = new_embeddings
+            # Deferred guilds get cleaned up when they're loaded
+            if guild_id in self.db.configs:
+                cleaned |= self._cleanup_conf(guild, self.db.configs[guild_id])
 
         health = "BAD (Cleaned)" if cleaned else "GOOD"
         log.info(f"Config health: {health}")
 
+    def _cleanup_conf(self, guild: discord.Guild, conf: GuildSettings) -> bool:
+        cleaned = False
+        for role_id in conf.max_token_role_override.copy():
+            if not guild.get_role(role_id):
+                log.debug("Cleaning deleted max token override role")
+                del conf.max_token_role_override[role_id]
+                cleaned = True
+        for role_id in conf.max_retention_role_override.copy():
+            if not guild.get_role(role_id):
+                log.debug("Cleaning deleted max retention override role")
+                del conf.max_retention_role_override[role_id]
+                cleaned = True
+        for role_id in conf.role_overrides.copy():
+            if not guild.get_role(role_id):
+                log.debug("Cleaning deleted model override role")
+                del conf.role_overrides[role_id]
+                cleaned = True
+        for role_id in conf.max_time_role_override.copy():
+            if not guild.get_role(role_id):
+                log.debug("Cleaning deleted max time override role")
+                del conf.max_time_role_override[role_id]
+                cleaned = True
+        for obj_id in conf.blacklist.copy():
+            discord_obj = guild.get_role(obj_id) or guild.get_member(obj_id) or guild.get_channel_or_thread(obj_id)
+            if not discord_obj:
+                log.debug("Cleaning up invalid blacklisted ID")
+                conf.blacklist.remove(obj_id)
+                cleaned = True
+
+        # Ensure embedding entry names arent too long
+        new_embeddings = {}
+        for entry_name, embedding in conf.embeddings.items():
+            if len(entry_name) > 100:
+                log.debug(f"Embed entry more than 100 characters, truncating: {entry_name}")
+                cleaned = True
+            new_embeddings[entry_name[:100]] = embedding
+        conf.embeddings = new_embeddings
+        return cleaned
+
+    async def save_embedding_cache(self):
+        if not self.db.persist_embedding_cache or not self.embedding_cache.dirty:
+            return
+        try:
+            await asyncio.to_thread(self.embedding_cache.save, self.embedding_cache_path)
+        except Exception as e:
+            log.error("Failed to save the embedding cache", exc_info=e)
+
     @tasks.loop(minutes=2)
     async def save_loop(self):
         if not self.db.persistent_conversations:
             return
         await self.save_conf()
+        await self.save_embedding_cache()
 
     # ------------------ 3rd PARTY ACCESSIBLE METHODS ------------------
     async def add_embedding(
@@ -238,7 +392,7 @@ class Assistant(
             Optional[List[float]]: List of embedding weights if successfully generated
         """
 
-        conf = self.db.get_conf(guild)
+        conf = await self.db.load_conf(guild)
 
         if name in conf.embeddings and not overwrite:
             raise EmbeddingEntryExists(f"The entry name '{name}' already exists!")
@@ -247,6 +401,7 @@ class Assistant(
         if not embedding:
             return None
         conf.embeddings[name] = Embedding(text=text, embedding=embedding, ai_created=ai_created, model=conf.embed_model)
+        await asyncio.to_thread(conf.sync_embeddings)
         asyncio.create_task(self.save_conf())
         return embedding
 
@@ -282,7 +437,7 @@ class Assistant(
         Returns:
             str: the reply from ChatGPT (may need to be pagified)
         """
-        conf = self.db.get_conf(guild)
+        conf = await self.db.load_conf(guild)
         if not await self.can_call_llm(conf):
             raise NoAPIKey("OpenAI key has not been set for this server!")
         return await self.get_chat_response(
@@ -324,6 +479,7 @@ class Assistant(
         cog_name: str,
         schema: dict,
         permission_level: Literal["user", "mod", "admin", "owner"] = "user",
+        parallel: bool = True,
     ) -> bool:
         """Allow 3rd party cogs to register their functions for the model to use
 
@@ -331,6 +487,8 @@ class Assistant(
             cog_name (str): the name of the cog registering the function
             schema (dict): JSON schema representation of the command (see https://json-schema.org/understanding-json-schema/)
             permission_level (str): the permission level required to call the function (user, mod, admin, owner)
+            parallel (bool): whether the function can run alongside other calls from the same response.
+                Set to False for functions with side effects that depend on ordering.
 
         Returns:
             bool: True if function was successfully registered
@@ -370,7 +528,13 @@ class Assistant(
             self.registry[cog_name] = {}
 
         log.info(f"The {cog_name} cog registered a function object: {function_name}")
-        self.registry[cog_name][function_name] = {"permission_level": permission_level, "schema": schema}
+        if existing := self.registry[cog_name].get(function_name):
+            tokenizer.forget_functions([existing["schema"]])
+        self.registry[cog_name][function_name] = {
+            "permission_level": permission_level,
+            "schema": schema,
+            "parallel": parallel,
+        }
         return True
 
     async def unregister_function(self, cog_name: str, function_name: str) -> None:
@@ -386,6 +550,7 @@ class Assistant(
         if function_name not in self.registry[cog_name]:
             log.debug(f"{function_name} not in {cog_name}'s registry")
             return
+        tokenizer.forget_functions([self.registry[cog_name][function_name]["schema"]])
         del self.registry[cog_name][function_name]
         log.info(f"{cog_name} cog removed the function {function_name} from the registry")
 
@@ -398,5 +563,6 @@ class Assistant(
         if cog_name not in self.registry:
             log.debug(f"{cog_name} not in registry")
             return
+        tokenizer.forget_functions(i["schema"] for i in self.registry[cog_name].values())
         del self.registry[cog_name]
         log.info(f"{cog_name} cog removed from registry")
@@ -1,11 +1,11 @@
 import asyncio
-import contextlib
 import logging
 import re
 import traceback
 import typing as t
 from datetime import datetime, timezone
 from io import BytesIO
+from time import monotonic
 from typing import List, Union
 from zipfile import ZIP_DEFLATED, ZipFile
 
@@ -29,9 +29,14 @@ from redbot.core.utils.chat_formatting import (
 )
 
 from ..abc import MixinMeta
+from ..common.calls import get_client, pool_limits, set_pool_limits
 from ..common.constants import MODELS, PRICES
+from ..common.imports import ResyncJob, rows_from_csv, rows_from_excel
 from ..common.models import DB, Embedding
+from ..common.pool import default_size
+from ..common.ratelimit import limiters
 from ..common.utils import get_attachments
+from ..common.vectors import PRECISIONS, Vector
 from ..views import CodeMenu, EmbeddingMenu, SetAPI
 
 log = logging.getLogger("red.vrt.assistant.admin")
@@ -61,7 +66,7 @@ class Admin(MixinMeta):
         """
         send_key = [ctx.guild.owner_id == ctx.author.id, ctx.author.id in self.bot.owner_ids]
 
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         model = conf.get_user_model(ctx.author)
         system_tokens = await self.count_tokens(conf.system_prompt, model) if conf.system_prompt else 0
         prompt_tokens = await self.count_tokens(conf.prompt, model) if conf.prompt else 0
@@ -85,6 +90,15 @@ class Admin(MixinMeta):
             + _("`Question Mode:       `{}\n").format(conf.question_mode)
             + _("`Mention on Reply:    `{}\n").format(conf.mention)
             + _("`Respond to Mentions: `{}\n").format(conf.mention_respond)
+            + _("`Stream Responses:    `{}\n").format(conf.stream_responses)
+            + _("`Coalesce Requests:   `{}\n").format(conf.coalesce_requests)
+            + _("`Response Cache:      `{}\n").format(
+                _("{} (similarity {}, {}s)").format(
+                    conf.response_cache, conf.response_cache_threshold, conf.response_cache_ttl
+                )
+                if conf.response_cache
+                else conf.response_cache
+            )
             + _("`Collaborative Mode:  `{}\n").format(conf.collab_convos)
             + _("`Max Retention:       `{}\n").format(conf.max_retention)
             + _("`Retention Expire:    `{}s\n").format(conf.max_retention_time)
@@ -139,6 +153,11 @@ class Admin(MixinMeta):
             _("`Top N Embeddings:  `{}\n").format(conf.top_n)
             + _("`Min Relatedness:   `{}\n").format(conf.min_relatedness)
             + _("`Embedding Method:  `{}\n").format(conf.embed_method)
+            + _("`Search Method:     `{}\n").format(
+                conf.search_method
+                if conf.search_method == "exact"
+                else _("{} ({} probes)").format(conf.search_method, conf.search_probes)
+            )
             + _("`Encodings:         `{}").format(encoded_by)
         )
         embed_num = humanize_number(len(conf.embeddings))
@@ -160,6 +179,10 @@ class Admin(MixinMeta):
         custom_func_field = (
             _("`Function Calling:  `{}\n").format(conf.use_function_calls)
             + _("`Maximum Recursion: `{}\n").format(conf.max_function_calls)
+            + _("`Parallel Calls:    `{}\n").format(conf.max_parallel_functions)
+            + _("`Function Timeout:  `{}\n").format(
+                _("{}s").format(conf.function_timeout) if conf.function_timeout else _("None")
+            )
             + _("`Function Tokens:   `{}\n").format(humanize_number(func_tokens))
         )
         if self.registry:
@@ -314,7 +337,7 @@ class Admin(MixinMeta):
     @commands.bot_has_permissions(embed_links=True)
     async def view_usage(self, ctx: commands.Context):
         """View the token usage stats for this server"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.usage:
             return await ctx.send(_("There is no usage data yet!"))
         embed = discord.Embed(color=ctx.author.color)
@@ -387,6 +410,13 @@ class Admin(MixinMeta):
             round(total_cost, 2),
             humanize_number(conf.functions_called),
         )
+        lookups = conf.response_cache_hits + conf.response_cache_misses
+        if lookups:
+            desc += _("`Cache Hits: `{}/{} ({}%)\n").format(
+                humanize_number(conf.response_cache_hits),
+                humanize_number(lookups),
+                round(conf.response_cache_hits / lookups * 100, 1),
+            )
         embed.description = desc
         return await ctx.send(embed=embed)
 
@@ -394,8 +424,10 @@ class Admin(MixinMeta):
     @commands.bot_has_permissions(embed_links=True)
     async def reset_usage(self, ctx: commands.Context):
         """Reset the token usage stats for this server"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.usage = {}
+        conf.response_cache_hits = 0
+        conf.response_cache_misses = 0
         await ctx.send(_("Token usage stats have been reset!"))
         await self.save_conf()
 
@@ -405,7 +437,7 @@ class Admin(MixinMeta):
         """
         Set your OpenAI key
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
 
         view = SetAPI(ctx.author, conf.api_key)
         txt = _("Click to set your OpenAI key\n\nTo remove your keys, enter `none`")
@@ -464,7 +496,7 @@ class Admin(MixinMeta):
             return await ctx.send(_("Invalid Timezone, did you mean `{}`?").format(likely_match))
         time = datetime.now(tz).strftime("%I:%M %p")  # Convert to 12-hour format
         await ctx.send(_("Timezone set to **{}** (`{}`)").format(timezone, time))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.timezone = timezone
         await self.save_conf()
 
@@ -516,7 +548,7 @@ class Admin(MixinMeta):
                 self.bot._last_exception = traceback.format_exc()
                 return
 
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         model = conf.get_user_model(ctx.author)
         ptokens = await self.count_tokens(prompt, model) if prompt else 0
         stokens = await self.count_tokens(conf.system_prompt, model) if conf.system_prompt else 0
@@ -552,7 +584,7 @@ class Admin(MixinMeta):
     @commands.has_permissions(attach_files=True)
     async def show_channel_prompt(self, ctx: commands.Context, channel: discord.TextChannel = commands.CurrentChannel):
         """Show the channel specific system prompt"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if channel.id not in conf.channel_prompts:
             return await ctx.send(_("No channel prompt set for {}").format(channel.mention))
         file = text_to_file(conf.channel_prompts[channel.id], f"{channel.name}_prompt.txt")
@@ -567,7 +599,7 @@ class Admin(MixinMeta):
         system_prompt: t.Optional[str] = None,
     ):
         """Set a channel specific system prompt"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         attachments = get_attachments(ctx.message)
         if attachments:
             try:
@@ -583,6 +615,7 @@ class Admin(MixinMeta):
         if system_prompt is None:
             if channel.id in conf.channel_prompts:
                 del conf.channel_prompts[channel.id]
+                conf.mark_dirty()
                 await ctx.send(_("Channel prompt has been removed from {}!").format(channel.mention))
                 await self.save_conf()
             else:
@@ -605,6 +638,7 @@ class Admin(MixinMeta):
         else:
             await ctx.send(_("Channel prompt has been set for {}!").format(channel.mention))
         conf.channel_prompts[channel.id] = system_prompt
+        conf.mark_dirty()
         await self.save_conf()
 
     @assistant.command(name="system", aliases=["sys"])
@@ -655,7 +689,7 @@ class Admin(MixinMeta):
                 self.bot._last_exception = traceback.format_exc()
                 return
 
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         model = conf.get_user_model(ctx.author)
         ptokens = await self.count_tokens(conf.prompt, model) if conf.prompt else 0
         stokens = await self.count_tokens(system_prompt, model) if system_prompt else 0
@@ -695,7 +729,7 @@ class Admin(MixinMeta):
         channel: Union[discord.TextChannel, discord.Thread, discord.ForumChannel, None] = None,
     ):
         """Set the channel for the assistant"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if channel is None and not conf.channel_id:
             return await ctx.send_help()
         if channel is None and conf.channel_id:
@@ -712,7 +746,7 @@ class Admin(MixinMeta):
     @assistant.command(name="sysoverride")
     async def toggle_systemoverride(self, ctx: commands.Context):
         """Toggle allowing per-conversation system prompt overriding"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.allow_sys_prompt_override:
             conf.allow_sys_prompt_override = False
             await ctx.send(_("System prompt overriding **Disabled**, users cannot set per-convo system prompts"))
@@ -724,7 +758,7 @@ class Admin(MixinMeta):
     @assistant.command(name="toggle")
     async def toggle_gpt(self, ctx: commands.Context):
         """Toggle the assistant on or off"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.enabled:
             conf.enabled = False
             await ctx.send(_("The assistant is now **Disabled**"))
@@ -736,7 +770,7 @@ class Admin(MixinMeta):
     @assistant.command(name="toggledraw", aliases=["drawtoggle"])
     async def toggle_draw_command(self, ctx: commands.Context):
         """Toggle the draw command on or off"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.image_command:
             conf.image_command = False
             await ctx.send(_("The draw command is now **Disabled**"))
@@ -748,7 +782,7 @@ class Admin(MixinMeta):
     @assistant.command(name="resolution")
     async def switch_vision_resolution(self, ctx: commands.Context):
         """Switch vision resolution between high and low for relevant GPT-4-Turbo models"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.vision_detail == "auto":
             conf.vision_detail = "low"
             await ctx.send(_("Vision resolution has been set to **Low**"))
@@ -763,7 +797,7 @@ class Admin(MixinMeta):
     @assistant.command(name="reasoning")
     async def switch_reasoning_effort(self, ctx: commands.Context):
         """Switch reasoning effort for o1 model between low, medium, and high"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.reasoning_effort == "low":
             conf.reasoning_effort = "medium"
             await ctx.send(_("Reasoning effort has been set to **Medium**"))
@@ -778,7 +812,7 @@ class Admin(MixinMeta):
     @assistant.command(name="questionmark")
     async def toggle_question(self, ctx: commands.Context):
         """Toggle whether questions need to end with **__?__**"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.endswith_questionmark:
             conf.endswith_questionmark = False
             await ctx.send(_("Questions will be answered regardless of if they end with **?**"))
@@ -790,7 +824,7 @@ class Admin(MixinMeta):
     @assistant.command(name="mentionrespond")
     async def toggle_mentionrespond(self, ctx: commands.Context):
         """Toggle whether the bot responds to mentions in any channel"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.mention_respond:
             conf.mention_respond = False
             await ctx.send(_("The bot will no longer respond to mentions"))
@@ -802,7 +836,7 @@ class Admin(MixinMeta):
     @assistant.command(name="mention")
     async def toggle_mention(self, ctx: commands.Context):
         """Toggle whether to ping the user on replies"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.mention:
             conf.mention = False
             await ctx.send(_("Mentions are now **Disabled**"))
@@ -811,6 +845,94 @@ class Admin(MixinMeta):
             await ctx.send(_("Mentions are now **Enabled**"))
         await self.save_conf()
 
+    @assistant.command(name="streaming", aliases=["stream"])
+    async def toggle_streaming(self, ctx: commands.Context):
+        """
+        Toggle streaming responses
+
+        When enabled, replies are posted as soon as the model starts responding and edited as more text arrives.
+        The regex blacklist is applied to the text as it streams in, the last few characters are held back until it's
+        clear they aren't part of a match. Blacklist patterns without a longest match (like `\\w+` or lookaheads)
+        disable streaming while they're set.
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if conf.stream_responses:
+            conf.stream_responses = False
+            await ctx.send(_("Streaming responses are now **Disabled**"))
+        else:
+            conf.stream_responses = True
+            await ctx.send(_("Streaming responses are now **Enabled**"))
+        await self.save_conf()
+
+    @assistant.command(name="coalesce")
+    async def toggle_coalesce(self, ctx: commands.Context):
+        """
+        Toggle sharing API calls between identical requests
+
+        Requests in flight at the same time that would send the exact same payload with the same settings share one
+        API call, and every conversation gets the answer.
+        The payload holds the conversation history and the prompts as formatted for each user, so in practice this
+        only helps with the same question asked without history, using prompts without per user placeholders like
+        `{username}`. Shared conversations (`[p]assistant collab`) rarely match since each message adds to the history.
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if conf.coalesce_requests:
+            conf.coalesce_requests = False
+            await ctx.send(_("Identical requests will now each make their own API call"))
+        else:
+            conf.coalesce_requests = True
+            await ctx.send(_("Identical requests made at the same time will now share an API call"))
+        await self.save_conf()
+
+    @assistant.command(name="responsecache")
+    async def toggle_response_cache(self, ctx: commands.Context):
+        """
+        Toggle reusing replies to questions that were already answered
+
+        Only questions asked without any conversation history are cached, and only replies that didn't need function calls.
+        A new question reuses a cached reply if its embedding is similar enough (see `[p]assistant cachethreshold`).
+        Replies are only reused with the same model, prompts and embeddings (editing any embedding starts over).
+
+        Useful for FAQ style channels. Prompts with per user placeholders like `{username}` keep separate replies
+        per user, so they get fewer cache hits. Time placeholders like `{time}` are ignored, a cached reply keeps the
+        time it was written with until it expires (see `[p]assistant cachettl`).
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if conf.response_cache:
+            conf.response_cache = False
+            self.response_cache.clear(ctx.guild.id)
+            await ctx.send(_("The response cache is now **Disabled**"))
+        else:
+            conf.response_cache = True
+            await ctx.send(_("The response cache is now **Enabled**"))
+        await self.save_conf()
+
+    @assistant.command(name="cachethreshold")
+    async def set_cache_threshold(self, ctx: commands.Context, similarity: float):
+        """
+        Set how similar a question must be to a cached one to reuse its reply
+
+        Between 0 and 1, higher is stricter. Values below 0.9 will likely give answers to the wrong question.
+        """
+        if not 0 < similarity <= 1:
+            return await ctx.send(_("Similarity must be above 0 and at most 1"))
+        conf = await self.db.load_conf(ctx.guild)
+        conf.response_cache_threshold = similarity
+        await ctx.send(
+            _("Cached replies will be reused for questions with a similarity of **{}** or more").format(similarity)
+        )
+        await self.save_conf()
+
+    @assistant.command(name="cachettl")
+    async def set_cache_ttl(self, ctx: commands.Context, seconds: int):
+        """Set how many seconds a cached reply stays valid"""
+        if seconds < 1:
+            return await ctx.send(_("Cached replies must last at least 1 second"))
+        conf = await self.db.load_conf(ctx.guild)
+        conf.response_cache_ttl = seconds
+        await ctx.send(_("Cached replies will now expire after **{}** seconds").format(seconds))
+        await self.save_conf()
+
     @assistant.command(name="collab")
     async def toggle_collab(self, ctx: commands.Context):
         """
@@ -818,7 +940,7 @@ class Admin(MixinMeta):
 
         Multiple people speaking in a channel will be treated as a single conversation.
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.collab_convos:
             conf.collab_convos = False
             await ctx.send(_("Collaborative conversations are now **Disabled**"))
@@ -843,7 +965,7 @@ class Admin(MixinMeta):
         """
         if max_retention < 0:
             return await ctx.send(_("Max retention needs to be at least 0 or higher"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.max_retention = max_retention
         if max_retention == 0:
             await ctx.send(_("Conversation retention has been disabled"))
@@ -863,7 +985,7 @@ class Admin(MixinMeta):
         """
         if retention_seconds < 0:
             return await ctx.send(_("Max retention time needs to be at least 0 or higher"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.max_retention_time = retention_seconds
         if retention_seconds == 0:
             await ctx.send(_("Conversations will be stored until the bot restarts or the cog is reloaded"))
@@ -882,7 +1004,7 @@ class Admin(MixinMeta):
         if not 0 <= temperature <= 2:
             return await ctx.send(_("Temperature must be between **0.0** and **2.0**"))
         temperature = round(temperature, 2)
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.temperature = temperature
         await self.save_conf()
         await ctx.send(_("Temperature has been set to **{}**").format(temperature))
@@ -898,7 +1020,7 @@ class Admin(MixinMeta):
         if not -2 <= frequency_penalty <= 2:
             return await ctx.send(_("Frequency penalty must be between **-2.0** and **2.0**"))
         frequency_penalty = round(frequency_penalty, 2)
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.frequency_penalty = frequency_penalty
         await self.save_conf()
         await ctx.send(_("Frequency penalty has been set to **{}**").format(frequency_penalty))
@@ -914,7 +1036,7 @@ class Admin(MixinMeta):
         if not -2 <= presence_penalty <= 2:
             return await ctx.send(_("Presence penalty must be between **-2.0** and **2.0**"))
         presence_penalty = round(presence_penalty, 2)
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.presence_penalty = presence_penalty
         await self.save_conf()
         await ctx.send(_("Presence penalty has been set to **{}**").format(presence_penalty))
@@ -929,34 +1051,45 @@ class Admin(MixinMeta):
         """
         if seed is not None and seed < 0:
             return await ctx.send(_("Seed must be a positive integer"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.seed = seed
         await self.save_conf()
         await ctx.send(_("The seed has been set to **{}**").format(seed))
 
     @assistant.command(name="refreshembeds", aliases=["refreshembeddings", "syncembeds", "syncembeddings"])
-    async def refresh_embeddings(self, ctx: commands.Context):
+    async def refresh_embeddings(self, ctx: commands.Context, cancel: bool = False):
         """
         Refresh embedding weights
 
         *This command can be used when changing the embedding model*
 
         Embeddings that were created using OpenAI cannot be use with the self-hosted model and vice versa
+
+        The refresh runs in the background, use this command again to check its progress or pass `True` to cancel it.
+        Entries refreshed before cancelling keep their new weights.
         """
-        conf = self.db.get_conf(ctx.guild)
+        job = self.resync_jobs.get(ctx.guild.id)
+        if cancel:
+            if not job:
+                return await ctx.send(_("There is no embedding refresh running"))
+            await asyncio.to_thread(job.delete, self.import_path)
+            job.task.cancel()
+            return await ctx.send(_("Embedding refresh cancelled"))
+        if job:
+            return await ctx.send(self.resync_status(job))
+
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
-        async with ctx.typing():
-            synced = await self.resync_embeddings(conf)
-            if synced:
-                await ctx.send(_("{} embeddings have been updated").format(synced))
-            else:
-                await ctx.send(_("No embeddings needed to be refreshed"))
+        message = await ctx.send(_("Refreshing embeddings in the background..."))
+        job = ResyncJob(ctx.guild.id, ctx.channel.id, message.id)
+        await asyncio.to_thread(job.save, self.import_path)
+        self.start_resync(job)
 
     @assistant.command(name="functioncalls", aliases=["usefunctions"])
     async def toggle_function_calls(self, ctx: commands.Context):
         """Toggle whether GPT can call functions"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.use_function_calls:
             conf.use_function_calls = False
             await ctx.send(_("Assistant will not call functions"))
@@ -976,7 +1109,7 @@ class Admin(MixinMeta):
         - gpt-4o
         - ect..
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         recursion = max(0, recursion)
         if recursion == 0:
             await ctx.send(_("Function calls will not be used since recursion is 0"))
@@ -985,6 +1118,41 @@ class Admin(MixinMeta):
         )
         conf.max_function_calls = recursion
 
+    @assistant.command(name="parallelfunctions", aliases=["parallelcalls"])
+    async def set_parallel_functions(self, ctx: commands.Context, limit: int):
+        """Set how many function calls from a single response can run at once
+
+        When the model asks for several functions in one response, independent ones run concurrently up to this limit.
+        Results are still given back to the model in the order it asked for them.
+
+        Set to 1 to run them one at a time
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        limit = max(1, limit)
+        conf.max_parallel_functions = limit
+        if limit == 1:
+            await ctx.send(_("Function calls will now run one at a time"))
+        else:
+            await ctx.send(_("Up to {} function calls from the same response will now run at once").format(limit))
+        await self.save_conf()
+
+    @assistant.command(name="functiontimeout")
+    async def set_function_timeout(self, ctx: commands.Context, seconds: int):
+        """Set how many seconds a function call can take before it is abandoned
+
+        The model is told the function timed out so it can carry on without it.
+
+        Set to 0 for no limit
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        seconds = max(0, seconds)
+        conf.function_timeout = seconds
+        if seconds:
+            await ctx.send(_("Function calls will now time out after {} seconds").format(seconds))
+        else:
+            await ctx.send(_("Function calls no longer have a time limit"))
+        await self.save_conf()
+
     @assistant.command(name="minlength")
     async def min_length(self, ctx: commands.Context, min_question_length: int):
         """
@@ -994,7 +1162,7 @@ class Admin(MixinMeta):
         """
         if min_question_length < 0:
             return await ctx.send(_("Minimum length needs to be at least 0 or higher"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.min_length = min_question_length
         if min_question_length == 0:
             await ctx.send(_("{} will respond regardless of message length").format(ctx.bot.user.name))
@@ -1020,7 +1188,7 @@ class Admin(MixinMeta):
 
         Using more than the model can handle will raise exceptions.
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.max_tokens = max_tokens
         if max_tokens:
             txt = _(
@@ -1039,7 +1207,7 @@ class Admin(MixinMeta):
 
         Set to 0 for response tokens to be dynamic
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.max_response_tokens = max_tokens
         if max_tokens:
             txt = _("The maximum amount of tokens in the models responses will be {}.").format(max_tokens)
@@ -1054,7 +1222,7 @@ class Admin(MixinMeta):
         Set the OpenAI model to use
         """
         model = model.lower().strip() if model else None
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
 
@@ -1066,7 +1234,7 @@ class Admin(MixinMeta):
 
         if conf.api_key and "deepseek" not in model:
             try:
-                client = openai.AsyncOpenAI(api_key=conf.api_key)
+                client = get_client(conf.api_key)
                 await client.models.retrieve(model)
             except openai.NotFoundError as e:
                 txt = _("Error: {}").format(e.response.json()["error"]["message"])
@@ -1080,7 +1248,7 @@ class Admin(MixinMeta):
     async def set_embedding_model(self, ctx: commands.Context, model: str = None):
         """Set the OpenAI Embedding model to use"""
         model = model.lower().strip() if model else None
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
 
@@ -1104,7 +1272,7 @@ class Admin(MixinMeta):
         """
         if not yes_or_no:
             return await ctx.send(_("Not wiping embedding data"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.embeddings = {}
         await ctx.send(_("All embedding data has been wiped!"))
         await self.save_conf()
@@ -1121,6 +1289,7 @@ class Admin(MixinMeta):
         for key, convo in self.db.conversations.items():
             if ctx.guild.id == int(key.split("-")[2]):
                 convo.messages.clear()
+                convo.mark_dirty()
         await ctx.send(_("Conversations have been wiped in this server!"))
         await self.save_conf()
 
@@ -1133,7 +1302,7 @@ class Admin(MixinMeta):
         """
         if not 0 <= top_n <= 10:
             return await ctx.send(_("Top N must be between 0 and 10"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.top_n = top_n
         if not top_n:
             await ctx.send(_("Embeddings will not be pulled during conversations"))
@@ -1154,7 +1323,7 @@ class Admin(MixinMeta):
         """
         if not 0 <= mimimum_relatedness <= 1:
             return await ctx.send(_("Minimum relatedness must be between 0 and 1"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         conf.min_relatedness = mimimum_relatedness
         await ctx.send(_("Minimum relatedness has been set to **{}**").format(mimimum_relatedness))
         await self.save_conf()
@@ -1166,15 +1335,52 @@ class Admin(MixinMeta):
             re.compile(regex)
         except re.error:
             return await ctx.send(_("That regex is invalid"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if regex in conf.regex_blacklist:
             conf.regex_blacklist.remove(regex)
             await ctx.send(_("`{}` has been **Removed** from the blacklist").format(regex))
         else:
             conf.regex_blacklist.append(regex)
             await ctx.send(_("`{}` has been **Added** to the blacklist").format(regex))
+        for pattern in self.regex_engine.set(ctx.guild.id, conf.regex_blacklist):
+            if pattern.pattern == regex and pattern.sandboxed:
+                txt = _(
+                    "This pattern could backtrack catastrophically ({}), it will run in a separate process."
+                ).format(pattern.risk)
+                await ctx.send(txt)
+        conf.mark_dirty()
         await self.save_conf()
 
+    @assistant.command(name="regexstats")
+    async def regex_stats(self, ctx: commands.Context):
+        """View how long each regex blacklist pattern takes to run
+
+        Patterns that could backtrack catastrophically run in a separate process, the rest run in-process.
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if not conf.regex_blacklist:
+            return await ctx.send(_("There are no regex blacklist patterns set"))
+        lines = []
+        for pattern in self.regex_engine.get(ctx.guild.id, conf.regex_blacklist):
+            if pattern.sandboxed:
+                mode = _("Sandboxed ({})").format(pattern.risk)
+            elif pattern.repeats:
+                mode = _("In-process, sandboxed for long replies")
+            else:
+                mode = _("In-process")
+            lines.append(
+                _("{}\n  {}\n  Runs: {}, Avg: {}ms, Max: {}ms, Timeouts: {}").format(
+                    pattern.pattern,
+                    mode,
+                    humanize_number(pattern.calls),
+                    round(pattern.average * 1000, 2),
+                    round(pattern.worst * 1000, 2),
+                    humanize_number(pattern.timeouts),
+                )
+            )
+        for p in pagify("\n".join(lines), page_length=1900):
+            await ctx.send(box(p))
+
     @assistant.command(name="regexfailblock")
     async def toggle_regex_fail_blocking(self, ctx: commands.Context):
         """
@@ -1183,7 +1389,7 @@ class Admin(MixinMeta):
         Some regexes can cause [catastrophically backtracking](https://www.rexegg.com/regex-explosive-quantifiers.html)
         The bot can safely handle if this happens and will either continue on, or block the response.
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.block_failed_regex:
             conf.block_failed_regex = False
             await ctx.send(_("If a regex blacklist fails, the bots reply will be blocked"))
@@ -1199,7 +1405,7 @@ class Admin(MixinMeta):
 
         If question mode is on, embeddings will only be sourced during the first message of a conversation and messages that end in **?**
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.question_mode:
             conf.question_mode = False
             await ctx.send(_("Question mode is now **Disabled**"))
@@ -1224,7 +1430,7 @@ class Admin(MixinMeta):
 
         Dynamic embeddings are helpful for Q&A, but not so much for chat when you need to retain the context pulled from the embeddings. The hybrid method is a good middle ground
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if conf.embed_method == "dynamic":
             conf.embed_method = "static"
             await ctx.send(_("Embedding method has been set to **Static**"))
@@ -1239,6 +1445,76 @@ class Admin(MixinMeta):
             await ctx.send(_("Embedding method has been set to **Dynamic**"))
         await self.save_conf()
 
+    @assistant.command(name="searchmethod")
+    async def toggle_search_method(self, ctx: commands.Context):
+        """
+        Toggle between exact and approximate embedding search
+
+        **Exact** search compares the query against every embedding, results are always the true top N.
+
+        **Approximate** search groups embeddings into clusters and only scans the clusters closest to the query.
+        This is much faster for large embedding sets (thousands of entries) at the cost of occasionally missing a related entry.
+        Sets smaller than 1024 entries are always searched exactly.
+
+        Use `[p]assistant searchprobes` to tune the recall/latency tradeoff and `[p]assistant searchrecall` to measure it.
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if conf.search_method == "exact":
+            conf.search_method = "approximate"
+            async with ctx.typing():
+                await asyncio.to_thread(conf.sync_embeddings)
+            await ctx.send(_("Search method has been set to **Approximate**"))
+        else:
+            conf.search_method = "exact"
+            await asyncio.to_thread(conf.sync_embeddings)
+            await ctx.send(_("Search method has been set to **Exact**"))
+        await self.save_conf()
+
+    @assistant.command(name="searchprobes")
+    async def set_search_probes(self, ctx: commands.Context, probes: commands.positive_int):
+        """
+        Set how many clusters are scanned per query in approximate search mode
+
+        Higher values improve recall (finding the same entries an exact search would) but make each search slower.
+        A set is split into roughly √N clusters, so 8 probes on 10,000 entries scans about 8% of them.
+
+        **Default:** 8
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        conf.search_probes = probes
+        await ctx.send(_("Approximate search will now scan **{}** clusters per query").format(probes))
+        await self.save_conf()
+
+    @assistant.command(name="searchrecall")
+    async def search_recall(self, ctx: commands.Context, samples: commands.positive_int = 50):
+        """
+        Measure approximate search against exact search
+
+        Random stored embeddings are used as queries and the top N results of both methods are compared.
+
+        Args:
+            samples (int): amount of queries to test
+        """
+        conf = await self.db.load_conf(ctx.guild)
+        if conf.search_method != "approximate":
+            txt = _("Approximate search is not enabled, use `{}` first").format(
+                f"{ctx.clean_prefix}assistant searchmethod"
+            )
+            return await ctx.send(txt)
+        async with ctx.typing():
+            res = await asyncio.to_thread(conf.measure_search_recall, samples)
+        if res is None:
+            return await ctx.send(_("There are not enough embeddings for approximate search to be used yet!"))
+        recall, exact_ms, approx_ms, ran = res
+        txt = (
+            _("`Queries:     `{}\n").format(humanize_number(ran))
+            + _("`Probes:      `{}\n").format(conf.search_probes)
+            + _("`Recall@{}:   `{}%\n").format(max(conf.top_n, 1), round(recall * 100, 1))
+            + _("`Exact:       `{}ms/query\n").format(round(exact_ms, 3))
+            + _("`Approximate: `{}ms/query").format(round(approx_ms, 3))
+        )
+        await ctx.send(txt)
+
     @assistant.command(name="importcsv")
     async def import_embeddings_csv(self, ctx: commands.Context, overwrite: bool):
         """Import embeddings to use with the assistant
@@ -1248,7 +1524,7 @@ class Admin(MixinMeta):
 
         This will read excel files too
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
         attachments = get_attachments(ctx.message)
@@ -1262,9 +1538,9 @@ class Admin(MixinMeta):
             file_bytes = await attachment.read()
             try:
                 if attachment.filename.lower().endswith(".csv"):
-                    df = pd.read_csv(BytesIO(file_bytes))
+                    df = await asyncio.to_thread(pd.read_csv, BytesIO(file_bytes))
                 else:
-                    df = pd.read_excel(BytesIO(file_bytes))
+                    df = await asyncio.to_thread(pd.read_excel, BytesIO(file_bytes))
             except Exception as e:
                 log.error("Error reading uploaded file", exc_info=e)
                 await ctx.send(_("Error reading **{}**: {}").format(attachment.filename, box(str(e))))
@@ -1282,43 +1558,8 @@ class Admin(MixinMeta):
         if not frames:
             return await ctx.send(_("There are no valid files to import!"))
 
-        message_text = _("Processing the following files in the background\n{}").format(box(humanize_list(files)))
-        message = await ctx.send(message_text)
-
-        df = await asyncio.to_thread(pd.concat, frames)
-
-        entries = len(df.index)
-        split_by = 10
-        if entries > 300:
-            split_by = round(entries / 25)
-        imported = 0
-        for index, row in enumerate(df.values):
-            if pd.isna(row[0]) or pd.isna(row[1]):
-                continue
-            name = str(row[0])
-            proc = _("processing")
-            if name in conf.embeddings:
-                proc = _("overwriting")
-                if row[1] == conf.embeddings[name].text or not overwrite:
-                    continue
-            text = str(row[1])[:4000]
-            if index and (index + 1) % split_by == 0:
-                with contextlib.suppress(discord.DiscordServerError):
-                    await message.edit(
-                        content=_("{}\n`Currently {}: `**{}** ({}/{})").format(
-                            message_text, proc, name, index + 1, len(df)
-                        )
-                    )
-            query_embedding = await self.request_embedding(text, conf)
-            if len(query_embedding) == 0:
-                await ctx.send(_("Failed to process embedding: `{}`").format(name))
-                continue
-
-            conf.embeddings[name] = Embedding(text=text, embedding=query_embedding, model=conf.embed_model)
-            imported += 1
-        await message.edit(content=_("{}\n**COMPLETE**").format(message_text))
-        await ctx.send(_("Successfully imported {} embeddings!").format(humanize_number(imported)))
-        await self.save_conf()
+        rows = await asyncio.to_thread(rows_from_csv, frames)
+        await self.queue_import(ctx, files, rows, overwrite)
 
     @assistant.command(name="importjson")
     async def import_embeddings_json(self, ctx: commands.Context, overwrite: bool):
@@ -1327,7 +1568,7 @@ class Admin(MixinMeta):
         Args:
             overwrite (bool): overwrite embeddings with existing entry names
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         attachments = get_attachments(ctx.message)
         if not attachments:
             return await ctx.send(
@@ -1358,6 +1599,7 @@ class Admin(MixinMeta):
                     )
                     continue
                 files.append(attachment.filename)
+            await asyncio.to_thread(conf.sync_embeddings)
             await ctx.send(
                 _("Imported the following files: `{}`\n{} embeddings imported").format(
                     humanize_list(files), humanize_number(imported)
@@ -1372,15 +1614,15 @@ class Admin(MixinMeta):
         Args:
             overwrite (bool): overwrite embeddings with existing entry names
         """
-        conf = self.db.get_conf(ctx.guild)
-        tz = pytz.timezone(conf.timezone)
+        conf = await self.db.load_conf(ctx.guild)
+        if not await self.can_call_llm(conf, ctx):
+            return
         attachments = get_attachments(ctx.message)
         if not attachments:
             return await ctx.send(
                 _("You must attach **.xlsx** files to this command or reference a message that has them!")
             )
 
-        imported = 0
         files = []
         frames = []
         async with ctx.typing():
@@ -1388,7 +1630,7 @@ class Admin(MixinMeta):
                 file_bytes = await attachment.read()
                 try:
                     # Read the Excel file into a DataFrame
-                    df = pd.read_excel(BytesIO(file_bytes), sheet_name="embeddings")
+                    df = await asyncio.to_thread(pd.read_excel, BytesIO(file_bytes), sheet_name="embeddings")
                 except Exception as e:
                     log.error("Error reading uploaded file", exc_info=e)
                     await ctx.send(_("Error reading **{}**: {}").format(attachment.filename, box(str(e))))
@@ -1408,53 +1650,11 @@ class Admin(MixinMeta):
                 frames.append(df)
                 files.append(attachment.filename)
 
-            message_text = _("Processing the following files in the background\n{}").format(box(humanize_list(files)))
-            message = await ctx.send(message_text)
-            df = await asyncio.to_thread(pd.concat, frames)
-            entries = len(df.index)
-            split_by = 10
-            if entries > 300:
-                split_by = round(entries / 25)
-            imported = 0
-            for index, row in df.iterrows():
-                name = row["name"]
-                text = row["text"]
-                proc = _("processing")
-                if name in conf.embeddings:
-                    proc = _("overwriting")
-                    if not overwrite or conf.embeddings[name].text == text:
-                        continue
-                created_tz = pd.to_datetime(row["created"]).tz_localize(tz)
-
-                if index and (index + 1) % split_by == 0:
-                    with contextlib.suppress(discord.DiscordServerError):
-                        await message.edit(
-                            content=_("{}\n`Currently {}: `**{}** ({}/{})").format(
-                                message_text, proc, name, index + 1, len(df)
-                            )
-                        )
-
-                query_embedding = await self.request_embedding(text, conf)
-                if len(query_embedding) == 0:
-                    await ctx.send(_("Failed to process embedding: `{}`").format(name))
-                    continue
-
-                conf.embeddings[name] = Embedding(
-                    text=text,
-                    embedding=query_embedding,
-                    ai_created=row["ai_created"],
-                    created=created_tz,
-                    model=conf.embed_model,
-                )
-                imported += 1
+        if not frames:
+            return await ctx.send(_("There are no valid files to import!"))
 
-            if imported:
-                await message.edit(content=_("{}\n**COMPLETE**").format(message_text))
-                await ctx.send(_("Successfully imported {} embeddings!").format(humanize_number(imported)))
-                await self.save_conf()
-            else:
-                await message.edit(content=_("{}\n**COMPLETE**").format(message_text))
-                await ctx.send(_("No embeddings needed to be updated!"))
+        rows = await asyncio.to_thread(rows_from_excel, frames, conf.timezone)
+        await self.queue_import(ctx, files, rows, overwrite)
 
     @assistant.command(name="exportexcel")
     @commands.bot_has_permissions(attach_files=True)
@@ -1464,7 +1664,7 @@ class Admin(MixinMeta):
 
         **Note:** csv exports do not include the embedding values
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.embeddings:
             return await ctx.send(_("There are no embeddings to export!"))
 
@@ -1507,7 +1707,7 @@ class Admin(MixinMeta):
 
         **Note:** csv exports do not include the embedding values
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.embeddings:
             return await ctx.send(_("There are no embeddings to export!"))
         async with ctx.typing():
@@ -1551,7 +1751,7 @@ class Admin(MixinMeta):
     @commands.bot_has_permissions(attach_files=True)
     async def export_embeddings_json(self, ctx: commands.Context):
         """Export embeddings to a json file"""
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.embeddings:
             return await ctx.send(_("There are no embeddings to export!"))
 
@@ -1602,7 +1802,7 @@ class Admin(MixinMeta):
         **Note**
         You can enter a search query with this command to bring up the menu and go directly to that embedding selection.
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if ctx.interaction:
             await ctx.interaction.response.defer()
 
@@ -1664,6 +1864,8 @@ class Admin(MixinMeta):
         if ctx.interaction:
             await ctx.interaction.response.defer()
 
+        # The menu grabs the settings synchronously, make sure they're loaded first
+        await self.db.load_conf(ctx.guild)
         view = CodeMenu(ctx, self.db, self.registry, self.save_conf, self.get_function_menu_embeds)
         await view.get_pages()
         if not function_name:
@@ -1687,7 +1889,8 @@ class Admin(MixinMeta):
 
     @cached(ttl=120)
     async def get_embedding_entries(self, guild_id: int) -> List[str]:
-        return list(self.db.get_conf(guild_id).embeddings.keys())
+        conf = await self.db.load_conf(guild_id)
+        return list(conf.embeddings.keys())
 
     @cached(ttl=30)
     async def get_matches(self, guild_id: int, current: str) -> List[Choice]:
@@ -1721,13 +1924,14 @@ class Admin(MixinMeta):
 
         `channel_role_member` can be a member, role, channel, or category channel
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if channel_role_member.id in conf.blacklist:
             conf.blacklist.remove(channel_role_member.id)
             await ctx.send(_("{} has been removed from the blacklist").format(channel_role_member.name))
         else:
             conf.blacklist.append(channel_role_member.id)
             await ctx.send(_("{} has been added to the blacklist").format(channel_role_member.name))
+        conf.mark_dirty()
         await self.save_conf()
 
     @assistant.command(name="tutor", aliases=["tutors"])
@@ -1747,13 +1951,14 @@ class Admin(MixinMeta):
 
         `role_or_member` can be a member or role
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if role_or_member.id in conf.tutors:
             conf.tutors.remove(role_or_member.id)
             await ctx.send(_("{} has been removed from the tutor list").format(role_or_member.name))
         else:
             conf.tutors.append(role_or_member.id)
             await ctx.send(_("{} has been added to the tutor list").format(role_or_member.name))
+        conf.mark_dirty()
         await self.save_conf()
 
     @assistant.group(name="override")
@@ -1773,7 +1978,7 @@ class Admin(MixinMeta):
         *Specify same role and model to remove the override*
         """
         model = model.lower().strip()
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
 
@@ -1782,7 +1987,7 @@ class Admin(MixinMeta):
 
         if conf.api_key:
             try:
-                client = openai.AsyncOpenAI(api_key=conf.api_key)
+                client = get_client(conf.api_key)
                 await client.models.retrieve(model)
             except openai.NotFoundError as e:
                 txt = _("Error: {}").format(e.response.json()["error"]["message"])
@@ -1799,6 +2004,7 @@ class Admin(MixinMeta):
             conf.role_overrides[role.id] = model
             await ctx.send(_("Role override for {} added!").format(role.mention))
 
+        conf.mark_dirty()
         await self.save_conf()
 
     @override.command(name="maxtokens")
@@ -1810,7 +2016,7 @@ class Admin(MixinMeta):
         """
         if max_tokens < 100:
             return await ctx.send(_("Use at least 100 tokens"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
 
         if role.id in conf.max_token_role_override:
             if conf.max_token_role_override[role.id] == max_tokens:
@@ -1823,6 +2029,7 @@ class Admin(MixinMeta):
             conf.max_token_role_override[role.id] = max_tokens
             await ctx.send(_("Max token override for {} added!").format(role.mention))
 
+        conf.mark_dirty()
         await self.save_conf()
 
     @override.command(name="maxresponsetokens")
@@ -1836,7 +2043,7 @@ class Admin(MixinMeta):
 
         *Specify same role and token count to remove the override*
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
 
         if role.id in conf.max_response_token_override:
             if conf.max_response_token_override[role.id] == max_tokens:
@@ -1848,6 +2055,7 @@ class Admin(MixinMeta):
         else:
             conf.max_response_token_override[role.id] = max_tokens
             await ctx.send(_("Max response token override for {} added!").format(role.mention))
+        conf.mark_dirty()
         await self.save_conf()
 
     @override.command(name="maxretention")
@@ -1859,7 +2067,7 @@ class Admin(MixinMeta):
         """
         if max_retention < 0:
             return await ctx.send(_("Max retention needs to be at least 0 or higher"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
 
         if role.id in conf.max_retention_role_override:
             if conf.max_retention_role_override[role.id] == max_retention:
@@ -1871,6 +2079,7 @@ class Admin(MixinMeta):
         else:
             conf.max_retention_role_override[role.id] = max_retention
             await ctx.send(_("Max retention override for {} added!").format(role.mention))
+        conf.mark_dirty()
         await self.save_conf()
 
     @override.command(name="maxtime")
@@ -1882,7 +2091,7 @@ class Admin(MixinMeta):
         """
         if retention_seconds < 0:
             return await ctx.send(_("Max retention time needs to be at least 0 or higher"))
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
 
         if role.id in conf.max_time_role_override:
             if conf.max_time_role_override[role.id] == retention_seconds:
@@ -1894,6 +2103,7 @@ class Admin(MixinMeta):
         else:
             conf.max_time_role_override[role.id] = retention_seconds
             await ctx.send(_("Max retention time override for {} added!").format(role.mention))
+        conf.mark_dirty()
         await self.save_conf()
 
     # --------------------------------------------------------------------------------------
@@ -1931,7 +2141,7 @@ class Admin(MixinMeta):
         """Wipe all settings and data for entire cog"""
         if not confirm:
             return await ctx.send(_("Not wiping cog"))
-        self.db.configs.clear()
+        self.db.clear_configs()
         self.db.conversations.clear()
         self.db.persistent_conversations = False
         await self.save_conf()
@@ -1949,7 +2159,8 @@ class Admin(MixinMeta):
         def _dump():
             # Delete and convo data
             self.db.conversations.clear()
-            return self.db.json()
+            self.db.load_all()
+            return orjson.dumps(self.db.model_dump()).decode()
 
         dump = await asyncio.to_thread(_dump)
 
@@ -2012,6 +2223,7 @@ class Admin(MixinMeta):
             return await ctx.send(_("Not wiping conversations"))
         for convo in self.db.conversations.values():
             convo.messages.clear()
+            convo.mark_dirty()
         await ctx.send(_("Conversations have been wiped for all servers!"))
         await self.save_conf()
 
@@ -2037,6 +2249,7 @@ class Admin(MixinMeta):
         """
         if not yes_or_no:
             return await ctx.send(_("Not wiping embedding data"))
+        await asyncio.to_thread(self.db.load_all)
         for conf in self.db.configs.values():
             conf.embeddings = {}
         await ctx.send(_("All embedding data has been wiped for all servers!"))
@@ -2057,3 +2270,287 @@ class Admin(MixinMeta):
             self.db.listen_to_bots = True
             await ctx.send(_("Assistant will listen to other bot messages"))
         await self.save_conf()
+
+    @assistant.command(name="embedprecision")
+    @commands.is_owner()
+    async def set_embedding_precision(self, ctx: commands.Context, precision: str = None):
+        """
+        Set how embedding vectors are stored in memory for all servers
+
+        **float32** - Full precision, ~6KB per 1536 dimension vector (Default)
+        **float16** - Half the memory, negligible effect on search results
+        **int8** - A quarter of the memory, vectors are scaled to 8 bit integers so relatedness scores shift slightly
+
+        Saved embeddings still export as normal lists of floats.
+        """
+        if precision is None:
+            sizes = {}
+            for conf in self.db.configs.values():
+                for em in conf.embeddings.values():
+                    sizes[em.embedding.dtype] = sizes.get(em.embedding.dtype, 0) + em.embedding.nbytes
+            txt = _("Embeddings are stored as **{}**").format(self.db.embedding_precision)
+            for dtype, size in sizes.items():
+                txt += _("\n`{}: `{} MB").format(dtype, round(size / 1024**2, 2))
+            return await ctx.send(txt)
+
+        precision = precision.lower()
+        if precision not in PRECISIONS:
+            return await ctx.send(_("Precision must be one of: {}").format(humanize_list(PRECISIONS)))
+
+        def _convert() -> int:
+            converted = 0
+            for conf in self.db.configs.values():
+                for em in conf.embeddings.values():
+                    if em.embedding.dtype != precision:
+                        em.embedding = Vector.from_values(em.embedding, precision)
+                        converted += 1
+            return converted
+
+        self.db.embedding_precision = precision
+        Vector.precision = precision
+        async with ctx.typing():
+            converted = await asyncio.to_thread(_convert)
+        await ctx.send(
+            _(
+                "Embeddings will now be stored as **{}**, {} vectors converted. "
+                "Servers that haven't been used since the bot started are converted when they're loaded."
+            ).format(precision, humanize_number(converted))
+        )
+        await self.save_conf()
+
+    @assistant.command(name="embedcache")
+    @commands.is_owner()
+    async def embedding_cache_settings(self, ctx: commands.Context, size_mb: int = None):
+        """
+        View the query embedding cache stats or set its size in MB
+
+        Embeddings for recently asked questions are reused instead of requested again, across all servers using the same embed model.
+        Set the size to 0 to disable the cache.
+        """
+        cache = self.embedding_cache
+        if size_mb is None:
+            lookups = cache.hits + cache.misses
+            hit_rate = round(cache.hits / lookups * 100, 1) if lookups else 0
+            txt = (
+                _("`Entries:   `{}\n").format(humanize_number(len(cache)))
+                + _("`Size:      `{} / {} MB\n").format(round(cache.nbytes / 1024**2, 2), self.db.embedding_cache_size)
+                + _("`Hits:      `{}\n").format(humanize_number(cache.hits))
+                + _("`Misses:    `{}\n").format(humanize_number(cache.misses))
+                + _("`Hit Rate:  `{}%\n").format(hit_rate)
+                + _("`Persisted: `{}").format(self.db.persist_embedding_cache)
+            )
+            return await ctx.send(txt)
+        if size_mb < 0:
+            return await ctx.send(_("Cache size cannot be negative!"))
+        self.db.embedding_cache_size = size_mb
+        cache.resize(size_mb * 1024**2)
+        if size_mb:
+            await ctx.send(_("Embedding cache size set to **{} MB**").format(size_mb))
+        else:
+            await ctx.send(_("Embedding cache has been **Disabled**"))
+        await self.save_conf()
+
+    @assistant.command(name="persistembedcache")
+    @commands.is_owner()
+    async def toggle_persist_embedding_cache(self, ctx: commands.Context):
+        """Toggle saving the query embedding cache to disk so it survives restarts"""
+        if self.db.persist_embedding_cache:
+            self.db.persist_embedding_cache = False
+            self.embedding_cache_path.unlink(missing_ok=True)
+            await ctx.send(_("The embedding cache will no longer be saved to disk"))
+        else:
+            self.db.persist_embedding_cache = True
+            self.embedding_cache.dirty = True
+            await ctx.send(_("The embedding cache will now be saved to disk"))
+        await self.save_conf()
+
+    @assistant.command(name="workerpool")
+    @commands.is_owner()
+    async def set_worker_pool_size(self, ctx: commands.Context, workers: int):
+        """
+        Set how many processes run risky regex blacklist patterns
+
+        The pool is only started once a pattern needs it and shuts down again after sitting idle.
+        Set to 0 to pick automatically.
+        """
+        if workers < 0:
+            return await ctx.send(_("Worker count cannot be negative!"))
+        self.db.worker_pool_size = workers
+        self.worker_pool.resize(workers)
+        if workers:
+            await ctx.send(_("The worker pool will now use **{}** processes").format(workers))
+        else:
+            await ctx.send(_("The worker pool will now use **{}** processes (automatic)").format(default_size()))
+        await self.save_conf()
+
+    @assistant.command(name="diagnostics")
+    @commands.is_owner()
+    async def diagnostics(self, ctx: commands.Context):
+        """View resource usage of the assistant's background workers, reply pre-flight timings and API rate limit queues"""
+        pool = self.worker_pool
+        mb = 1024**2
+        size = _("{} (automatic)").format(pool.workers) if not pool.size else str(pool.workers)
+        txt = (
+            _("`Pool Running: `{}\n").format(pool.running)
+            + _("`Pool Size:    `{}\n").format(size)
+            + _("`Recycled:     `{}\n").format(humanize_number(pool.recycled))
+        )
+        if pool.running:
+            txt += _("`Idle For:     `{}s\n").format(round(monotonic() - pool.last_used))
+            workers = pool.worker_memory()
+            known = [rss for __, rss in workers if rss is not None]
+            txt += _("`Worker RSS:   `{} MB\n").format(round(sum(known) / mb, 1))
+            for pid, rss in workers:
+                usage = _("{} MB").format(round(rss / mb, 1)) if rss is not None else _("Unknown")
+                txt += _("- PID {}: {}\n").format(pid, usage)
+
+        patterns = [p for __, compiled in self.regex_engine.guilds.values() for p in compiled]
+        sandboxed = [p for p in patterns if p.sandboxed]
+        txt += _("`Regex Patterns: `{} ({} sandboxed)\n").format(len(patterns), len(sandboxed))
+        txt += _("`Regex Timeouts: `{}\n").format(humanize_number(sum(p.timeouts for p in patterns)))
+        txt += _("`Coalesced:      `{} of {} requests joined one in flight\n").format(
+            humanize_number(self.singleflight.shared),
+            humanize_number(self.singleflight.calls + self.singleflight.shared),
+        )
+
+        if summary := self.preflight_timings.summary():
+            txt += _("\n**Pre-flight** (last {} replies)\n").format(summary[0][3])
+            for step, average, worst, __ in summary:
+                txt += _("`{}`avg {}ms, max {}ms\n").format(
+                    step.ljust(11), round(average * 1000, 1), round(worst * 1000, 1)
+                )
+
+        for (api_key, __, model), limiter in limiters().items():
+            if not limiter.calls and not limiter.queued:
+                continue
+            txt += _("\n**Rate Limits** `{}` (key ending {})\n").format(model, api_key[-4:])
+            txt += _("`Queued:    `{}\n").format(limiter.queued)
+            txt += _("`Waited:    `{}/{} requests, avg {}ms, max {}s\n").format(
+                humanize_number(limiter.waits),
+                humanize_number(limiter.calls),
+                round(limiter.average_wait * 1000, 1),
+                round(limiter.worst_wait, 2),
+            )
+            txt += _("`429s:      `{}\n").format(humanize_number(limiter.limited))
+            if limiter.requests.limit:
+                txt += _("`Budget:    `{} RPM, {} TPM\n").format(
+                    humanize_number(limiter.requests.limit), humanize_number(limiter.tokens.limit or 0)
+                )
+        for p in pagify(txt, page_length=1900):
+            await ctx.send(p)
+
+    @assistant.command(name="chatlimits")
+    @commands.is_owner()
+    async def set_chat_limits(
+        self,
+        ctx: commands.Context,
+        total: int = None,
+        per_server: int = None,
+        queued: int = None,
+        timeout: int = None,
+    ):
+        """
+        View or set how many replies can be generated at once
+
+        **Arguments**
+        `total` - replies generated at once across all servers
+        `per_server` - replies generated at once per server
+        `queued` - messages a server can have waiting before new ones are turned away
+        `timeout` - seconds a message can wait for its turn (0 for no limit)
+
+        When busy, servers take turns based on their priority (see `[p]assistant priority`).
+        """
+        if total is None:
+            scheduler = self.scheduler
+            txt = (
+                _("`Total:      `{}\n").format(self.db.max_concurrent_chats)
+                + _("`Per Server: `{}\n").format(self.db.max_guild_chats)
+                + _("`Queued:     `{}\n").format(self.db.max_queued_chats)
+                + _("`Timeout:    `{}s\n").format(self.db.chat_queue_timeout)
+                + _("`Active Now: `{}\n").format(scheduler.active)
+                + _("`Queued Now: `{}\n").format(scheduler.queued)
+            )
+            if stats := scheduler.stats(ctx.guild.id):
+                avg_wait = stats.total_wait / stats.served if stats.served else 0
+                txt += _("This server has been served {} times (avg wait {}s), {} messages were turned away").format(
+                    humanize_number(stats.served), round(avg_wait, 2), humanize_number(stats.shed)
+                )
+            return await ctx.send(txt)
+        if any(i is not None and i < 1 for i in (total, per_server, queued)) or (timeout is not None and timeout < 0):
+            return await ctx.send(_("Limits must be at least 1 and the timeout cannot be negative!"))
+        self.db.max_concurrent_chats = total
+        if per_server is not None:
+            self.db.max_guild_chats = per_server
+        if queued is not None:
+            self.db.max_queued_chats = queued
+        if timeout is not None:
+            self.db.chat_queue_timeout = timeout
+        self.configure_scheduler()
+        await ctx.send(
+            _("Up to {} replies at once, {} per server, with {} messages queued per server for up to {}s").format(
+                self.db.max_concurrent_chats,
+                self.db.max_guild_chats,
+                self.db.max_queued_chats,
+                self.db.chat_queue_timeout,
+            )
+        )
+        await self.save_conf()
+
+    @assistant.command(name="connectionpool")
+    @commands.is_owner()
+    async def set_connection_pool(
+        self,
+        ctx: commands.Context,
+        connections: int = None,
+        keepalive: int = None,
+        expiry: int = None,
+    ):
+        """
+        View or set the HTTP connection pool limits for API requests
+
+        **Arguments**
+        `connections` - open connections per API key and endpoint
+        `keepalive` - idle connections kept open for reuse
+        `expiry` - seconds an idle connection stays open
+
+        Existing connections are replaced on the next request and closed once they've had time to finish.
+        """
+        if connections is None:
+            limits = pool_limits()
+            txt = (
+                _("`Connections: `{}\n").format(limits.max_connections)
+                + _("`Keepalive:   `{}\n").format(limits.max_keepalive_connections)
+                + _("`Expiry:      `{}s").format(limits.keepalive_expiry)
+            )
+            return await ctx.send(txt)
+        if connections < 1 or any(i is not None and i < 0 for i in (keepalive, expiry)):
+            return await ctx.send(_("Connections must be at least 1 and the other limits cannot be negative!"))
+        self.db.max_connections = connections
+        if keepalive is not None:
+            self.db.max_keepalive_connections = keepalive
+        if expiry is not None:
+            self.db.keepalive_expiry = expiry
+        set_pool_limits(self.db.max_connections, self.db.max_keepalive_connections, self.db.keepalive_expiry)
+        await ctx.send(
+            _("Up to {} connections per API key, keeping {} idle connections open for {}s").format(
+                self.db.max_connections,
+                self.db.max_keepalive_connections,
+                self.db.keepalive_expiry,
+            )
+        )
+        await self.save_conf()
+
+    @assistant.command(name="priority")
+    @commands.is_owner()
+    async def set_priority(self, ctx: commands.Context, priority: int):
+        """
+        Set this server's priority when the bot is busy
+
+        A server with priority 2 gets twice as many turns as a server with priority 1 while both have messages waiting.
+        """
+        if not 1 <= priority <= 10:
+            return await ctx.send(_("Priority must be between 1 and 10"))
+        conf = await self.db.load_conf(ctx.guild)
+        conf.priority = priority
+        await ctx.send(_("This server's priority has been set to **{}**").format(priority))
+        await self.save_conf()
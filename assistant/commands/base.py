@@ -94,7 +94,7 @@ If a file has no extension it will still try to read it only if it can be decode
         quality: t.Literal["standard", "hd"] = "standard",
         style: t.Literal["natural", "vivid"] = "vivid",
     ):
-        conf = self.db.get_conf(interaction.guild)
+        conf = await self.db.load_conf(interaction.guild)
         if not conf.api_key and not self.db.endpoint_override:
             return await interaction.response.send_message(_("The API key is not set up!"), ephemeral=True)
         if not conf.image_command:
@@ -151,13 +151,12 @@ If a file has no extension it will still try to read it only if it can be decode
         - Including `--outputfile hello.py --extract` will output a file containing just the code blocks and send the rest as text.
         - Including `--extract` will send the code separately from the reply
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not await self.can_call_llm(conf, ctx):
             return
         if not await can_use(ctx.message, conf.blacklist):
             return
-        async with ctx.typing():
-            await self.handle_message(ctx.message, question, conf)
+        await self.handle_in_turn(ctx.message, question, conf)
 
     @commands.command(name="convostats")
     @commands.guild_only()
@@ -171,7 +170,7 @@ If a file has no extension it will still try to read it only if it can be decode
         """
         if not user:
             user = ctx.author
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         mem_id = ctx.channel.id if conf.collab_convos else user.id
         conversation = self.db.get_conversation(mem_id, ctx.channel.id, ctx.guild.id)
         messages = len(conversation.messages)
@@ -196,7 +195,7 @@ If a file has no extension it will still try to read it only if it can be decode
             # Return the new RGB color
             return (green, blue)
 
-        convo_tokens = await self.count_payload_tokens(conversation.messages, conf.get_user_model(user))
+        convo_tokens = await self.count_payload_tokens(conversation.messages, conf.get_user_model(user), conversation)
         g, b = generate_color(messages, conf.get_user_max_retention(ctx.author))
         gg, bb = generate_color(convo_tokens, max_tokens)
         # Whatever limit is more severe get that color
@@ -244,7 +243,7 @@ If a file has no extension it will still try to read it only if it can be decode
 
         This will clear all message history between you and the bot for this channel
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         mem_id = ctx.channel.id if conf.collab_convos else ctx.author.id
         perms = [
             await self.bot.is_mod(ctx.author),
@@ -265,7 +264,7 @@ If a file has no extension it will still try to read it only if it can be decode
         """
         Pop the last message from your conversation
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         mem_id = ctx.channel.id if conf.collab_convos else ctx.author.id
         perms = [
             await self.bot.is_mod(ctx.author),
@@ -280,6 +279,7 @@ If a file has no extension it will still try to read it only if it can be decode
             txt = _("There are no messages in this conversation yet!")
             return await ctx.send(txt)
         last = conversation.messages.pop()
+        conversation.mark_dirty()
         dump = json.dumps(last, indent=2)
         file = text_to_file(dump, "popped.json")
         await ctx.send(_("Removed the last message from this conversation"), file=file)
@@ -360,7 +360,7 @@ If a file has no extension it will still try to read it only if it can be decode
         if len(messages) < 5:
             return await interaction.followup.send(_("Not enough messages found to summarize within that timeframe!"))
 
-        conf = self.db.get_conf(interaction.guild)
+        conf = await self.db.load_conf(interaction.guild)
 
         humanized_delta = humanize_timedelta(timedelta=delta)
 
@@ -508,7 +508,7 @@ If a file has no extension it will still try to read it only if it can be decode
         """
         Copy the conversation to another channel, thread, or forum
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         mem_id = ctx.channel.id if conf.collab_convos else ctx.author.id
         perms = [
             await self.bot.is_mod(ctx.author),
@@ -552,7 +552,7 @@ If a file has no extension it will still try to read it only if it can be decode
 
         Check out [This Guide](https://platform.openai.com/docs/guides/prompt-engineering) for prompting help.
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.allow_sys_prompt_override:
             txt = _("Conversation system prompt overriding is **Disabled**.")
             return await ctx.send(txt)
@@ -615,7 +615,7 @@ If a file has no extension it will still try to read it only if it can be decode
         if not user:
             user = ctx.author
 
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         mem_id = ctx.channel.id if conf.collab_convos else user.id
         conversation = self.db.get_conversation(mem_id, channel.id, ctx.guild.id)
         if not conversation.messages:
@@ -642,7 +642,7 @@ If a file has no extension it will still try to read it only if it can be decode
 
         You can use this to fine-tune the minimum relatedness for your assistant
         """
-        conf = self.db.get_conf(ctx.guild)
+        conf = await self.db.load_conf(ctx.guild)
         if not conf.embeddings:
             return await ctx.send(_("You do not have any embeddings configured!"))
         if not conf.top_n:
@@ -1,24 +1,41 @@
 import asyncio
+import contextlib
 import inspect
 import json
 import logging
 import math
-from typing import List, Optional
+from time import monotonic, perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional
 
 import aiohttp
 import discord
-import tiktoken
 from openai.types.chat.chat_completion import ChatCompletion
 from openai.types.chat.chat_completion_message import ChatCompletionMessage
-from openai.types.create_embedding_response import CreateEmbeddingResponse
 from redbot.core import commands
 from redbot.core.i18n import Translator, cog_i18n
-from redbot.core.utils.chat_formatting import box, humanize_number
+from redbot.core.utils.chat_formatting import box, humanize_list, humanize_number, humanize_timedelta
 
 from ..abc import MixinMeta
-from .calls import request_chat_completion_raw, request_embedding_raw
+from . import tokenizer
+from .calls import (
+    get_embedding_batcher,
+    request_chat_completion_raw,
+    request_embedding_raw,
+    stream_chat_completion_raw,
+)
 from .constants import MODELS
-from .models import GuildSettings
+from .imports import (
+    CHECKPOINT_INTERVAL,
+    IMPORT_CHUNK,
+    RESYNC_BATCH,
+    RESYNC_WORKERS,
+    ImportJob,
+    ResyncJob,
+    Row,
+    make_embedding,
+    pending_rows,
+)
+from .models import Conversation, GuildSettings
 
 log = logging.getLogger("red.vrt.assistant.api")
 _ = Translator("Assistant", __file__)
@@ -48,13 +65,19 @@ class API(MixinMeta):
         response_token_override: int = None,
         model_override: Optional[str] = None,
         temperature_override: Optional[float] = None,
+        conversation: Optional[Conversation] = None,
+        stream_callback: Optional[Callable[[str], Awaitable[None]]] = None,
     ) -> ChatCompletionMessage:
+        """Request a chat completion
+
+        If a stream callback is passed, the response is streamed and the callback is awaited with the content so far as it arrives
+        """
         model = model_override or conf.get_user_model(member)
 
         max_convo_tokens = self.get_max_tokens(conf, member)
         max_response_tokens = conf.get_user_max_response_tokens(member)
 
-        current_convo_tokens = await self.count_payload_tokens(messages, model)
+        current_convo_tokens = await self.count_payload_tokens(messages, model, conversation)
         if functions:
             current_convo_tokens += await self.count_function_tokens(functions, model)
 
@@ -85,44 +108,55 @@ class API(MixinMeta):
             model = "gpt-4o-mini"
             await self.save_conf()
 
-        response: ChatCompletion = await request_chat_completion_raw(
-            model=model,
-            messages=messages,
-            temperature=temperature_override if temperature_override is not None else conf.temperature,
-            api_key=conf.api_key,
-            max_tokens=response_tokens,
-            functions=functions,
-            frequency_penalty=conf.frequency_penalty,
-            presence_penalty=conf.presence_penalty,
-            seed=conf.seed,
-            base_url=self.db.endpoint_override,
-        )
+        kwargs = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature_override if temperature_override is not None else conf.temperature,
+            "api_key": conf.api_key,
+            "max_tokens": response_tokens,
+            "functions": functions,
+            "frequency_penalty": conf.frequency_penalty,
+            "presence_penalty": conf.presence_penalty,
+            "seed": conf.seed,
+            "base_url": self.db.endpoint_override,
+            # Counted against the key's per minute token budget before sending
+            "tokens": current_convo_tokens + response_tokens,
+        }
+        if stream_callback is not None:
+            response: ChatCompletion = await stream_chat_completion_raw(on_content=stream_callback, **kwargs)
+        else:
+            response: ChatCompletion = await request_chat_completion_raw(**kwargs)
         message: ChatCompletionMessage = response.choices[0].message
 
-        conf.update_usage(
-            response.model,
-            response.usage.total_tokens,
-            response.usage.prompt_tokens,
-            response.usage.completion_tokens,
-        )
+        if response.usage:
+            conf.update_usage(
+                response.model,
+                response.usage.total_tokens,
+                response.usage.prompt_tokens,
+                response.usage.completion_tokens,
+            )
+        else:
+            # Some endpoints don't report usage for streamed responses
+            completion_tokens = await self.count_tokens(message.content or "", model)
+            conf.update_usage(
+                response.model,
+                current_convo_tokens + completion_tokens,
+                current_convo_tokens,
+                completion_tokens,
+            )
         log.debug(f"MESSAGE TYPE: {type(message)}")
         return message
 
     async def request_embedding(self, text: str, conf: GuildSettings) -> List[float]:
-        response: CreateEmbeddingResponse = await request_embedding_raw(
-            text=text,
-            api_key=conf.api_key,
-            model=conf.embed_model,
-            base_url=self.db.endpoint_override,
-        )
-
-        conf.update_usage(
-            response.model,
-            response.usage.total_tokens,
-            response.usage.prompt_tokens,
-            0,
-        )
-        return response.data[0].embedding
+        endpoint = self.db.endpoint_override
+        if cached := self.embedding_cache.get(text, conf.embed_model, endpoint):
+            return cached
+        # Concurrent requests for the same key and model are sent together
+        batcher = get_embedding_batcher(conf.api_key, conf.embed_model, endpoint)
+        embedding, tokens, model = await batcher.embed(text)
+        conf.update_usage(model, tokens, tokens, 0)
+        self.embedding_cache.put(text, conf.embed_model, embedding, endpoint)
+        return embedding
 
     # -------------------------------------------------------
     # -------------------------------------------------------
@@ -130,119 +164,28 @@ class API(MixinMeta):
     # -------------------------------------------------------
     # -------------------------------------------------------
 
-    async def count_payload_tokens(self, messages: List[dict], model: str = "gpt-4o-mini") -> int:
+    async def count_payload_tokens(
+        self,
+        messages: List[dict],
+        model: str = "gpt-4o-mini",
+        conversation: Optional[Conversation] = None,
+    ) -> int:
+        """Count tokens for a list of messages
+
+        If the conversation the messages belong to is passed, its per message cache is used so only new or edited messages get encoded
+        """
         if not messages:
             return 0
-
-        def _count_payload():
-            try:
-                encoding = tiktoken.encoding_for_model(model)
-            except KeyError:
-                encoding = tiktoken.get_encoding("o200k_base")
-
-            tokens_per_message = 3
-            tokens_per_name = 1
-            num_tokens = 0
-            for message in messages:
-                num_tokens += tokens_per_message
-                for key, value in message.items():
-                    num_tokens += len(encoding.encode(str(value)))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-            num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-            return num_tokens
-
-        return await asyncio.to_thread(_count_payload)
+        cache = conversation.token_cache(tokenizer.encoding_name(model)) if conversation else None
+        size = tokenizer.payload_size(messages)
+        return await tokenizer.offload(size, tokenizer.count_payload, messages, model, cache)
 
     async def count_function_tokens(self, functions: List[dict], model: str = "gpt-4o-mini") -> int:
-        # Initialize function settings to 0
-        func_init = 0
-        prop_init = 0
-        prop_key = 0
-        enum_init = 0
-        enum_item = 0
-        func_end = 0
-
-        if model in [
-            "gpt-4o",
-            "gpt-4o-2024-05-13",
-            "gpt-4o-2024-08-06",
-            "gpt-4o-2024-11-20",
-            "gpt-4o-mini",
-            "gpt-4o-mini-2024-07-18",
-            "o1-preview",
-            "o1-preview-2024-09-12",
-            "o1",
-            "o1-2024-12-17",
-            "o1-mini",
-            "o1-mini-2024-09-12",
-        ]:
-            # Set function settings for the above models
-            func_init = 7
-            prop_init = 3
-            prop_key = 3
-            enum_init = -3
-            enum_item = 3
-            func_end = 12
-        elif model in [
-            "gpt-3.5-turbo-1106",
-            "gpt-3.5-turbo-0125",
-            "gpt-4",
-            "gpt-4-turbo",
-            "gpt-4-turbo-preview",
-            "gpt-4-0125-preview",
-            "gpt-4-1106-preview",
-        ]:
-            # Set function settings for the above models
-            func_init = 10
-            prop_init = 3
-            prop_key = 3
-            enum_init = -3
-            enum_item = 3
-            func_end = 12
-        else:
-            log.warning(f"Incompatible model: {model}")
-
-        def _count_tokens():
-            try:
-                encoding = tiktoken.encoding_for_model(model)
-            except KeyError:
-                encoding = tiktoken.get_encoding("o200k_base")
-
-            func_token_count = 0
-
-            if len(functions) > 0:
-                for f in functions:
-                    if "function" not in f.keys():
-                        f = {"function": f, "name": f["name"], "description": f["description"]}
-                    func_token_count += func_init  # Add tokens for start of each function
-                    function = f["function"]
-                    f_name = function["name"]
-                    f_desc = function["description"]
-                    if f_desc.endswith("."):
-                        f_desc = f_desc[:-1]
-                    line = f_name + ":" + f_desc
-                    func_token_count += len(encoding.encode(line))  # Add tokens for set name and description
-                    if len(function["parameters"]["properties"]) > 0:
-                        func_token_count += prop_init  # Add tokens for start of each property
-                        for key in list(function["parameters"]["properties"].keys()):
-                            func_token_count += prop_key  # Add tokens for each set property
-                            p_name = key
-                            p_type = function["parameters"]["properties"][key].get("type", "")
-                            p_desc = function["parameters"]["properties"][key].get("description", "")
-                            if "enum" in function["parameters"]["properties"][key].keys():
-                                func_token_count += enum_init  # Add tokens if property has enum list
-                                for item in function["parameters"]["properties"][key]["enum"]:
-                                    func_token_count += enum_item
-                                    func_token_count += len(encoding.encode(item))
-                            if p_desc.endswith("."):
-                                p_desc = p_desc[:-1]
-                            line = f"{p_name}:{p_type}:{p_desc}"
-                            func_token_count += len(encoding.encode(line))
-                func_token_count += func_end
-            return func_token_count
-
-        return await asyncio.to_thread(_count_tokens)
+        if not functions:
+            return 0
+        if tokenizer.functions_memoized(functions, model):
+            return tokenizer.count_functions(functions, model)
+        return await asyncio.to_thread(tokenizer.count_functions, functions, model)
 
     async def get_tokens(self, text: str, model: str = "gpt-4o-mini") -> list[int]:
         """Get token list from text"""
@@ -251,17 +194,7 @@ class API(MixinMeta):
             return []
         if isinstance(text, bytes):
             text = text.decode(encoding="utf-8")
-
-        def _get_encoding():
-            try:
-                enc = tiktoken.encoding_for_model(model)
-            except KeyError:
-                enc = tiktoken.get_encoding("o200k_base")
-            return enc
-
-        encoding = await asyncio.to_thread(_get_encoding)
-
-        return await asyncio.to_thread(encoding.encode, text)
+        return await tokenizer.offload(len(text), tokenizer.encode, text, model)
 
     async def count_tokens(self, text: str, model: str) -> int:
         if not text:
@@ -274,6 +207,13 @@ class API(MixinMeta):
             log.error(f"Failed to count tokens for: {text}", exc_info=e)
             return 0
 
+    async def count_tokens_batch(self, texts: List[str], model: str) -> List[int]:
+        """Count tokens for many strings in a single worker call"""
+        if not texts:
+            return []
+        size = sum(len(i) for i in texts)
+        return await tokenizer.offload(size, tokenizer.count_batch, texts, model)
+
     async def can_call_llm(self, conf: GuildSettings, ctx: Optional[commands.Context] = None) -> bool:
         if not conf.api_key and not self.db.endpoint_override:
             if ctx:
@@ -284,10 +224,22 @@ class API(MixinMeta):
             return False
         return True
 
-    async def resync_embeddings(self, conf: GuildSettings) -> int:
+    async def resync_embeddings(
+        self,
+        conf: GuildSettings,
+        on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    ) -> int:
         """Update embeds to match current dimensions
 
-        Takes a sample using current embed method, the updates the rest to match dimensions
+        Takes a sample using current embed method, the updates the rest to match dimensions.
+        Stale entries are re-embedded in batches by a fixed number of workers.
+
+        Args:
+            conf (GuildSettings): guild settings
+            on_progress (Optional[Callable]): awaited with (done, total) after every batch
+
+        Returns:
+            int: amount of entries updated
         """
         if not conf.embeddings:
             return 0
@@ -295,23 +247,219 @@ class API(MixinMeta):
         sample = list(conf.embeddings.values())[0]
         sample_embed = await self.request_embedding(sample.text, conf)
 
-        async def update_embedding(name: str, text: str):
-            conf.embeddings[name].embedding = await self.request_embedding(text, conf)
-            conf.embeddings[name].update()
-            conf.embeddings[name].model = conf.embed_model
-            log.debug(f"Updated embedding: {name}")
+        stale = [
+            name
+            for name, em in conf.embeddings.items()
+            if conf.embed_model != em.model or len(em.embedding) != len(sample_embed)
+        ]
+        if not stale:
+            return 0
+
+        queue: asyncio.Queue[List[str]] = asyncio.Queue()
+        for i in range(0, len(stale), RESYNC_BATCH):
+            queue.put_nowait(stale[i : i + RESYNC_BATCH])
+        # Entries checked so far and entries actually updated
+        done = synced = 0
+
+        async def worker():
+            nonlocal done, synced
+            while not queue.empty():
+                batch = queue.get_nowait()
+                names = [name for name in batch if name in conf.embeddings]
+                texts = [conf.embeddings[name].text for name in names]
+                vectors = await self.embed_batch(texts, conf)
+                for name, text, vector in zip(names, texts, vectors):
+                    em = conf.embeddings.get(name)
+                    # Skip entries that were edited or removed while the request was in flight
+                    if em is None or em.text != text:
+                        continue
+                    em.embedding = vector
+                    em.update()
+                    em.model = conf.embed_model
+                    synced += 1
+                done += len(batch)
+                if on_progress:
+                    await on_progress(done, len(stale))
+
+        workers = [asyncio.create_task(worker()) for __ in range(min(RESYNC_WORKERS, queue.qsize()))]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # One worker failing (or the resync being cancelled) stops the rest before anything is saved
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if synced:
+                await asyncio.to_thread(conf.sync_embeddings)
+                await self.save_conf()
+        return synced
 
-        synced = 0
-        tasks = []
-        for name, em in conf.embeddings.items():
-            if conf.embed_model != em.model or len(em.embedding) != len(sample_embed):
-                synced += 1
-                tasks.append(update_embedding(name, em.text))
+    async def embed_batch(self, texts: List[str], conf: GuildSettings) -> List[List[float]]:
+        """Embed a list of texts in a single request, rate limits are waited out by the request's limiter and retries"""
+        response = await request_embedding_raw(texts, conf.api_key, conf.embed_model, self.db.endpoint_override)
+        conf.update_usage(response.model, response.usage.total_tokens, response.usage.prompt_tokens, 0)
+        return [i.embedding for i in sorted(response.data, key=lambda i: i.index)]
+
+    def start_resync(self, job: ResyncJob):
+        job.task = asyncio.create_task(self.run_resync(job))
+        self.resync_jobs[job.guild_id] = job
+        job.task.add_done_callback(lambda __: self.resync_jobs.pop(job.guild_id, None))
+
+    async def run_resync(self, job: ResyncJob):
+        """Resync a guild's embeddings in the background, reporting throughput and ETA on the job's status message"""
+        guild = self.bot.get_guild(job.guild_id)
+        channel = guild.get_channel_or_thread(job.channel_id) if guild else None
+        if not channel:
+            await asyncio.to_thread(job.delete, self.import_path)
+            return
+        conf = await self.db.load_conf(guild)
+        message = channel.get_partial_message(job.message_id)
+        last_edit = monotonic()
+        last_checkpoint = monotonic()
+
+        async def on_progress(done: int, total: int):
+            nonlocal last_edit, last_checkpoint
+            job.done, job.total = done, total
+            if monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                # Persist what's been re-embedded so far so a restart only redoes the rest
+                last_checkpoint = monotonic()
+                await self.save_conf()
+            if monotonic() - last_edit > 5 and done < total:
+                last_edit = monotonic()
+                with contextlib.suppress(discord.HTTPException):
+                    await message.edit(content=self.resync_status(job))
+
+        try:
+            synced = await self.resync_embeddings(conf, on_progress)
+        except asyncio.CancelledError:
+            with contextlib.suppress(discord.HTTPException):
+                await message.edit(content=_("Embedding refresh cancelled at {}/{}").format(job.done, job.total))
+            raise
+        except Exception as e:
+            log.error(f"Embedding resync failed for {guild.name}", exc_info=e)
+            await asyncio.to_thread(job.delete, self.import_path)
+            with contextlib.suppress(discord.HTTPException):
+                await message.edit(content=_("Embedding refresh failed: {}").format(box(str(e))))
+            return
 
+        await asyncio.to_thread(job.delete, self.import_path)
         if synced:
-            await asyncio.gather(*tasks)
+            txt = _("{} embeddings have been updated").format(humanize_number(synced))
+        else:
+            txt = _("No embeddings needed to be refreshed")
+        with contextlib.suppress(discord.HTTPException):
+            await message.edit(content=txt)
+
+    def resync_status(self, job: ResyncJob) -> str:
+        eta = job.eta()
+        return _("Refreshing embeddings: `{}/{}` ({}/s, ETA: {})").format(
+            humanize_number(job.done),
+            humanize_number(job.total),
+            round(job.rate(), 1),
+            humanize_timedelta(seconds=int(eta)) if eta else _("calculating..."),
+        )
+
+    async def queue_import(self, ctx: commands.Context, files: List[str], rows: List[Row], overwrite: bool):
+        """Post a status message and start importing parsed rows in the background"""
+        message_text = _("Processing the following files in the background\n{}").format(box(humanize_list(files)))
+        message = await ctx.send(message_text)
+        job = ImportJob(ctx.guild.id, ctx.channel.id, message.id, files, overwrite, rows)
+        await asyncio.to_thread(job.save, self.import_path)
+        self.start_import(job)
+
+    def start_import(self, job: ImportJob):
+        task = asyncio.create_task(self.run_import(job))
+        self.import_tasks[job.key] = task
+        task.add_done_callback(lambda __: self.import_tasks.pop(job.key, None))
+
+    async def resume_jobs(self):
+        """Restart imports and resyncs that were interrupted by the cog unloading"""
+        imports = await asyncio.to_thread(ImportJob.load_all, self.import_path)
+        for job in imports:
+            log.info(f"Resuming embedding import for guild {job.guild_id}")
+            self.start_import(job)
+        resyncs = await asyncio.to_thread(ResyncJob.load_all, self.import_path)
+        for job in resyncs:
+            log.info(f"Resuming embedding resync for guild {job.guild_id}")
+            self.start_resync(job)
+
+    async def run_import(self, job: ImportJob):
+        """Embed and add the rows of an import job in chunks
+
+        Each chunk's requests run concurrently and get merged into batched calls by the embedding batcher.
+        Progress is shown by editing the job's status message and saved every `CHECKPOINT_INTERVAL` seconds,
+        so a resumed import only embeds the rows that weren't saved yet.
+        """
+        guild = self.bot.get_guild(job.guild_id)
+        channel = guild.get_channel_or_thread(job.channel_id) if guild else None
+        if not channel:
+            await asyncio.to_thread(job.delete, self.import_path)
+            return
+        conf = await self.db.load_conf(guild)
+        message = channel.get_partial_message(job.message_id)
+        message_text = _("Processing the following files in the background\n{}").format(box(humanize_list(job.files)))
+
+        rows = await asyncio.to_thread(pending_rows, job.rows, conf.embeddings, job.overwrite)
+        total = len(rows)
+        imported = 0
+        failed = []
+        last_edit = 0.0
+        last_checkpoint = monotonic()
+        unsaved = 0
+        start = perf_counter()
+        for i in range(0, total, IMPORT_CHUNK):
+            chunk = rows[i : i + IMPORT_CHUNK]
+            # Identical texts only need embedding once
+            texts = list(dict.fromkeys(row[1] for row in chunk))
+            results = await asyncio.gather(
+                *(self.request_embedding(text, conf) for text in texts), return_exceptions=True
+            )
+            vectors = dict(zip(texts, results))
+            for row in chunk:
+                vector = vectors[row[1]]
+                if isinstance(vector, Exception) or not vector:
+                    if isinstance(vector, Exception):
+                        log.error(f"Failed to embed {row[0]} during import", exc_info=vector)
+                    failed.append(row[0])
+                    continue
+                conf.embeddings[row[0]] = make_embedding(row, vector, conf.embed_model)
+                imported += 1
+                unsaved += 1
+
+            if unsaved and monotonic() - last_checkpoint > CHECKPOINT_INTERVAL:
+                last_checkpoint = monotonic()
+                unsaved = 0
+                await asyncio.to_thread(conf.sync_embeddings)
+                await self.save_conf()
+
+            done = min(i + IMPORT_CHUNK, total)
+            if perf_counter() - last_edit > 5 and done < total:
+                last_edit = perf_counter()
+                with contextlib.suppress(discord.HTTPException):
+                    await message.edit(
+                        content=_("{}\n`Progress: `{}/{} ({} failed)").format(
+                            message_text, humanize_number(done), humanize_number(total), len(failed)
+                        )
+                    )
+
+        if unsaved:
+            await asyncio.to_thread(conf.sync_embeddings)
             await self.save_conf()
-        return synced
+        await asyncio.to_thread(job.delete, self.import_path)
+        log.info(f"Imported {imported}/{total} embeddings for {guild.name} in {round(perf_counter() - start, 1)}s")
+
+        with contextlib.suppress(discord.HTTPException):
+            await message.edit(content=_("{}\n**COMPLETE**").format(message_text))
+        if not total:
+            txt = _("No embeddings needed to be updated!")
+        else:
+            txt = _("Successfully imported {} embeddings!").format(humanize_number(imported))
+        if failed:
+            txt += "\n" + _("Failed to process {} entries: {}").format(
+                len(failed), box(humanize_list(failed[:20]) + ("..." if len(failed) > 20 else ""))
+            )
+        with contextlib.suppress(discord.HTTPException):
+            await channel.send(txt)
 
     def get_max_tokens(self, conf: GuildSettings, user: Optional[discord.Member]) -> int:
         user_max = conf.get_user_max_tokens(user)
@@ -326,17 +474,8 @@ class API(MixinMeta):
 
     async def get_text(self, tokens: list, model: str = "gpt-4o-mini") -> str:
         """Get text from token list"""
-
-        def _get_encoding():
-            try:
-                enc = tiktoken.encoding_for_model(model)
-            except KeyError:
-                enc = tiktoken.get_encoding("o200k_base")
-            return enc
-
-        encoding = await asyncio.to_thread(_get_encoding)
-
-        return await asyncio.to_thread(encoding.decode, tokens)
+        # Roughly 4 characters per token
+        return await tokenizer.offload(len(tokens) * 4, tokenizer.decode, tokens, model)
 
     # -------------------------------------------------------
     # -------------------------------------------------------
@@ -349,9 +488,10 @@ class API(MixinMeta):
         function_list: List[dict],
         conf: GuildSettings,
         user: Optional[discord.Member],
+        conversation: Optional[Conversation] = None,
     ) -> bool:
         """
-        Iteratively degrade a conversation payload in-place to fit within the max token limit, prioritizing more recent messages and critical context.
+        Degrade a conversation payload in-place to fit within the max token limit, prioritizing more recent messages and critical context.
 
         Order of importance:
         - System messages
@@ -366,6 +506,7 @@ class API(MixinMeta):
             messages (List[dict]): message entries sent to the api
             function_list (List[dict]): list of json function schemas for the model
             conf: (GuildSettings): current settings
+            conversation (Optional[Conversation]): conversation the messages belong to, for its token cache
 
         Returns:
             bool: whether the conversation was degraded
@@ -374,8 +515,12 @@ class API(MixinMeta):
         model = conf.get_user_model(user)
         # Fetch the max token limit for the current user
         max_tokens = min(self.get_max_tokens(conf, user), MODELS[model] - 96)
-        # Token count of current conversation
-        convo_tokens = await self.count_payload_tokens(messages, model)
+        # Token cost of each message, counted once and reused for planning
+        cache = conversation.token_cache(tokenizer.encoding_name(model)) if conversation else None
+        costs = await tokenizer.offload(
+            tokenizer.payload_size(messages), tokenizer.count_messages, messages, model, cache
+        )
+        convo_tokens = sum(costs) + 3 if messages else 0
         # Token count of function calls available to model
         function_tokens = await self.count_function_tokens(function_list, model)
 
@@ -387,66 +532,42 @@ class API(MixinMeta):
 
         log.debug(f"Degrading messages for {user} (total: {total_tokens}/max: {max_tokens})")
 
-        def count(role: str):
-            return sum(1 for msg in messages if msg["role"] == role)
+        # Indexes of each removable role, oldest first
+        queues: Dict[str, List[int]] = {"tool": [], "function": [], "assistant": [], "user": []}
+        for idx, msg in enumerate(messages):
+            if msg["role"] in queues:
+                queues[msg["role"]].append(idx)
+        cursors = {role: 0 for role in queues}
 
-        async def pop(role: str) -> int:
-            for idx, msg in enumerate(messages):
-                if msg["role"] != role:
-                    continue
-                removed = messages.pop(idx)
-                reduction = 4
-                if "name" in removed:
-                    reduction += 1
-                if content := removed.get("content"):
-                    reduction += await self.count_tokens(content, model)
-                elif tool_calls := removed.get("tool_calls"):
-                    reduction += await self.count_tokens(str(tool_calls), model)
-                elif function_call := removed.get("function_call"):
-                    reduction += await self.count_tokens(str(function_call), model)
-                return reduction
-            return 0
+        def remaining(role: str) -> int:
+            return len(queues[role]) - cursors[role]
 
         # We will NOT remove the most recent user message or assistant message
         # We will also not touch system messages
         # We will also not touch function calls available to model (yet)
-        iters = 0
-        while True:
-            iters += 1
-            break_conditions = [
-                count("user") <= 1,
-                count("assistant") <= 1,
-                iters > 100,
-            ]
-            if any(break_conditions):
-                break
-            # First we will iterate through the messages and remove in the following sweep order:
-            # 1. Remove oldest tool call or response
-            reduced = await pop("tool")
-            if reduced:
-                total_tokens -= reduced
-                if total_tokens <= max_tokens:
-                    break
-            reduced = await pop("function")
-            if reduced:
-                total_tokens -= reduced
-                if total_tokens <= max_tokens:
-                    break
-            # 2. Remove oldest assistant message
-            reduced = await pop("assistant")
-            if reduced:
-                total_tokens -= reduced
-                if total_tokens <= max_tokens:
-                    break
-            # 3. Remove oldest user message
-            reduced = await pop("user")
-            if reduced:
-                total_tokens -= reduced
+        # Each sweep removes the oldest tool call/response, function response, assistant message and user message
+        # in that order, stopping as soon as we're under the limit
+        to_remove = set()
+        done = False
+        while not done and remaining("user") > 1 and remaining("assistant") > 1:
+            for role in ("tool", "function", "assistant", "user"):
+                if not remaining(role):
+                    continue
+                idx = queues[role][cursors[role]]
+                cursors[role] += 1
+                to_remove.add(idx)
+                total_tokens -= costs[idx]
                 if total_tokens <= max_tokens:
+                    done = True
                     break
-            # Then we will repeat the process until we are under the max token limit
 
-        log.debug(f"Convo degradation finished for {user} (total: {total_tokens}/max: {max_tokens})")
+        if to_remove:
+            messages[:] = [msg for idx, msg in enumerate(messages) if idx not in to_remove]
+        saved = convo_tokens + function_tokens - total_tokens
+        log.debug(
+            f"Convo degradation finished for {user}, removed {len(to_remove)} messages "
+            f"saving {saved} tokens (total: {total_tokens}/max: {max_tokens})"
+        )
         return True
 
     async def token_pagify(self, text: str, conf: GuildSettings) -> List[str]:
@@ -500,7 +621,7 @@ class API(MixinMeta):
                     "permission_level": data["permission_level"],
                 }
 
-        conf = self.db.get_conf(user.guild)
+        conf = await self.db.load_conf(user.guild)
         model = conf.get_user_model(user)
 
         pages = sum(len(v) for v in registry.values())
@@ -574,9 +695,9 @@ class API(MixinMeta):
             embed = discord.Embed(title=_("Embeddings"), color=discord.Color.blue())
             embed.set_footer(text=_("Page {}/{}").format(page + 1, pages))
             num = 0
-            for i in range(start, stop):
+            token_counts = await self.count_tokens_batch([em.text for __, em in embeddings[start:stop]], model)
+            for i, tokens in zip(range(start, stop), token_counts):
                 name, embedding = embeddings[i]
-                tokens = await self.count_tokens(embedding.text, model)
                 text = (
                     box(f"{embedding.text[:30].strip()}...")
                     if len(embedding.text) > 33
@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import msgpack
+import numpy as np
+
+log = logging.getLogger("red.vrt.assistant.cache")
+
+# Cached query embeddings expire after a week
+EMBEDDING_TTL = 7 * 24 * 60 * 60
+# Cached replies kept per guild, the least recently used fingerprint's oldest replies are dropped first
+MAX_RESPONSES = 256
+
+
+class EmbeddingCache:
+    """LRU/TTL cache of query embeddings, shared by every guild using the same model and endpoint
+
+    Entries are keyed by `(endpoint, model, sha256(text))` and stored as float32 arrays,
+    the least recently used ones are evicted once the vectors outgrow `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int = EMBEDDING_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # {key: (vector, created)}
+        self.entries: OrderedDict[Tuple[str, str, bytes], Tuple[np.ndarray, float]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+    @staticmethod
+    def key(text: str, model: str, endpoint: Optional[str] = None) -> Tuple[str, str, bytes]:
+        return (endpoint or "", model, hashlib.sha256(text.encode()).digest())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, text: str, model: str, endpoint: Optional[str] = None) -> Optional[List[float]]:
+        key = self.key(text, model, endpoint)
+        entry = self.entries.get(key)
+        if entry is not None and time() - entry[1] > self.ttl:
+            self._pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0].tolist()
+
+    def put(self, text: str, model: str, embedding: List[float], endpoint: Optional[str] = None):
+        if not self.max_bytes or not embedding:
+            return
+        key = self.key(text, model, endpoint)
+        self._pop(key)
+        vector = np.asarray(embedding, dtype=np.float32)
+        self.entries[key] = (vector, time())
+        self.nbytes += vector.nbytes
+        self.dirty = True
+        self.trim()
+
+    def resize(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.trim()
+
+    def trim(self):
+        while self.entries and self.nbytes > self.max_bytes:
+            __, (vector, __) = self.entries.popitem(last=False)
+            self.nbytes -= vector.nbytes
+            self.dirty = True
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = True
+
+    def _pop(self, key: Tuple[str, str, bytes]):
+        if entry := self.entries.pop(key, None):
+            self.nbytes -= entry[0].nbytes
+            self.dirty = True
+
+    def save(self, path: Path):
+        """Write the cache to disk, expired entries are left out"""
+        now = time()
+        entries = [
+            (endpoint, model, digest, vector.tobytes(), created)
+            for (endpoint, model, digest), (vector, created) in self.entries.items()
+            if now - created <= self.ttl
+        ]
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(msgpack.packb(entries))
+        os.replace(tmp, path)
+        self.dirty = False
+
+    def load(self, path: Path):
+        if not path.exists():
+            return
+        try:
+            entries = msgpack.unpackb(path.read_bytes())
+        except Exception as e:
+            log.error("Failed to load the embedding cache, starting empty", exc_info=e)
+            return
+        now = time()
+        for endpoint, model, digest, raw, created in entries:
+            if now - created > self.ttl:
+                continue
+            vector = np.frombuffer(raw, dtype=np.float32)
+            self.entries[(endpoint, model, digest)] = (vector, created)
+            self.nbytes += vector.nbytes
+        self.trim()
+        self.dirty = False
+        log.debug(f"Loaded {len(self.entries)} cached embeddings")
+
+
+class ResponseBucket:
+    """Cached replies sharing one fingerprint"""
+
+    def __init__(self):
+        self.replies: List[str] = []
+        self.created: List[float] = []
+        # Unit length query vectors, stacked into a matrix on first lookup after a change
+        self.vectors: List[np.ndarray] = []
+        self.matrix: Optional[np.ndarray] = None
+
+    def drop(self, count: int):
+        del self.replies[:count]
+        del self.created[:count]
+        del self.vectors[:count]
+        self.matrix = None
+
+
+class ResponseCache:
+    """Replies to questions asked without any conversation history, matched by query embedding similarity
+
+    Entries are grouped by guild and a fingerprint of whatever shapes a reply (model, formatted prompts, embeddings),
+    so channels with different prompts or users with different models keep their own replies side by side.
+    Each guild keeps up to `max_entries` replies, taken from its least recently used fingerprint first.
+    """
+
+    def __init__(self, max_entries: int = MAX_RESPONSES):
+        self.max_entries = max_entries
+        # {guild_id: {fingerprint: bucket}} with the least recently used fingerprint first
+        self.guilds: Dict[int, "OrderedDict[int, ResponseBucket]"] = {}
+
+    def get(
+        self,
+        guild_id: int,
+        fingerprint: int,
+        embedding: List[float],
+        threshold: float,
+        ttl: int,
+    ) -> Optional[str]:
+        buckets = self.guilds.get(guild_id)
+        entries = buckets.get(fingerprint) if buckets else None
+        if entries is None:
+            return None
+        buckets.move_to_end(fingerprint)
+        # Entries are in insertion order, so expired ones are always at the front
+        cutoff = time() - ttl
+        expired = 0
+        while expired < len(entries.created) and entries.created[expired] < cutoff:
+            expired += 1
+        if expired:
+            entries.drop(expired)
+        if not entries.replies:
+            self._forget(guild_id, fingerprint)
+            return None
+        query = self._normalize(embedding)
+        if query is None or entries.vectors[0].shape != query.shape:
+            return None
+        if entries.matrix is None:
+            entries.matrix = np.vstack(entries.vectors)
+        scores = entries.matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None
+        return entries.replies[best]
+
+    def put(self, guild_id: int, fingerprint: int, embedding: List[float], reply: str):
+        query = self._normalize(embedding)
+        if query is None or not reply:
+            return
+        buckets = self.guilds.setdefault(guild_id, OrderedDict())
+        entries = buckets.get(fingerprint)
+        if entries is None:
+            entries = buckets[fingerprint] = ResponseBucket()
+        buckets.move_to_end(fingerprint)
+        entries.replies.append(reply)
+        entries.created.append(time())
+        entries.vectors.append(query)
+        entries.matrix = None
+
+        total = sum(len(i.replies) for i in buckets.values())
+        while total > self.max_entries:
+            oldest_fingerprint, oldest = next(iter(buckets.items()))
+            count = min(total - self.max_entries, len(oldest.replies))
+            oldest.drop(count)
+            total -= count
+            if not oldest.replies:
+                del buckets[oldest_fingerprint]
+
+    def clear(self, guild_id: int):
+        self.guilds.pop(guild_id, None)
+
+    def _forget(self, guild_id: int, fingerprint: int):
+        buckets = self.guilds.get(guild_id)
+        if buckets is None:
+            return
+        buckets.pop(fingerprint, None)
+        if not buckets:
+            del self.guilds[guild_id]
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not vector.size or not norm:
+            return None
+        return vector / norm
@@ -1,52 +1,150 @@
+import asyncio
 import logging
 import typing as t
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import httpx
 import openai
 from openai.types import CreateEmbeddingResponse, Image, ImagesResponse
-from openai.types.chat import ChatCompletion
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage, FunctionCall
+from openai.types.chat.chat_completion_message_tool_call import ChatCompletionMessageToolCall, Function
 from pydantic import BaseModel
 from sentry_sdk import add_breadcrumb
 from tenacity import (
     retry,
+    retry_if_exception,
     retry_if_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
 
 from .constants import NO_DEVELOPER_ROLE, PRICES, SUPPORTS_SEED, SUPPORTS_TOOLS
+from .ratelimit import RateLimiter, get_limiter
 
 log = logging.getLogger("red.vrt.assistant.calls")
 
+# Default connection pool limits for every client, overridden from the DB on load
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+# Seconds an idle connection is kept open for reuse
+KEEPALIVE_EXPIRY = 60
+# Seconds a client replaced by new pool limits stays open for requests already using it
+RETIRE_DELAY = 600
 
-@retry(
-    retry=retry_if_exception_type(
-        t.Union[
-            httpx.TimeoutException,
-            httpx.ReadTimeout,
-            openai.InternalServerError,
-        ]
-    ),
-    wait=wait_random_exponential(min=1, max=30),
-    stop=stop_after_attempt(5),
-    reraise=True,
+# {(api_key, base_url): client}
+_clients: Dict[Tuple[str, Optional[str]], openai.AsyncOpenAI] = {}
+_limits = httpx.Limits(
+    max_connections=MAX_CONNECTIONS,
+    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=KEEPALIVE_EXPIRY,
 )
-async def request_chat_completion_raw(
+# Replaced clients waiting to be closed
+_retired: t.Set[openai.AsyncOpenAI] = set()
+
+
+def get_client(api_key: str, base_url: Optional[str] = None) -> openai.AsyncOpenAI:
+    """Get a pooled client for an api key and endpoint, creating it on first use
+
+    Clients are reused so consecutive requests share connections (and TLS sessions) instead of
+    setting up a new pool every call.
+    """
+    key = (api_key, base_url)
+    client = _clients.get(key)
+    if client is None or client.is_closed():
+        http_client = openai.DefaultAsyncHttpxClient(limits=_limits)
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        _clients[key] = client
+    return client
+
+
+def set_pool_limits(max_connections: int, max_keepalive_connections: int, keepalive_expiry: float) -> None:
+    """Change the connection pool limits, existing clients are replaced on next use and closed once idle"""
+    global _limits
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    if limits == _limits:
+        return
+    _limits = limits
+    for client in _clients.values():
+        _retired.add(client)
+        asyncio.create_task(_retire(client))
+    _clients.clear()
+
+
+async def _retire(client: openai.AsyncOpenAI):
+    await asyncio.sleep(RETIRE_DELAY)
+    if client not in _retired:
+        # Already closed by close_clients
+        return
+    _retired.discard(client)
+    try:
+        await client.close()
+    except Exception as e:
+        log.warning("Failed to close retired client", exc_info=e)
+
+
+def pool_limits() -> httpx.Limits:
+    return _limits
+
+
+async def close_clients() -> None:
+    """Close every pooled client, called when the cog unloads"""
+    clients = list(_clients.values()) + list(_retired)
+    _clients.clear()
+    _retired.clear()
+    batchers = list(_batchers.values())
+    _batchers.clear()
+    # Batches still waiting or in flight would otherwise leave their callers hanging on requests that never finish
+    for batcher in batchers:
+        await batcher.close()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as e:
+            log.warning("Failed to close client", exc_info=e)
+    if clients:
+        log.debug(f"Closed {len(clients)} pooled client(s)")
+
+
+def should_retry(error: BaseException) -> bool:
+    """Timeouts, server errors and rate limits are retried, running out of quota isn't"""
+    if isinstance(error, openai.RateLimitError):
+        return error.code != "insufficient_quota"
+    return isinstance(error, (httpx.TimeoutException, openai.InternalServerError))
+
+
+async def limited_create(limiter: RateLimiter, tokens: int, create: t.Callable[..., t.Awaitable], **kwargs):
+    """Call an endpoint through its `with_raw_response` variant once the limiter has room
+
+    The response headers keep the limiter's budgets in sync, a 429 holds everyone queued on the same limiter.
+    """
+    await limiter.acquire(tokens)
+    try:
+        raw = await create(**kwargs)
+    except openai.RateLimitError as e:
+        limiter.penalize(e)
+        raise
+    limiter.update(raw.headers)
+    return raw.parse()
+
+
+def _chat_kwargs(
     model: str,
     messages: List[dict],
     temperature: float,
-    api_key: str,
     max_tokens: int,
-    functions: Optional[List[dict]] = None,
-    frequency_penalty: float = 0.0,
-    presence_penalty: float = 0.0,
-    seed: int = None,
-    base_url: Optional[str] = None,
-    reasoning_effort: Optional[str] = None,
-) -> ChatCompletion:
-    client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
-
+    functions: Optional[List[dict]],
+    frequency_penalty: float,
+    presence_penalty: float,
+    seed: Optional[int],
+    base_url: Optional[str],
+    reasoning_effort: Optional[str],
+) -> dict:
     kwargs = {"model": model, "messages": messages}
 
     if model in PRICES and base_url is None:
@@ -75,6 +173,47 @@ async def request_chat_completion_raw(
                     kwargs["tools"] = tools
             else:
                 kwargs["functions"] = functions
+    return kwargs
+
+
+@retry(
+    retry=retry_if_exception(should_retry),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def request_chat_completion_raw(
+    model: str,
+    messages: List[dict],
+    temperature: float,
+    api_key: str,
+    max_tokens: int,
+    functions: Optional[List[dict]] = None,
+    frequency_penalty: float = 0.0,
+    presence_penalty: float = 0.0,
+    seed: int = None,
+    base_url: Optional[str] = None,
+    reasoning_effort: Optional[str] = None,
+    tokens: int = 0,
+) -> ChatCompletion:
+    """Request a chat completion
+
+    Args:
+        tokens (int): estimated tokens the request will use, counted against the key's per minute token budget
+    """
+    client = get_client(api_key, base_url)
+    kwargs = _chat_kwargs(
+        model,
+        messages,
+        temperature,
+        max_tokens,
+        functions,
+        frequency_penalty,
+        presence_penalty,
+        seed,
+        base_url,
+        reasoning_effort,
+    )
 
     add_breadcrumb(
         category="api",
@@ -82,42 +221,296 @@ async def request_chat_completion_raw(
         level="info",
         data=kwargs,
     )
-    response: ChatCompletion = await client.chat.completions.create(**kwargs)
+    limiter = get_limiter(api_key, base_url, model)
+    response: ChatCompletion = await limited_create(
+        limiter, tokens, client.chat.completions.with_raw_response.create, **kwargs
+    )
 
     log.debug(f"request_chat_completion_raw: {model} -> {response.model}")
     return response
 
 
 @retry(
-    retry=retry_if_exception_type(
-        t.Union[
-            httpx.TimeoutException,
-            httpx.ReadTimeout,
-            openai.InternalServerError,
+    retry=retry_if_exception(should_retry),
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def stream_chat_completion_raw(
+    model: str,
+    messages: List[dict],
+    temperature: float,
+    api_key: str,
+    max_tokens: int,
+    on_content: t.Callable[[str], t.Awaitable[None]],
+    functions: Optional[List[dict]] = None,
+    frequency_penalty: float = 0.0,
+    presence_penalty: float = 0.0,
+    seed: int = None,
+    base_url: Optional[str] = None,
+    reasoning_effort: Optional[str] = None,
+    tokens: int = 0,
+) -> ChatCompletion:
+    """Same as request_chat_completion_raw but streams the response
+
+    Args:
+        on_content (Callable): awaited with the full content received so far every time more arrives.
+            A retry starts the content over so the callback always sees a coherent reply.
+
+    Returns:
+        ChatCompletion: the chunks assembled into a regular completion, tool call deltas included.
+        `usage` is None if the endpoint doesn't report it for streams.
+    """
+    client = get_client(api_key, base_url)
+    kwargs = _chat_kwargs(
+        model,
+        messages,
+        temperature,
+        max_tokens,
+        functions,
+        frequency_penalty,
+        presence_penalty,
+        seed,
+        base_url,
+        reasoning_effort,
+    )
+    kwargs["stream"] = True
+    if base_url is None:
+        kwargs["stream_options"] = {"include_usage": True}
+
+    add_breadcrumb(
+        category="api",
+        message=f"Calling stream_chat_completion_raw: {model}",
+        level="info",
+        data=kwargs,
+    )
+    limiter = get_limiter(api_key, base_url, model)
+    stream: t.AsyncIterator[ChatCompletionChunk] = await limited_create(
+        limiter, tokens, client.chat.completions.with_raw_response.create, **kwargs
+    )
+
+    response_id, created, response_model = "", 0, model
+    content = ""
+    finish_reason = "stop"
+    usage = None
+    # {index: {"id": str, "name": str, "arguments": str}}
+    tool_calls: Dict[int, dict] = {}
+    function_call: Optional[dict] = None
+    async for chunk in stream:
+        response_id, created, response_model = chunk.id, chunk.created, chunk.model
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+        delta = choice.delta
+        if delta.tool_calls:
+            for call in delta.tool_calls:
+                entry = tool_calls.setdefault(call.index, {"id": "", "name": "", "arguments": ""})
+                if call.id:
+                    entry["id"] = call.id
+                if call.function and call.function.name:
+                    entry["name"] += call.function.name
+                if call.function and call.function.arguments:
+                    entry["arguments"] += call.function.arguments
+        if delta.function_call:
+            if function_call is None:
+                function_call = {"name": "", "arguments": ""}
+            function_call["name"] += delta.function_call.name or ""
+            function_call["arguments"] += delta.function_call.arguments or ""
+        if delta.content:
+            content += delta.content
+            await on_content(content)
+
+    message = ChatCompletionMessage(
+        role="assistant",
+        content=content or None,
+        tool_calls=[
+            ChatCompletionMessageToolCall(
+                id=entry["id"],
+                type="function",
+                function=Function(name=entry["name"], arguments=entry["arguments"]),
+            )
+            for __, entry in sorted(tool_calls.items())
         ]
-    ),
+        or None,
+        function_call=FunctionCall(**function_call) if function_call else None,
+    )
+    response = ChatCompletion(
+        id=response_id,
+        object="chat.completion",
+        created=created,
+        model=response_model,
+        choices=[Choice(index=0, finish_reason=finish_reason, message=message)],
+        usage=usage,
+    )
+    log.debug(f"stream_chat_completion_raw: {model} -> {response.model}")
+    return response
+
+
+@retry(
+    retry=retry_if_exception(should_retry),
     wait=wait_random_exponential(min=5, max=30),
     stop=stop_after_attempt(5),
     reraise=True,
 )
 async def request_embedding_raw(
-    text: str,
+    text: t.Union[str, List[str]],
     api_key: str,
     model: str,
     base_url: Optional[str] = None,
 ) -> CreateEmbeddingResponse:
-    client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+    client = get_client(api_key, base_url)
+    texts = [text] if isinstance(text, str) else text
+    # Roughly 4 characters per token, close enough for budgeting
+    tokens = sum(len(i) for i in texts) // 4 + 1
     add_breadcrumb(
         category="api",
         message="Calling request_embedding_raw",
         level="info",
         data={"text": text},
     )
-    response: CreateEmbeddingResponse = await client.embeddings.create(input=text, model=model)
+    limiter = get_limiter(api_key, base_url, model)
+    response: CreateEmbeddingResponse = await limited_create(
+        limiter, tokens, client.embeddings.with_raw_response.create, input=text, model=model
+    )
     log.debug(f"request_embedding_raw: {model} -> {response.model}")
     return response
 
 
+class EmbeddingBatcher:
+    """Gathers concurrent embedding requests for the same key/model/endpoint into batched calls
+
+    A batch is sent once `max_wait` seconds passed since its first request, or as soon as it
+    reaches `max_batch` inputs or `max_chars` characters.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        base_url: Optional[str] = None,
+        max_batch: int = 64,
+        max_wait: float = 0.01,
+        max_chars: int = 400_000,
+    ):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_chars = max_chars
+
+        self.pending: List[Tuple[str, asyncio.Future]] = []
+        self.pending_chars = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks: t.Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> Tuple[List[float], int, str]:
+        """Queue a text for embedding
+
+        Returns:
+            Tuple[List[float], int, str]: the embedding, this text's share of the batch's tokens and the model used
+        """
+        loop = asyncio.get_running_loop()
+        if self.pending and self.pending_chars + len(text) > self.max_chars:
+            self.dispatch()
+        future = loop.create_future()
+        self.pending.append((text, future))
+        self.pending_chars += len(text)
+        if len(self.pending) >= self.max_batch:
+            self.dispatch()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.dispatch)
+        return await future
+
+    def dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending, self.pending_chars = self.pending, [], 0
+        task = asyncio.create_task(self._send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, __ in batch]
+        try:
+            response = await request_embedding_raw(texts, self.api_key, self.model, self.base_url)
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("Embedding batcher was closed"))
+            raise
+        except openai.BadRequestError as e:
+            if len(batch) == 1:
+                self._fail(batch, e)
+                return
+            # One bad input shouldn't fail everyone else's request
+            log.debug(f"Batched embedding request failed, retrying {len(batch)} inputs individually")
+            await asyncio.gather(*(self._send([item]) for item in batch))
+            return
+        except Exception as e:
+            self._fail(batch, e)
+            return
+
+        if len(batch) > 1:
+            log.debug(f"Embedded {len(batch)} inputs in one request")
+        # Usage is only reported for the whole batch, split it by input length
+        total_tokens = response.usage.total_tokens
+        total_chars = sum(len(text) for text in texts) or 1
+        remaining = total_tokens
+        for data in sorted(response.data, key=lambda i: i.index):
+            if not 0 <= data.index < len(batch):
+                continue
+            text, future = batch[data.index]
+            if data.index == len(batch) - 1:
+                tokens = remaining
+            else:
+                tokens = round(total_tokens * len(text) / total_chars)
+                remaining -= tokens
+            if not future.done():
+                future.set_result((data.embedding, tokens, response.model))
+
+        # Some endpoints return fewer embeddings than inputs, don't leave those callers waiting forever
+        missing = [item for item in batch if not item[1].done()]
+        if missing:
+            log.warning(f"Embedding response was missing {len(missing)} of {len(batch)} inputs")
+            self._fail(missing, ValueError("No embedding was returned for this input"))
+
+    async def close(self):
+        """Fail every request that hasn't been answered yet, queued or in flight"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending, self.pending_chars = self.pending, [], 0
+        self._fail(batch, RuntimeError("Embedding batcher was closed"))
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def _fail(batch: List[Tuple[str, asyncio.Future]], error: Exception):
+        for __, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+# {(api_key, model, base_url): batcher}
+_batchers: Dict[Tuple[str, str, Optional[str]], EmbeddingBatcher] = {}
+
+
+def get_embedding_batcher(api_key: str, model: str, base_url: Optional[str] = None) -> EmbeddingBatcher:
+    key = (api_key, model, base_url)
+    if key not in _batchers:
+        _batchers[key] = EmbeddingBatcher(api_key, model, base_url)
+    return _batchers[key]
+
+
 @retry(
     retry=retry_if_exception_type(
         t.Union[
@@ -138,7 +531,7 @@ async def request_image_raw(
     style: t.Literal["natural", "vivid"] = "vivid",
     base_url: Optional[str] = None,
 ) -> Image:
-    client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+    client = get_client(api_key, base_url)
     response: ImagesResponse = await client.images.generate(
         model="dall-e-3",
         prompt=prompt,
@@ -161,7 +554,7 @@ async def create_memory_call(
     api_key: str,
     base_url: Optional[str] = None,
 ) -> t.Union[CreateMemoryResponse, None]:
-    client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+    client = get_client(api_key, base_url)
     response = await client.beta.chat.completions.parse(
         model="gpt-4o-2024-11-20",
         messages=messages,
@@ -2,13 +2,13 @@ import asyncio
 import functools
 import json
 import logging
-import multiprocessing as mp
 import re
 import traceback
 from datetime import datetime
 from inspect import iscoroutinefunction
 from io import BytesIO
-from typing import Callable, Dict, List, Optional, Union
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 import discord
 import httpx
@@ -23,13 +23,17 @@ from openai.types.chat.chat_completion_message_tool_call import (
 )
 from redbot.core import bank
 from redbot.core.i18n import Translator, cog_i18n
-from redbot.core.utils.chat_formatting import box, humanize_number, pagify, text_to_file
+from redbot.core.utils.chat_formatting import box, humanize_number, text_to_file
 from sentry_sdk import add_breadcrumb
 
 from ..abc import MixinMeta
+from . import tokenizer
+from .coalesce import payload_key
 from .constants import READ_EXTENSIONS, SUPPORTS_VISION
 from .models import Conversation, GuildSettings
+from .streaming import StreamedReply, reply_pages
 from .utils import (
+    TIME_PARAMS,
     clean_name,
     clean_response,
     clean_responses,
@@ -48,6 +52,26 @@ log = logging.getLogger("red.vrt.assistant.chathandler")
 _ = Translator("Assistant", __file__)
 
 
+def function_call_name(function_call: Union[ChatCompletionMessageToolCall, FunctionCall]) -> str:
+    if isinstance(function_call, ChatCompletionMessageToolCall):
+        return function_call.function.name
+    return function_call.name
+
+
+def function_call_error(
+    function_call: Union[ChatCompletionMessageToolCall, FunctionCall], error: BaseException
+) -> Tuple[str, dict, bool, bool]:
+    """Same result shape as ChatHandler._call_function for a call that raised, so its call id still gets answered"""
+    function_name = function_call_name(function_call)
+    log.error(f"Handling function call {function_name} failed", exc_info=error)
+    content = f"{type(error).__name__}: {error}"
+    if isinstance(function_call, ChatCompletionMessageToolCall):
+        entry = {"role": "tool", "name": function_name, "content": content, "tool_call_id": function_call.id}
+    else:
+        entry = {"role": "function", "name": function_name, "content": content}
+    return function_name, entry, True, False
+
+
 @cog_i18n(_)
 class ChatHandler(MixinMeta):
     async def handle_message(
@@ -143,6 +167,17 @@ class ChatHandler(MixinMeta):
                 if include:
                     question = f"# {ref.author.name} SAID:\n{ref.content}\n\n" f"# REPLY\n{question}"
 
+        # Streamed replies can't be post-processed into files
+        streamer = None
+        if conf.stream_responses and not outputfile and not extract:
+            transform = None
+            if conf.regex_blacklist:
+                transform = functools.partial(self.filter_streamed_text, message.guild, conf)
+            # A pattern with no longest match could still grow over anything already shown
+            patterns = self.regex_engine.get(message.guild.id, conf.regex_blacklist)
+            if all(i.width is not None for i in patterns):
+                streamer = StreamedReply(message, conf.mention, transform=transform)
+
         if get_last_message:
             reply = conversation.messages[-1]["content"] if conversation.messages else _("No message history!")
         else:
@@ -155,6 +190,7 @@ class ChatHandler(MixinMeta):
                     conf,
                     message_obj=message,
                     images=images,
+                    streamer=streamer,
                 )
             except openai.InternalServerError as e:
                 if e.body and isinstance(e.body, dict):
@@ -191,6 +227,9 @@ class ChatHandler(MixinMeta):
         if reply is None:
             return
 
+        if streamer and streamer.started:
+            return await streamer.finish(reply)
+
         files = None
         to_send = []
         if outputfile and not extract:
@@ -239,6 +278,7 @@ class ChatHandler(MixinMeta):
         extend_function_calls: bool = True,
         message_obj: Optional[discord.Message] = None,
         images: list[str] = None,
+        streamer: Optional[StreamedReply] = None,
     ) -> Union[str, None]:
         """Call the API asynchronously"""
         functions = function_calls.copy() if function_calls else []
@@ -278,6 +318,7 @@ class ChatHandler(MixinMeta):
                 mapping,
                 message_obj,
                 images,
+                streamer,
             )
         finally:
             conversation.cleanup(conf, author)
@@ -295,6 +336,7 @@ class ChatHandler(MixinMeta):
         function_map: Dict[str, Callable],
         message_obj: Optional[discord.Message] = None,
         images: list[str] = None,
+        streamer: Optional[StreamedReply] = None,
     ) -> Union[str, None]:
         if isinstance(author, int):
             author = guild.get_member(author)
@@ -308,34 +350,78 @@ class ChatHandler(MixinMeta):
         # Ensure the message is not longer than 1048576 characters
         message = message[:1048576]
 
-        # Determine if we should embed the user's message
-        message_tokens = await self.count_tokens(message, model)
-        words = message.split(" ")
-        get_embed_conditions = [
-            conf.embeddings,  # We actually have embeddings to compare with
-            len(words) > 1,  # Message is long enough
-            conf.top_n,  # Top n is greater than 0
-            message_tokens < 8191,
-        ]
-        if all(get_embed_conditions):
-            if conf.question_mode:
-                # If question mode is enabled, only the first message and messages that end with a ? will be embedded
-                if message.endswith("?") or not conversation.messages:
+        # Pre-flight work doesn't depend on each other until the prompt is assembled, so it all runs at once
+        preflight_start = perf_counter()
+        timings: Dict[str, float] = {}
+
+        async def timed(step: str, coro: Awaitable):
+            start = perf_counter()
+            try:
+                return await coro
+            finally:
+                timings[step] = perf_counter() - start
+
+        token_count: Optional[asyncio.Task] = None
+
+        async def under_embed_limit() -> bool:
+            # A token is at least a byte, so only long messages need counting
+            nonlocal token_count
+            if len(message.encode()) < 8191:
+                return True
+            if token_count is None:
+                token_count = asyncio.create_task(timed("tokens", self.count_tokens(message, model)))
+            return await token_count < 8191
+
+        async def embed() -> Tuple[List[float], List[float]]:
+            query_embedding = []
+            # Determine if we should embed the user's message
+            words = message.split(" ")
+            get_embed_conditions = [
+                conf.embeddings,  # We actually have embeddings to compare with
+                len(words) > 1,  # Message is long enough
+                conf.top_n,  # Top n is greater than 0
+            ]
+            if all(get_embed_conditions) and await under_embed_limit():
+                if conf.question_mode:
+                    # In question mode only the first message and messages that end with a ? are embedded
+                    if message.endswith("?") or not conversation.messages:
+                        query_embedding = await self.request_embedding(message, conf)
+                else:
                     query_embedding = await self.request_embedding(message, conf)
-            else:
-                query_embedding = await self.request_embedding(message, conf)
 
+            # Only questions asked without any history can reuse or provide a cached reply
+            cache_embedding = []
+            if conf.response_cache and not conversation.messages and not images and await under_embed_limit():
+                try:
+                    cache_embedding = query_embedding or await self.request_embedding(message, conf)
+                except Exception as e:
+                    log.warning("Failed to embed question for the response cache", exc_info=e)
+            return query_embedding, cache_embedding
+
+        async def get_balance() -> str:
+            mem = guild.get_member(author) if isinstance(author, int) else author
+            return humanize_number(await bank.get_balance(mem)) if mem else _("None")
+
+        async def bank_extras() -> dict:
+            balance, is_global, currency, bank_name = await asyncio.gather(
+                get_balance(),
+                bank.is_global(),
+                bank.get_currency_name(guild),
+                bank.get_bank_name(guild),
+            )
+            return {
+                "banktype": "global bank" if is_global else "local bank",
+                "currency": currency,
+                "bank": bank_name,
+                "balance": balance,
+            }
+
+        (query_embedding, cache_embedding), extras = await asyncio.gather(
+            timed("embedding", embed()),
+            timed("bank", bank_extras()),
+        )
         log.debug(f"Query embedding: {len(query_embedding)}")
 
-        mem = guild.get_member(author) if isinstance(author, int) else author
-        bal = humanize_number(await bank.get_balance(mem)) if mem else _("None")
-        extras = {
-            "banktype": "global bank" if await bank.is_global() else "local bank",
-            "currency": await bank.get_currency_name(guild),
-            "bank": await bank.get_bank_name(guild),
-            "balance": bal,
-        }
-
         # Don't include if user is not a tutor
         not_tutor = [
             author.id not in conf.tutors,
@@ -362,23 +448,43 @@ class ChatHandler(MixinMeta):
             function_calls = [i for i in function_calls if i["name"] != "search_internet"]
             del function_map["search_internet"]
 
-        messages = await self.prepare_messages(
-            message,
-            guild,
-            conf,
-            conversation,
-            author,
-            channel,
-            query_embedding,
-            extras,
-            function_calls,
-            images,
+        messages = await timed(
+            "prepare",
+            self.prepare_messages(
+                message,
+                guild,
+                conf,
+                conversation,
+                author,
+                channel,
+                query_embedding,
+                extras,
+                function_calls,
+                images,
+            ),
         )
+        preflight = perf_counter() - preflight_start
+        self.preflight_timings.record(timings, preflight)
+        steps = ", ".join(f"{step} {round(took * 1000, 1)}ms" for step, took in timings.items())
+        log.debug(f"Pre-flight took {round(preflight * 1000, 1)}ms ({steps})")
         reply = None
 
+        cached_reply = None
+        if cache_embedding:
+            fingerprint = await self.response_fingerprint(conf, conversation, guild, channel, author, extras, model)
+            cached_reply = self.response_cache.get(
+                guild.id, fingerprint, cache_embedding, conf.response_cache_threshold, conf.response_cache_ttl
+            )
+            if cached_reply is None:
+                conf.response_cache_misses += 1
+            else:
+                log.debug(f"Response cache hit in {guild.name}")
+                conf.response_cache_hits += 1
+                reply = cached_reply
+
         calls = 0
         tries = 0
-        while True:
+        while cached_reply is None:
             if tries > 2:
                 log.error("breaking after 3 tries, purge_images function must have failed")
                 break
@@ -389,7 +495,7 @@ class ChatHandler(MixinMeta):
             await ensure_message_compatibility(messages, conf, author)
 
             # Iteratively degrade the conversation to ensure it is always under the token limit
-            degraded = await self.degrade_conversation(messages, function_calls, conf, author)
+            degraded = await self.degrade_conversation(messages, function_calls, conf, author, conversation)
 
             before = len(messages)
             cleaned = await ensure_tool_consistency(messages)
@@ -404,13 +510,24 @@ class ChatHandler(MixinMeta):
             if not messages:
                 log.error("Messages got pruned too aggressively, increase token limit!")
                 break
+            request = functools.partial(
+                self.request_response,
+                messages=messages,
+                conf=conf,
+                functions=function_calls,
+                member=author,
+                conversation=conversation,
+                stream_callback=streamer.update if streamer else None,
+            )
             try:
-                response: ChatCompletionMessage = await self.request_response(
-                    messages=messages,
-                    conf=conf,
-                    functions=function_calls,
-                    member=author,
-                )
+                if conf.coalesce_requests:
+                    # Identical payloads in flight at the same time share one upstream call
+                    key = payload_key(messages, function_calls, self.request_settings(conf, author))
+                    response: ChatCompletionMessage = await self.singleflight.run(key, request)
+                    # Responses get cleaned in place, each conversation needs its own copy
+                    response = response.model_copy(deep=True)
+                else:
+                    response: ChatCompletionMessage = await request()
             except httpx.ReadTimeout:
                 reply = _("Request timed out, please try again.")
                 break
@@ -445,6 +562,8 @@ class ChatHandler(MixinMeta):
                 raise e
 
             if reply := response.content:
+                if cache_embedding and not calls:
+                    self.response_cache.put(guild.id, fingerprint, cache_embedding, reply)
                 break
 
             await clean_response(response)
@@ -469,151 +588,56 @@ class ChatHandler(MixinMeta):
                 del dump["tool_calls"]
 
             conversation.messages.append(dump)
+            conversation.mark_dirty()
             messages.append(dump)
 
             # Add function call count
             conf.functions_called += len(response_functions)
 
-            for function_call in response_functions:
-                if isinstance(function_call, ChatCompletionMessageToolCall):
-                    function_name = function_call.function.name
-                    arguments = function_call.function.arguments
-                    tool_id = function_call.id
-                    role = "tool"
-                else:
-                    function_name = function_call.name
-                    arguments = function_call.arguments
-                    tool_id = None
-                    role = "function"
-
-                calls += 1
-
-                if function_name not in function_map:
-                    log.error(f"GPT suggested a function not provided: {function_name}")
-                    e = {
-                        "role": role,
-                        "name": "invalid_function",
-                        "content": f"{function_name} is not a valid function name",
-                    }
-                    if tool_id:
-                        e["tool_call_id"] = tool_id
-                    messages.append(e)
-                    conversation.messages.append(e)
-                    # Remove the function call from the list
-                    function_calls = [i for i in function_calls if i["name"] != function_name]
-                    continue
+            # Independent calls run concurrently, ones that opted out of parallelism run one by one afterwards
+            sequential = {
+                name
+                for functions in self.registry.values()
+                for name, data in functions.items()
+                if not data.get("parallel", True)
+            }
+            semaphore = asyncio.Semaphore(max(1, conf.max_parallel_functions))
+
+            async def run(function_call: Union[ChatCompletionMessageToolCall, FunctionCall]):
+                async with semaphore:
+                    return await self._call_function(
+                        function_call, function_map, guild, channel, author, conf, message_obj
+                    )
 
-                if arguments != "{}":
-                    try:
-                        args = json.loads(arguments)
-                        parse_success = True
-                    except json.JSONDecodeError:
-                        args = {}
-                        parse_success = False
-                else:
-                    args = {}
-                    parse_success = True
-
-                if parse_success:
-                    extras = {
-                        "user": guild.get_member(author) if isinstance(author, int) else author,
-                        "channel": guild.get_channel_or_thread(channel) if isinstance(channel, int) else channel,
-                        "guild": guild,
-                        "bot": self.bot,
-                        "conf": conf,
-                    }
-                    kwargs = {**args, **extras}
-                    func = function_map[function_name]
+            results = [None] * len(response_functions)
+            concurrent = [i for i, fc in enumerate(response_functions) if function_call_name(fc) not in sequential]
+            # One call raising shouldn't throw away the others' results or leave its own call id unanswered
+            gathered = await asyncio.gather(*(run(response_functions[i]) for i in concurrent), return_exceptions=True)
+            for index, result in zip(concurrent, gathered):
+                if isinstance(result, BaseException):
+                    result = function_call_error(response_functions[index], result)
+                results[index] = result
+            for index, function_call in enumerate(response_functions):
+                if results[index] is None:
                     try:
-                        if iscoroutinefunction(func):
-                            func_result = await func(**kwargs)
-                        else:
-                            func_result = await asyncio.to_thread(func, **kwargs)
+                        results[index] = await run(function_call)
                     except Exception as e:
-                        log.error(
-                            f"Custom function {function_name} failed to execute!\nArgs: {arguments}",
-                            exc_info=e,
-                        )
-                        func_result = traceback.format_exc()
-                        function_calls = [i for i in function_calls if i["name"] != function_name]
-                else:
-                    # Help the model self-correct
-                    func_result = f"JSONDecodeError: Failed to parse arguments for function {function_name}"
-
-                return_null = False
-
-                if isinstance(func_result, discord.Embed):
-                    result = func_result.description or _("Result sent!")
-                    try:
-                        await channel.send(embed=func_result)
-                    except discord.Forbidden:
-                        result = "You do not have permissions to embed links in this channel"
-                        function_calls = [i for i in function_calls if i["name"] != function_name]
-                elif isinstance(func_result, discord.File):
-                    result = "File uploaded!"
-                    try:
-                        await channel.send(file=func_result)
-                    except discord.Forbidden:
-                        result = "You do not have permissions to upload files in this channel"
-                        function_calls = [i for i in function_calls if i["name"] != function_name]
-                elif isinstance(func_result, dict):
-                    # For complex responses
-                    result = func_result["result_text"]
-                    return_null = func_result.get("return_null", False)
-                    kwargs = {}
-                    if "embed" in func_result and channel.permissions_for(guild.me).embed_links:
-                        if not isinstance(func_result["embed"], discord.Embed):
-                            raise TypeError("Embed must be a discord.Embed object")
-                        kwargs["embed"] = func_result["embed"]
-                    if "file" in func_result and channel.permissions_for(guild.me).attach_files:
-                        if not isinstance(func_result["file"], discord.File):
-                            raise TypeError("File must be a discord.File object")
-                        kwargs["file"] = func_result["file"]
-                    if "embeds" in func_result and channel.permissions_for(guild.me).embed_links:
-                        if not isinstance(func_result["embeds"], list):
-                            raise TypeError("Embeds must be a list of discord.Embed objects")
-                        if not all(isinstance(i, discord.Embed) for i in func_result["embeds"]):
-                            raise TypeError("Embeds must be a list of discord.Embed objects")
-                        kwargs["embeds"] = func_result["embeds"]
-                    if "files" in func_result and channel.permissions_for(guild.me).attach_files:
-                        if not isinstance(func_result["files"], list):
-                            raise TypeError("Files must be a list of discord.File objects")
-                        if not all(isinstance(i, discord.File) for i in func_result["files"]):
-                            raise TypeError("Files must be a list of discord.File objects")
-                        kwargs["files"] = func_result["files"]
-                    if kwargs:
-                        try:
-                            await channel.send(**kwargs)
-                        except discord.HTTPException as e:
-                            result = f"discord.HTTPException: {e.text}"
-                            function_calls = [i for i in function_calls if i["name"] != function_name]
-
-                elif isinstance(func_result, bytes):
-                    result = func_result.decode()
-                else:  # Is a string
-                    result = str(func_result)
-
-                # Ensure response isnt too large
-                result = await self.cut_text_by_tokens(result, conf, author)
-                info = (
-                    f"Called function {function_name} in {guild.name} for {author.display_name}\n"
-                    f"Params: {args}\nResult: {result}"
-                )
-                log.debug(info)
-                e = {"role": role, "name": function_name, "content": result}
-                if tool_id:
-                    e["tool_call_id"] = tool_id
-                messages.append(e)
-                conversation.messages.append(e)
-
-                if return_null:
-                    return None
+                        results[index] = function_call_error(function_call, e)
+            calls += len(response_functions)
+
+            # Results go in the same order as the calls so every tool_call_id is answered in sequence
+            return_null = False
+            for function_name, entry, failed, null in results:
+                messages.append(entry)
+                conversation.messages.append(entry)
+                if failed:
+                    # Remove the function call from the list
+                    function_calls = [i for i in function_calls if i["name"] != function_name]
+                return_null = return_null or null
+            conversation.mark_dirty()
 
-                if message_obj and function_name in ["create_memory", "edit_memory"]:
-                    try:
-                        await message_obj.add_reaction("\N{BRAIN}")
-                    except (discord.Forbidden, discord.NotFound):
-                        pass
+            if return_null:
+                return None
 
         # Handle the rest of the reply
         if calls > 1:
@@ -621,16 +645,7 @@ class ChatHandler(MixinMeta):
 
         block = False
         if reply:
-            for regex in conf.regex_blacklist:
-                try:
-                    reply = await self.safe_regex(regex, reply)
-                except (asyncio.TimeoutError, mp.TimeoutError):
-                    log.error(f"Regex {regex} in {guild.name} took too long to process. Skipping...")
-                    if conf.block_failed_regex:
-                        block = True
-                except Exception as e:
-                    log.error("Regex sub error", exc_info=e)
-
+            reply, block = await self.apply_regex_blacklist(guild, conf, reply)
             conversation.update_messages(reply, "assistant", clean_name(self.bot.user.name))
 
         if block:
@@ -638,20 +653,259 @@ class ChatHandler(MixinMeta):
 
         return reply
 
-    async def safe_regex(self, regex: str, content: str):
-        process = self.mp_pool.apply_async(
-            re.sub,
-            args=(
-                regex,
-                "",
-                content,
-            ),
+    async def apply_regex_blacklist(self, guild: discord.Guild, conf: GuildSettings, text: str) -> Tuple[str, bool]:
+        """Remove the guild's blacklisted patterns from a reply
+
+        Returns:
+            Tuple[str, bool]: the cleaned text and whether it should be blocked because a pattern failed
+        """
+        block = False
+        for pattern in self.regex_engine.get(guild.id, conf.regex_blacklist):
+            try:
+                text = await self.regex_engine.sub(pattern, text, self.worker_pool)
+            except asyncio.TimeoutError:
+                log.error(f"Regex {pattern.pattern} in {guild.name} took too long to process. Skipping...")
+                if conf.block_failed_regex:
+                    block = True
+            except Exception as e:
+                log.error("Regex sub error", exc_info=e)
+        return text, block
+
+    async def filter_streamed_text(self, guild: discord.Guild, conf: GuildSettings, text: str) -> Optional[str]:
+        """Regex blacklist for partial streamed replies, None holds the rest of the stream back
+
+        The end of the text could be the start of a match that isn't complete yet, so as many characters as
+        the widest pattern could still grow from are left off until more of the reply arrives.
+        """
+        patterns = self.regex_engine.get(guild.id, conf.regex_blacklist)
+        if any(i.width is None for i in patterns):
+            # Blacklist changed mid reply
+            return None
+        cleaned, block = await self.apply_regex_blacklist(guild, conf, text)
+        if block:
+            return None
+        # Removing matches only shortens the text, so whatever could still be part of a match stays at the end
+        holdback = max(i.width for i in patterns) if patterns else 0
+        return cleaned[: max(0, len(cleaned) - holdback)]
+
+    async def response_fingerprint(
+        self,
+        conf: GuildSettings,
+        conversation: Conversation,
+        guild: discord.Guild,
+        channel: Union[discord.TextChannel, discord.Thread, discord.ForumChannel],
+        author: discord.Member,
+        extras: dict,
+        model: str,
+    ) -> int:
+        """Hash of everything that shapes a reply to a question without history, cached replies are tied to it
+
+        The prompt templates are hashed along with the values of the placeholders they use, so a prompt with
+        per user placeholders like `{username}` or `{roles}` never serves one user's reply to another.
+        Time placeholders like `{time}` are left out, the cache TTL bounds how stale they get.
+        Related embeddings are covered by the embeddings revision instead of the text they add to the prompts.
+        """
+        system_prompt, initial_prompt = self.prompt_templates(conf, conversation, channel)
+        templates = system_prompt + initial_prompt
+
+        def _prepare() -> Tuple[tuple, int]:
+            params = get_params(self.bot, guild, datetime.now(), author, channel, extras)
+            used = tuple((k, str(v)) for k, v in params.items() if k not in TIME_PARAMS and "{" + k + "}" in templates)
+            return used, conf.embeddings_revision()
+
+        used, revision = await asyncio.to_thread(_prepare)
+        return hash(
+            (
+                model,
+                system_prompt,
+                initial_prompt,
+                used,
+                conf.embed_model,
+                conf.embed_method,
+                revision,
+                conf.temperature,
+            )
         )
-        task = functools.partial(process.get, timeout=2)
-        loop = asyncio.get_running_loop()
-        new_task = loop.run_in_executor(None, task)
-        subbed = await asyncio.wait_for(new_task, timeout=5)
-        return subbed
+
+    @staticmethod
+    def prompt_templates(
+        conf: GuildSettings,
+        conversation: Conversation,
+        channel: Union[discord.TextChannel, discord.Thread, discord.ForumChannel],
+    ) -> Tuple[str, str]:
+        """The system and initial prompts before their placeholders are filled in"""
+        if channel.id in conf.channel_prompts:
+            system_prompt = conf.channel_prompts[channel.id]
+        else:
+            system_prompt = conversation.system_prompt_override or conf.system_prompt
+        return system_prompt, conf.prompt
+
+    def request_settings(self, conf: GuildSettings, member: Optional[discord.Member]) -> dict:
+        """Everything besides the payload that changes what request_response sends"""
+        return {
+            "api_key": conf.api_key,
+            "endpoint": self.db.endpoint_override,
+            "model": conf.get_user_model(member),
+            "temperature": conf.temperature,
+            "frequency_penalty": conf.frequency_penalty,
+            "presence_penalty": conf.presence_penalty,
+            "seed": conf.seed,
+            "max_tokens": self.get_max_tokens(conf, member),
+            "max_response_tokens": conf.get_user_max_response_tokens(member),
+        }
+
+    async def _call_function(
+        self,
+        function_call: Union[ChatCompletionMessageToolCall, FunctionCall],
+        function_map: Dict[str, Callable],
+        guild: discord.Guild,
+        channel: Union[discord.TextChannel, discord.Thread, discord.ForumChannel],
+        author: discord.Member,
+        conf: GuildSettings,
+        message_obj: Optional[discord.Message] = None,
+    ) -> Tuple[str, dict, bool, bool]:
+        """Run a single function call from the model
+
+        Returns:
+            Tuple[str, dict, bool, bool]: function name, the message with its result, whether the function
+            failed and should no longer be offered, and whether the reply should be dropped (return_null)
+        """
+        if isinstance(function_call, ChatCompletionMessageToolCall):
+            function_name = function_call.function.name
+            arguments = function_call.function.arguments
+            tool_id = function_call.id
+            role = "tool"
+        else:
+            function_name = function_call.name
+            arguments = function_call.arguments
+            tool_id = None
+            role = "function"
+
+        if function_name not in function_map:
+            log.error(f"GPT suggested a function not provided: {function_name}")
+            e = {
+                "role": role,
+                "name": "invalid_function",
+                "content": f"{function_name} is not a valid function name",
+            }
+            if tool_id:
+                e["tool_call_id"] = tool_id
+            return function_name, e, True, False
+
+        failed = False
+        if arguments != "{}":
+            try:
+                args = json.loads(arguments)
+                parse_success = True
+            except json.JSONDecodeError:
+                args = {}
+                parse_success = False
+        else:
+            args = {}
+            parse_success = True
+
+        if parse_success:
+            extras = {
+                "user": guild.get_member(author) if isinstance(author, int) else author,
+                "channel": guild.get_channel_or_thread(channel) if isinstance(channel, int) else channel,
+                "guild": guild,
+                "bot": self.bot,
+                "conf": conf,
+            }
+            kwargs = {**args, **extras}
+            func = function_map[function_name]
+            try:
+                if iscoroutinefunction(func):
+                    task = func(**kwargs)
+                else:
+                    task = asyncio.to_thread(func, **kwargs)
+                func_result = await asyncio.wait_for(task, timeout=conf.function_timeout or None)
+            except asyncio.TimeoutError:
+                log.warning(f"Function {function_name} timed out after {conf.function_timeout}s\nArgs: {arguments}")
+                func_result = f"TimeoutError: {function_name} did not finish within {conf.function_timeout} seconds"
+                failed = True
+            except Exception as e:
+                log.error(
+                    f"Custom function {function_name} failed to execute!\nArgs: {arguments}",
+                    exc_info=e,
+                )
+                func_result = traceback.format_exc()
+                failed = True
+        else:
+            # Help the model self-correct
+            func_result = f"JSONDecodeError: Failed to parse arguments for function {function_name}"
+
+        return_null = False
+
+        if isinstance(func_result, discord.Embed):
+            result = func_result.description or _("Result sent!")
+            try:
+                await channel.send(embed=func_result)
+            except discord.Forbidden:
+                result = "You do not have permissions to embed links in this channel"
+                failed = True
+        elif isinstance(func_result, discord.File):
+            result = "File uploaded!"
+            try:
+                await channel.send(file=func_result)
+            except discord.Forbidden:
+                result = "You do not have permissions to upload files in this channel"
+                failed = True
+        elif isinstance(func_result, dict):
+            # For complex responses
+            result = func_result["result_text"]
+            return_null = func_result.get("return_null", False)
+            kwargs = {}
+            if "embed" in func_result and channel.permissions_for(guild.me).embed_links:
+                if not isinstance(func_result["embed"], discord.Embed):
+                    raise TypeError("Embed must be a discord.Embed object")
+                kwargs["embed"] = func_result["embed"]
+            if "file" in func_result and channel.permissions_for(guild.me).attach_files:
+                if not isinstance(func_result["file"], discord.File):
+                    raise TypeError("File must be a discord.File object")
+                kwargs["file"] = func_result["file"]
+            if "embeds" in func_result and channel.permissions_for(guild.me).embed_links:
+                if not isinstance(func_result["embeds"], list):
+                    raise TypeError("Embeds must be a list of discord.Embed objects")
+                if not all(isinstance(i, discord.Embed) for i in func_result["embeds"]):
+                    raise TypeError("Embeds must be a list of discord.Embed objects")
+                kwargs["embeds"] = func_result["embeds"]
+            if "files" in func_result and channel.permissions_for(guild.me).attach_files:
+                if not isinstance(func_result["files"], list):
+                    raise TypeError("Files must be a list of discord.File objects")
+                if not all(isinstance(i, discord.File) for i in func_result["files"]):
+                    raise TypeError("Files must be a list of discord.File objects")
+                kwargs["files"] = func_result["files"]
+            if kwargs:
+                try:
+                    await channel.send(**kwargs)
+                except discord.HTTPException as e:
+                    result = f"discord.HTTPException: {e.text}"
+                    failed = True
+
+        elif isinstance(func_result, bytes):
+            result = func_result.decode()
+        else:  # Is a string
+            result = str(func_result)
+
+        # Ensure response isnt too large
+        result = await self.cut_text_by_tokens(result, conf, author)
+        info = (
+            f"Called function {function_name} in {guild.name} for {author.display_name}\n"
+            f"Params: {args}\nResult: {result}"
+        )
+        log.debug(info)
+        e = {"role": role, "name": function_name, "content": result}
+        if tool_id:
+            e["tool_call_id"] = tool_id
+
+        if message_obj and function_name in ["create_memory", "edit_memory"]:
+            try:
+                await message_obj.add_reaction("\N{BRAIN}")
+            except (discord.Forbidden, discord.NotFound):
+                pass
+
+        return function_name, e, failed, return_null
 
     async def prepare_messages(
         self,
@@ -690,25 +944,26 @@ class ChatHandler(MixinMeta):
                 text = text.replace(key, str(v))
             return text
 
-        if channel.id in conf.channel_prompts:
-            system_prompt = format_string(conf.channel_prompts[channel.id])
-        else:
-            system_prompt = format_string(conversation.system_prompt_override or conf.system_prompt)
-
-        initial_prompt = format_string(conf.prompt)
+        system_prompt, initial_prompt = self.prompt_templates(conf, conversation, channel)
+        system_prompt = format_string(system_prompt)
+        initial_prompt = format_string(initial_prompt)
         model = conf.get_user_model(author)
-        current_tokens = await self.count_tokens(message + system_prompt + initial_prompt, model)
-        current_tokens += await self.count_payload_tokens(conversation.messages, model)
-        current_tokens += await self.count_function_tokens(function_calls, model)
 
-        max_tokens = self.get_max_tokens(conf, author)
+        def _prepare() -> Tuple[int, list, List[int]]:
+            # Token counting and the embedding search share a single worker call
+            tokens = tokenizer.count(message + system_prompt + initial_prompt, model)
+            cache = conversation.token_cache(tokenizer.encoding_name(model))
+            tokens += tokenizer.count_payload(conversation.messages, model, cache)
+            tokens += tokenizer.count_functions(function_calls, model)
+            found = conf.get_related_embeddings(query_embedding)
+            return tokens, found, tokenizer.count_batch([i[1] for i in found], model)
 
-        related = await asyncio.to_thread(conf.get_related_embeddings, query_embedding)
+        current_tokens, related, related_tokens = await asyncio.to_thread(_prepare)
+        max_tokens = self.get_max_tokens(conf, author)
 
         embeds: List[str] = []
         # Get related embeddings (Name, text, score, dimensions)
-        for i in related:
-            embed_tokens = await self.count_tokens(i[1], model)
+        for i, embed_tokens in zip(related, related_tokens):
             if embed_tokens + current_tokens > max_tokens:
                 log.debug("Cannot fit anymore embeddings")
                 break
@@ -753,7 +1008,6 @@ class ChatHandler(MixinMeta):
         if files and not file_perms:
             files = []
             content += _("\nMissing 'attach files' permissions!")
-        delims = ("```", "\n")
 
         async def send(
             content: Optional[str] = None,
@@ -777,21 +1031,8 @@ class ChatHandler(MixinMeta):
                     pass
             return await message.channel.send(content=content, embed=embed, embeds=embeds, files=files)
 
-        if len(content) <= 2000:
-            await send(content, files=files, mention=conf.mention)
-        elif len(content) <= 4000 and embed_perms:
-            await send(embed=discord.Embed(description=content), files=files, mention=conf.mention)
-        elif embed_perms:
-            embeds = [discord.Embed(description=p) for p in pagify(content, page_length=3950, delims=delims)]
-            for index, embed in enumerate(embeds):
-                if index == 0:
-                    await send(embed=embed, files=files, mention=conf.mention)
-                else:
-                    await send(embed=embed)
-        else:
-            pages = [p for p in pagify(content, page_length=2000, delims=delims)]
-            for index, p in enumerate(pages):
-                if index == 0:
-                    await send(content=p, files=files, mention=conf.mention)
-                else:
-                    await send(content=p)
+        for index, page in enumerate(reply_pages(content, embed_perms)):
+            if index == 0:
+                await send(**page, files=files, mention=conf.mention)
+            else:
+                await send(**page)
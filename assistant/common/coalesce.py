@@ -0,0 +1,49 @@
+import asyncio
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import orjson
+
+log = logging.getLogger("red.vrt.assistant.coalesce")
+
+T = TypeVar("T")
+
+
+def payload_key(messages: List[dict], functions: Optional[List[dict]], settings: Dict[str, Any]) -> bytes:
+    """Digest of everything that goes into a chat completion request"""
+    dump = orjson.dumps(
+        {"messages": messages, "functions": functions or [], "settings": settings},
+        option=orjson.OPT_SORT_KEYS,
+        default=str,
+    )
+    return hashlib.sha256(dump).digest()
+
+
+class SingleFlight:
+    """Shares one in-flight call between every caller asking for the same key
+
+    The first caller's call runs as its own task, so if it gets cancelled the others still get the result.
+    """
+
+    def __init__(self):
+        self.inflight: Dict[bytes, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def run(self, key: bytes, func: Callable[[], Awaitable[T]]) -> T:
+        """Await `func`, or the call already in flight for the key
+
+        Returns:
+            T: the result, callers that joined another call get the very same object
+        """
+        task = self.inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.create_task(func())
+            self.inflight[key] = task
+            task.add_done_callback(lambda __: self.inflight.pop(key, None))
+        else:
+            self.shared += 1
+            log.debug("Joined an identical request already in flight")
+        return await asyncio.shield(task)
@@ -207,6 +207,7 @@ class AssistantFunctions(MixinMeta):
         conf.embeddings[memory_name].embedding = embedding
         conf.embeddings[memory_name].update()
         conf.embeddings[memory_name].model = conf.embed_model
+        await asyncio.to_thread(conf.sync_embeddings)
         asyncio.create_task(self.save_conf())
         return "Your memory has been updated!"
 
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+import msgpack
+import pandas as pd
+
+from .models import Embedding
+
+log = logging.getLogger("red.vrt.assistant.imports")
+
+# Imported entry text is truncated to this many characters
+MAX_TEXT = 4000
+# Rows embedded concurrently per chunk, the embedding batcher merges them into batched requests
+IMPORT_CHUNK = 256
+# Inputs per embedding request and requests in flight when resyncing
+RESYNC_BATCH = 64
+RESYNC_WORKERS = 4
+# Seconds between saves while importing or resyncing
+CHECKPOINT_INTERVAL = 60
+
+# (name, text, created timestamp or None, ai_created)
+Row = Tuple[str, str, Optional[float], bool]
+
+
+def rows_from_csv(frames: List[pd.DataFrame]) -> List[Row]:
+    """Rows from frames with `name` and `text` columns"""
+    rows = []
+    for df in frames:
+        for name, text in zip(df["name"], df["text"]):
+            if pd.isna(name) or pd.isna(text):
+                continue
+            rows.append((str(name), str(text)[:MAX_TEXT], None, False))
+    return rows
+
+
+def rows_from_excel(frames: List[pd.DataFrame], timezone_name: str) -> List[Row]:
+    """Rows from exported sheets with `name`, `text`, `created` and `ai_created` columns"""
+    rows = []
+    for df in frames:
+        for name, text, created, ai_created in zip(df["name"], df["text"], df["created"], df["ai_created"]):
+            if pd.isna(name) or pd.isna(text):
+                continue
+            created_ts = None
+            if not pd.isna(created):
+                created_ts = pd.to_datetime(created).tz_localize(timezone_name).timestamp()
+            rows.append((str(name), str(text)[:MAX_TEXT], created_ts, bool(ai_created)))
+    return rows
+
+
+def pending_rows(rows: List[Row], embeddings: Dict[str, Embedding], overwrite: bool) -> List[Row]:
+    """Rows that still need importing
+
+    Duplicate names within the import resolve the same way importing them one by one would,
+    the last one wins when overwriting, otherwise the first. Rows matching an existing entry's
+    text are skipped, which is also what lets a resumed import pick up where it left off.
+    """
+    unique: Dict[str, Row] = {}
+    for row in rows:
+        if overwrite or row[0] not in unique:
+            unique[row[0]] = row
+    pending = []
+    for name, row in unique.items():
+        if existing := embeddings.get(name):
+            if not overwrite or existing.text == row[1]:
+                continue
+        pending.append(row)
+    return pending
+
+
+def make_embedding(row: Row, vector: List[float], model: str) -> Embedding:
+    __, text, created, ai_created = row
+    embedding = Embedding(text=text, embedding=vector, ai_created=ai_created, model=model)
+    if created is not None:
+        embedding.created = datetime.fromtimestamp(created, tz=timezone.utc)
+    return embedding
+
+
+class ImportJob:
+    """An embedding import that is checkpointed to disk so it can resume if the cog reloads
+
+    The checkpoint holds every parsed row, on resume `pending_rows` filters out whatever was already imported.
+    """
+
+    def __init__(
+        self,
+        guild_id: int,
+        channel_id: int,
+        message_id: int,
+        files: List[str],
+        overwrite: bool,
+        rows: List[Row],
+    ):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.files = files
+        self.overwrite = overwrite
+        self.rows = rows
+
+    @property
+    def key(self) -> str:
+        return f"{self.guild_id}_{self.message_id}"
+
+    def path(self, root: Path) -> Path:
+        return root / f"{self.key}.msgpack"
+
+    def save(self, root: Path):
+        root.mkdir(parents=True, exist_ok=True)
+        data = {
+            "guild_id": self.guild_id,
+            "channel_id": self.channel_id,
+            "message_id": self.message_id,
+            "files": self.files,
+            "overwrite": self.overwrite,
+            "rows": self.rows,
+        }
+        path = self.path(root)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(msgpack.packb(data))
+        os.replace(tmp, path)
+
+    def delete(self, root: Path):
+        self.path(root).unlink(missing_ok=True)
+
+    @classmethod
+    def load_all(cls, root: Path) -> List["ImportJob"]:
+        if not root.exists():
+            return []
+        jobs = []
+        for path in root.glob("*.msgpack"):
+            if path.name.startswith("resync_"):
+                continue
+            try:
+                data = msgpack.unpackb(path.read_bytes())
+                data["rows"] = [tuple(row) for row in data["rows"]]
+                jobs.append(cls(**data))
+            except Exception as e:
+                log.error(f"Discarding unreadable import checkpoint {path.name}", exc_info=e)
+                path.unlink(missing_ok=True)
+        return jobs
+
+
+class ResyncJob:
+    """Progress of a background embedding resync, checkpointed so it restarts if the cog reloads
+
+    Entries are written back as they're re-embedded, so a restarted resync only picks up the ones still stale.
+    """
+
+    def __init__(self, guild_id: int, channel_id: int, message_id: int):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+
+        self.total = 0
+        self.done = 0
+        self.start = monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+    def rate(self) -> float:
+        """Entries per second"""
+        elapsed = monotonic() - self.start
+        return self.done / elapsed if elapsed else 0.0
+
+    def eta(self) -> Optional[float]:
+        """Seconds until finished at the current rate"""
+        rate = self.rate()
+        if not rate:
+            return None
+        return (self.total - self.done) / rate
+
+    def path(self, root: Path) -> Path:
+        return root / f"resync_{self.guild_id}.msgpack"
+
+    def save(self, root: Path):
+        root.mkdir(parents=True, exist_ok=True)
+        data = {"guild_id": self.guild_id, "channel_id": self.channel_id, "message_id": self.message_id}
+        self.path(root).write_bytes(msgpack.packb(data))
+
+    def delete(self, root: Path):
+        self.path(root).unlink(missing_ok=True)
+
+    @classmethod
+    def load_all(cls, root: Path) -> List["ResyncJob"]:
+        if not root.exists():
+            return []
+        jobs = []
+        for path in root.glob("resync_*.msgpack"):
+            try:
+                jobs.append(cls(**msgpack.unpackb(path.read_bytes())))
+            except Exception as e:
+                log.error(f"Discarding unreadable resync checkpoint {path.name}", exc_info=e)
+                path.unlink(missing_ok=True)
+        return jobs
@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import logging
 from datetime import datetime, timezone
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
@@ -5,11 +7,16 @@ from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import discord
 import numpy as np
 import orjson
-from pydantic import VERSION, BaseModel, Field
+from pydantic import VERSION, BaseModel, Field, PrivateAttr
 from redbot.core.bot import Red
 
+from .vectors import EmbeddingIndex, Vector
+
 log = logging.getLogger("red.vrt.assistant.models")
 
+# {code hash: callable} for custom functions that have been compiled
+_compiled_functions: Dict[str, Callable] = {}
+
 
 class AssistantBaseModel(BaseModel):
     @classmethod
@@ -18,15 +25,46 @@ class AssistantBaseModel(BaseModel):
             return super().model_validate(obj, *args, **kwargs)
         return super().parse_obj(obj, *args, **kwargs)
 
-    def model_dump(self, exclude_defaults: bool = True):
+    def model_dump(self, exclude_defaults: bool = True, exclude: Optional[Union[set, dict]] = None):
         if VERSION >= "2.0.1":
-            return super().model_dump(mode="json", exclude_defaults=exclude_defaults)
-        return orjson.loads(super().json(exclude_defaults=exclude_defaults))
+            return super().model_dump(mode="json", exclude_defaults=exclude_defaults, exclude=exclude)
+
+        def default(obj: Any):
+            if isinstance(obj, Vector):
+                return obj.tolist()
+            return self.__json_encoder__(obj)
+
+        return orjson.loads(super().json(exclude_defaults=exclude_defaults, exclude=exclude, encoder=default))
+
+
+class TrackedModel(AssistantBaseModel):
+    """Model that gets persisted on its own and is flagged when it may have changed
+
+    Assignments flag the model automatically, in-place edits (appending to a list etc) must call mark_dirty
+    themselves since reading a model never flags it.
+    """
+
+    _dirty: bool = PrivateAttr(default=True)
+
+    def __setattr__(self, name: str, value: Any):
+        super().__setattr__(name, value)
+        if name != "_dirty":
+            self._dirty = True
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def mark_clean(self):
+        self._dirty = False
+
+    @property
+    def is_dirty(self) -> bool:
+        return self._dirty
 
 
 class Embedding(AssistantBaseModel):
     text: str
-    embedding: List[float]
+    embedding: Vector
     ai_created: bool = False
     created: datetime = Field(default_factory=lambda: datetime.now(tz=timezone.utc))
     modified: datetime = Field(default_factory=lambda: datetime.now(tz=timezone.utc))
@@ -43,21 +81,45 @@ class Embedding(AssistantBaseModel):
     def update(self):
         self.modified = datetime.now(tz=timezone.utc)
 
+    def __setattr__(self, name: str, value: Any):
+        # Assignment isn't validated, so keep edited vectors compact too
+        if name == "embedding" and not isinstance(value, Vector):
+            value = Vector.from_values(value)
+        super().__setattr__(name, value)
+
     def __str__(self) -> str:
         return self.text
 
 
-class CustomFunction(AssistantBaseModel):
+class CustomFunction(TrackedModel):
     """Functions added by bot owner via string"""
 
     code: str
     jsonschema: dict
     permission_level: str = "user"  # user, mod, admin, owner
 
+    @property
+    def code_hash(self) -> str:
+        return hashlib.sha256(f"{self.jsonschema['name']}\n{self.code}".encode()).hexdigest()
+
     def prep(self) -> Callable:
-        """Prep function for execution"""
-        exec(self.code, globals())
-        return globals()[self.jsonschema["name"]]
+        """Prep function for execution
+
+        Code is only compiled and executed the first time, in its own namespace, and reused until it changes
+        """
+        key = self.code_hash
+        if key in _compiled_functions:
+            return _compiled_functions[key]
+        name = self.jsonschema["name"]
+        # Copy of this module's globals so code relying on them keeps working without polluting them
+        namespace = dict(globals())
+        exec(compile(self.code, f"<custom function {name}>", "exec"), namespace)
+        _compiled_functions[key] = namespace[name]
+        return namespace[name]
+
+    def forget(self):
+        """Drop the compiled callable, called when the function is edited or deleted"""
+        _compiled_functions.pop(self.code_hash, None)
 
 
 class Usage(AssistantBaseModel):
@@ -66,7 +128,7 @@ class Usage(AssistantBaseModel):
     output_tokens: int = 0
 
 
-class GuildSettings(AssistantBaseModel):
+class GuildSettings(TrackedModel):
     system_prompt: str = "You are a discord bot named {botname}, and are chatting with {username}."
     prompt: str = ""
     channel_prompts: Dict[int, str] = {}
@@ -78,6 +140,8 @@ class GuildSettings(AssistantBaseModel):
     top_n: int = 3
     min_relatedness: float = 0.78
     embed_method: str = "dynamic"  # hybrid, dynamic, static, user
+    search_method: str = "exact"  # exact, approximate
+    search_probes: int = 8  # Clusters scanned per query in approximate mode, higher = better recall but slower
     question_mode: bool = False  # If True, only the first message and messages that end with ? will have emebddings
     channel_id: Optional[int] = 0
     api_key: Optional[str] = None
@@ -89,6 +153,12 @@ class GuildSettings(AssistantBaseModel):
     max_tokens: int = 4000
     mention: bool = False
     mention_respond: bool = True
+    stream_responses: bool = False  # Post replies as they're generated and edit them as more arrives
+    priority: int = 1  # Share of reply slots relative to other guilds when busy, set by the bot owner
+    coalesce_requests: bool = True  # Identical requests in flight at the same time share one API call
+    response_cache: bool = False  # Reuse replies to questions similar to ones already answered without history
+    response_cache_threshold: float = 0.95  # Similarity a question needs to a cached one to reuse its reply
+    response_cache_ttl: int = 3600  # Seconds a cached reply stays valid
     enabled: bool = True  # Auto-reply channel
     model: str = "gpt-4o-mini"
     embed_model: str = "text-embedding-3-small"  # Or text-embedding-3-large, text-embedding-ada-002
@@ -116,8 +186,28 @@ class GuildSettings(AssistantBaseModel):
 
     use_function_calls: bool = False
     max_function_calls: int = 20  # Max calls in a row
+    max_parallel_functions: int = 4  # Tool calls from one response that can run at once, 1 = one at a time
+    function_timeout: int = 60  # Seconds before a function call is abandoned, 0 = no limit
     disabled_functions: List[str] = []
     functions_called: int = 0
+    response_cache_hits: int = 0
+    response_cache_misses: int = 0
+
+    _embedding_index: EmbeddingIndex = PrivateAttr(default_factory=EmbeddingIndex)
+
+    def sync_embeddings(self) -> int:
+        """Sync the cached embedding matrix with any added, edited or deleted entries"""
+        return self._embedding_index.sync(self.embeddings, approximate=self.search_method == "approximate")
+
+    def embeddings_revision(self) -> int:
+        """Changes whenever an embedding is added, edited or deleted"""
+        self.sync_embeddings()
+        return self._embedding_index.revision
+
+    def measure_search_recall(self, samples: int = 50) -> Optional[Tuple[float, float, float, int]]:
+        """Recall and average latency (ms) of approximate search vs an exact scan"""
+        self.sync_embeddings()
+        return self._embedding_index.measure_recall(samples, max(self.top_n, 1), self.search_probes)
 
     def get_related_embeddings(
         self,
@@ -139,10 +229,14 @@ class GuildSettings(AssistantBaseModel):
         if not top_n or q_length == 0 or not self.embeddings:
             return []
 
+        self.sync_embeddings()
+        probes = self.search_probes if self.search_method == "approximate" else 0
+        candidates = self._embedding_index.candidates(query_embedding, top_n, min_relatedness, probes)
+
+        # Rescore the candidates exactly so results match a full scan
         strings_and_relatedness = []
-        for name, em in self.embeddings.items():
-            if q_length != len(em.embedding):
-                continue
+        for name in candidates:
+            em = self.embeddings[name]
             try:
                 score = cosine_similarity(query_embedding, em.embedding)
                 if score >= min_relatedness:
@@ -166,6 +260,7 @@ class GuildSettings(AssistantBaseModel):
         input_tokens: int,
         output_tokens: int,
     ) -> None:
+        self.mark_dirty()
         if model not in self.usage:
             self.usage[model] = Usage()
         if total_tokens:
@@ -221,11 +316,18 @@ class GuildSettings(AssistantBaseModel):
         return self.max_retention_time
 
 
-class Conversation(AssistantBaseModel):
+class Conversation(TrackedModel):
     messages: List[dict] = []
     last_updated: float = 0.0
     system_prompt_override: Optional[str] = None
 
+    # {encoding_name: {message fingerprint: tokens}}
+    _token_cache: Dict[str, Dict[int, int]] = PrivateAttr(default_factory=dict)
+
+    def token_cache(self, encoding: str) -> Dict[int, int]:
+        """Per message token counts for an encoding, edited messages get new fingerprints so stale counts never match"""
+        return self._token_cache.setdefault(encoding, {})
+
     def function_count(self) -> int:
         if not self.messages:
             return 0
@@ -243,12 +345,14 @@ class Conversation(AssistantBaseModel):
         ]
         if any(clear):
             self.messages.clear()
+            self.mark_dirty()
         elif conf.max_retention:
             self.messages = self.messages[-conf.get_user_max_retention(member) :]
 
     def reset(self):
         self.refresh()
         self.messages.clear()
+        self._token_cache.clear()
 
     def refresh(self):
         self.last_updated = datetime.now().timestamp()
@@ -353,10 +457,72 @@ class DB(AssistantBaseModel):
     listen_to_bots: bool = False
     brave_api_key: Optional[str] = None
     endpoint_override: Optional[str] = None
+    embedding_precision: str = "float32"  # float32, float16, int8
+    embedding_cache_size: int = 32  # MB of query embeddings to keep cached, 0 to disable
+    persist_embedding_cache: bool = False  # Keep the embedding cache across restarts
+    worker_pool_size: int = 0  # Processes for sandboxed regex patterns, 0 = automatic
+    max_concurrent_chats: int = 10  # Replies generated at once across all guilds
+    max_guild_chats: int = 3  # Replies generated at once per guild
+    max_queued_chats: int = 10  # Messages a guild can have waiting before new ones are turned away
+    chat_queue_timeout: int = 60  # Seconds a message can wait for its turn, 0 = no limit
+    max_connections: int = 100  # Open HTTP connections per API key and endpoint
+    max_keepalive_connections: int = 20  # Idle connections kept open for reuse
+    keepalive_expiry: int = 60  # Seconds an idle connection stays open
+
+    # Raw guild settings that haven't been validated yet, loaded on first access
+    _raw_configs: Dict[int, dict] = PrivateAttr(default_factory=dict)
+    _conf_loader: Optional[Callable[[int, dict], GuildSettings]] = PrivateAttr(default=None)
+
+    def defer_configs(self, raw_configs: Dict[Any, dict], loader: Callable[[int, dict], GuildSettings]) -> None:
+        """Hold raw guild settings to be validated by the loader the first time they're accessed"""
+        self._raw_configs = {int(k): v for k, v in raw_configs.items()}
+        self._conf_loader = loader
+
+    def deferred_configs(self) -> Dict[int, dict]:
+        """Raw settings of guilds that haven't been loaded yet"""
+        return dict(self._raw_configs)
+
+    def guild_ids(self) -> List[int]:
+        # A guild being loaded can briefly be in both
+        return list(dict.fromkeys([*self.configs, *self._raw_configs]))
+
+    def has_conf(self, guild_id: int) -> bool:
+        return guild_id in self.configs or guild_id in self._raw_configs
+
+    def drop_conf(self, guild_id: int) -> None:
+        self.configs.pop(guild_id, None)
+        self._raw_configs.pop(guild_id, None)
+
+    def clear_configs(self) -> None:
+        self.configs.clear()
+        self._raw_configs.clear()
+
+    def load_all(self) -> None:
+        for gid in list(self._raw_configs):
+            self.get_conf(gid)
 
     def get_conf(self, guild: Union[discord.Guild, int]) -> GuildSettings:
         gid = guild if isinstance(guild, int) else guild.id
-        return self.configs.setdefault(gid, GuildSettings())
+        conf = self.configs.get(gid)
+        if conf is None:
+            # Raw settings are only dropped once loaded so a load running in a thread can't be mistaken for a new guild
+            raw = self._raw_configs.get(gid)
+            if raw is None:
+                conf = GuildSettings()
+            elif self._conf_loader is not None:
+                conf = self._conf_loader(gid, raw)
+            else:
+                conf = GuildSettings.model_validate(raw)
+            conf = self.configs.setdefault(gid, conf)
+            self._raw_configs.pop(gid, None)
+        return conf
+
+    async def load_conf(self, guild: Union[discord.Guild, int]) -> GuildSettings:
+        """Same as get_conf but a deferred guild is loaded in a thread instead of blocking the event loop"""
+        gid = guild if isinstance(guild, int) else guild.id
+        if gid not in self.configs and gid in self._raw_configs:
+            return await asyncio.to_thread(self.get_conf, gid)
+        return self.get_conf(gid)
 
     def get_conversation(
         self,
@@ -386,27 +552,27 @@ class DB(AssistantBaseModel):
             Tuple[List[dict], Dict[str, Callable]]: List of json function schemas and a dict mapping to their callables
         """
 
-        async def can_use(perm_level: str) -> bool:
+        async def check(perm_level: str) -> bool:
             if perm_level == "user":
                 return True
             if member is None:
                 return False
             if perm_level == "mod":
-                perms = [
-                    member.guild_permissions.manage_messages,
-                    await bot.is_mod(member),
-                ]
-                return any(perms)
+                return member.guild_permissions.manage_messages or await bot.is_mod(member)
             if perm_level == "admin":
-                perms = [
-                    member.guild_permissions.administrator,
-                    await bot.is_admin(member),
-                ]
-                return any(perms)
+                return member.guild_permissions.administrator or await bot.is_admin(member)
             if perm_level == "owner":
                 return await bot.is_owner(member)
             return False
 
+        # Each permission level only needs checking once for the member
+        checked: Dict[str, bool] = {}
+
+        async def can_use(perm_level: str) -> bool:
+            if perm_level not in checked:
+                checked[perm_level] = await check(perm_level)
+            return checked[perm_level]
+
         function_calls = []
         function_map = {}
 
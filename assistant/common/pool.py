@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+from contextlib import suppress
+from multiprocessing.pool import Pool
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import psutil
+
+log = logging.getLogger("red.vrt.assistant.pool")
+
+# Workers used when no size is configured, the pool only sandboxes risky regex patterns
+DEFAULT_WORKERS = 2
+# Seconds without use before the workers are shut down
+IDLE_TIMEOUT = 600
+# Tasks a worker runs before it's replaced, keeps long lived workers from bloating
+MAX_TASKS_PER_CHILD = 100
+
+
+def default_size() -> int:
+    return min(DEFAULT_WORKERS, os.cpu_count() or 1)
+
+
+class WorkerPool:
+    """Process pool that's only started when something needs it
+
+    Idle workers are shut down after `IDLE_TIMEOUT` seconds and started again on next use.
+    A pool with a worker stuck on a runaway task can be recycled so the next caller gets a fresh one,
+    the old pool keeps running until the other tasks sent to it are done.
+    """
+
+    def __init__(self, size: int = 0, idle_timeout: float = IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.pool: Optional[Pool] = None
+        self.started = 0.0
+        self.last_used = 0.0
+        self.recycled = 0
+        self.pending = 0
+        # Unresolved futures of every pool that's running, keyed by pool
+        self.tasks: Dict[Pool, Set[asyncio.Future]] = {}
+        # Recycled pools waiting for their remaining tasks before they're shut down
+        self.retiring: Set[Pool] = set()
+        self.reaper: Optional[asyncio.TimerHandle] = None
+        self.closing: List[asyncio.Task] = []
+
+    @property
+    def workers(self) -> int:
+        return self.size or default_size()
+
+    @property
+    def running(self) -> bool:
+        return self.pool is not None
+
+    def get(self) -> Pool:
+        """The process pool, started if it isn't running"""
+        if self.pool is None:
+            self.pool = Pool(processes=self.workers, maxtasksperchild=MAX_TASKS_PER_CHILD)
+            self.started = monotonic()
+            log.debug(f"Started process pool with {self.workers} workers")
+        self.last_used = monotonic()
+        self._schedule_reap()
+        return self.pool
+
+    def apply(self, func: Callable, *args: Any) -> asyncio.Future:
+        """Run a function in a worker, the returned future resolves without tying up a thread"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(result: Any, error: bool = False):
+            # Called from the pool's result handler thread
+            def _set():
+                if future.done():
+                    return
+                if error:
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+            with suppress(RuntimeError):  # Loop already closed
+                loop.call_soon_threadsafe(_set)
+
+        pool = self.get()
+        self.pending += 1
+        self.tasks.setdefault(pool, set()).add(future)
+        future.add_done_callback(lambda f: self._done(pool, f))
+        pool.apply_async(
+            func,
+            args=args,
+            callback=resolve,
+            error_callback=lambda e: resolve(e, error=True),
+        )
+        return future
+
+    def _done(self, pool: Pool, future: asyncio.Future):
+        self.pending -= 1
+        self.last_used = monotonic()
+        tasks = self.tasks.get(pool)
+        if tasks is None:
+            return
+        tasks.discard(future)
+        if not tasks and pool in self.retiring:
+            self.retiring.discard(pool)
+            self._discard(pool)
+
+    def resize(self, size: int):
+        """Change the worker count, a running pool is replaced on next use"""
+        if size == self.size:
+            return
+        self.size = size
+        self.recycle()
+
+    def recycle(self):
+        """Start a new pool on the next `get`, the current one is shut down once its other tasks are done
+
+        Terminating it right away would kill every other caller's task along with the stuck one.
+        """
+        if self.pool is None:
+            return
+        self.recycled += 1
+        pool, self.pool = self.pool, None
+        # A caller that gave up on its task has already cancelled the future
+        if any(not f.done() for f in self.tasks.get(pool, ())):
+            self.retiring.add(pool)
+        else:
+            self._discard(pool)
+
+    async def close(self):
+        """Shut the pool down without blocking the event loop"""
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        pools = list(self.retiring) + ([self.pool] if self.pool is not None else [])
+        self.pool = None
+        self.retiring.clear()
+        self.tasks.clear()
+        for pool in pools:
+            await self._shutdown(pool)
+        if self.closing:
+            await asyncio.gather(*self.closing, return_exceptions=True)
+
+    def _schedule_reap(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+        with suppress(RuntimeError):  # No running loop
+            self.reaper = asyncio.get_running_loop().call_later(self.idle_timeout, self._reap)
+
+    def _reap(self):
+        self.reaper = None
+        if self.pool is None:
+            return
+        if self.pending or monotonic() - self.last_used < self.idle_timeout:
+            self._schedule_reap()
+            return
+        log.debug("Shutting down idle process pool")
+        pool, self.pool = self.pool, None
+        self._discard(pool)
+
+    def _discard(self, pool: Pool):
+        self.tasks.pop(pool, None)
+        task = asyncio.create_task(self._shutdown(pool))
+        self.closing.append(task)
+        task.add_done_callback(self.closing.remove)
+
+    @staticmethod
+    async def _shutdown(pool: Pool):
+        # terminate instead of close since a worker may be stuck on a pattern that never finishes
+        # terminate blocks while it joins the pool's handler threads and kills the workers, so both run in a thread
+        def _stop():
+            pool.terminate()
+            pool.join()
+
+        await asyncio.to_thread(_stop)
+
+    def worker_memory(self) -> List[Tuple[int, Optional[int]]]:
+        """(pid, RSS bytes) of each worker, RSS is None if the process couldn't be read"""
+        if self.pool is None:
+            return []
+        usage = []
+        # Pool doesn't expose its processes publicly
+        for process in list(getattr(self.pool, "_pool", [])):
+            try:
+                usage.append((process.pid, psutil.Process(process.pid).memory_info().rss))
+            except (psutil.Error, TypeError):
+                usage.append((process.pid, None))
+        return usage
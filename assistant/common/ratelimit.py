@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import re
+from time import monotonic
+from typing import Dict, Mapping, Optional, Tuple
+
+import openai
+
+log = logging.getLogger("red.vrt.assistant.ratelimit")
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds from a rate limit reset header like `6m0s` or `20ms`"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = DURATION.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * UNITS[unit] for amount, unit in matches)
+
+
+def parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Budget:
+    """Per minute allowance refilled continuously, unlimited until a limit is learned"""
+
+    def __init__(self):
+        self.limit: Optional[int] = None
+        self.available = 0.0
+        self.updated = monotonic()
+
+    def refill(self, now: float):
+        if self.limit:
+            self.available = min(self.limit, self.available + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait(self, amount: int, now: float) -> float:
+        """Seconds until `amount` is available"""
+        if not self.limit:
+            return 0.0
+        self.refill(now)
+        amount = min(amount, self.limit)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60 / self.limit
+
+    def take(self, amount: int):
+        if self.limit:
+            self.available -= min(amount, self.limit)
+
+    def sync(self, limit: Optional[int], remaining: Optional[int]):
+        if not limit:
+            return
+        self.limit = limit
+        if remaining is not None:
+            self.available = float(remaining)
+            self.updated = monotonic()
+
+
+class RateLimiter:
+    """Client side request and token budgets for one API key and model
+
+    Budgets are learned from the `x-ratelimit-*` headers OpenAI sends with every response.
+    Requests queue up in order and wait for capacity instead of being sent into a 429.
+    Endpoints that don't send the headers are never throttled.
+    """
+
+    def __init__(self):
+        self.requests = Budget()
+        self.tokens = Budget()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+        self.queued = 0
+        self.calls = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.worst_wait = 0.0
+        self.limited = 0
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.calls if self.calls else 0.0
+
+    async def acquire(self, tokens: int = 0) -> float:
+        """Wait for room to send a request using roughly `tokens` tokens
+
+        Returns:
+            float: seconds spent waiting
+        """
+        start = monotonic()
+        self.queued += 1
+        try:
+            async with self.lock:
+                while True:
+                    now = monotonic()
+                    delay = max(
+                        self.blocked_until - now,
+                        self.requests.wait(1, now),
+                        self.tokens.wait(tokens, now),
+                    )
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+        finally:
+            self.queued -= 1
+        waited = monotonic() - start
+        self.calls += 1
+        self.total_wait += waited
+        self.worst_wait = max(self.worst_wait, waited)
+        if waited > 0.01:
+            self.waits += 1
+        return waited
+
+    def update(self, headers: Mapping[str, str]):
+        """Sync the budgets with the limits the API reported"""
+        self.requests.sync(
+            parse_int(headers.get("x-ratelimit-limit-requests")),
+            parse_int(headers.get("x-ratelimit-remaining-requests")),
+        )
+        self.tokens.sync(
+            parse_int(headers.get("x-ratelimit-limit-tokens")),
+            parse_int(headers.get("x-ratelimit-remaining-tokens")),
+        )
+
+    def penalize(self, error: openai.RateLimitError):
+        """Hold every queued request until the API says the limit has reset"""
+        self.limited += 1
+        headers = error.response.headers if error.response is not None else {}
+        self.update(headers)
+        delay = parse_duration(headers.get("retry-after")) or max(
+            parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+            parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0,
+        )
+        self.blocked_until = max(self.blocked_until, monotonic() + (delay or 1))
+        log.debug(f"Rate limited, holding requests for {delay or 1}s")
+
+
+# {(api_key, base_url, model): limiter}
+_limiters: Dict[Tuple[str, Optional[str], str], RateLimiter] = {}
+
+
+def get_limiter(api_key: str, base_url: Optional[str], model: str) -> RateLimiter:
+    """Limiter for a key, OpenAI rate limits are tracked per model so each gets its own budgets"""
+    key = (api_key, base_url, model)
+    if key not in _limiters:
+        _limiters[key] = RateLimiter()
+    return _limiters[key]
+
+
+def limiters() -> Dict[Tuple[str, Optional[str], str], RateLimiter]:
+    return _limiters
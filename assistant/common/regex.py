@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import re
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+from .pool import WorkerPool
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+log = logging.getLogger("red.vrt.assistant.regex")
+
+# Seconds a sandboxed pattern gets before it's abandoned
+REGEX_TIMEOUT = 2
+# Two unbounded quantifiers over overlapping characters (`a*a*b`) already backtrack cubically on long replies
+MAX_UNBOUNDED = 1
+# Bounded quantifiers allowing more repeats than this backtrack like unbounded ones
+MAX_REPEAT = 16
+# Ways a match can be split between bounded quantifiers (`[a-z]{1,16}` twice is 256) before a pattern is risky,
+# alongside an unbounded quantifier the limit is MAX_REPEAT since each split is tried at every position it could end
+MAX_COMBINATIONS = 256
+# Any quantifier can backtrack at least quadratically over a reply, longer replies go to the sandbox
+INLINE_CHARS = 2000
+
+
+class Risky(Exception):
+    pass
+
+
+def _scan(items) -> Tuple[int, int, int, int]:
+    """Walk a parsed pattern, returns (unbounded quantifiers, quantifiers, alternations, bounded combinations)
+
+    Bounded combinations is how many ways a match can be split between the bounded quantifiers.
+    """
+    unbounded = repeats = branches = 0
+    combinations = 1
+    for op, av in items:
+        name = str(op)
+        subs = []
+        if name.startswith("GROUPREF"):
+            raise Risky("backreference")
+        elif name in ("MAX_REPEAT", "MIN_REPEAT"):
+            low, high, sub = av
+            inner = _scan(sub)
+            # Bounds don't make this safe, `(?:a{1,16}){1,16}` still has 16**16 ways to split a match
+            if inner[1] or inner[2]:
+                raise Risky("quantified group containing alternation or quantifiers")
+            repeats += 1
+            if high == sre_constants.MAXREPEAT or high > MAX_REPEAT:
+                unbounded += 1
+            else:
+                combinations *= high - low + 1
+            continue
+        elif name == "POSSESSIVE_REPEAT":
+            # Possessive quantifiers never give back what they matched
+            repeats += 1
+            subs = [av[2]]
+        elif name == "SUBPATTERN":
+            subs = [av[-1]]
+        elif name in ("ASSERT", "ASSERT_NOT"):
+            subs = [av[1]]
+        elif name == "ATOMIC_GROUP":
+            subs = [av]
+        elif name == "BRANCH":
+            # Each alternative gets tried, so their combinations add up instead of multiplying
+            scanned = [_scan(sub) for sub in av[1]]
+            unbounded += sum(i[0] for i in scanned)
+            repeats += sum(i[1] for i in scanned)
+            branches += 1 + sum(i[2] for i in scanned)
+            combinations *= sum(i[3] for i in scanned)
+            continue
+        for sub in subs:
+            inner = _scan(sub)
+            unbounded += inner[0]
+            repeats += inner[1]
+            branches += inner[2]
+            combinations *= inner[3]
+    return unbounded, repeats, branches, combinations
+
+
+def analyze(pattern: str) -> Tuple[Optional[str], int]:
+    """Check a pattern for catastrophic backtracking
+
+    Only patterns with at most one unbounded quantifier (at worst quadratic), no quantified groups holding
+    alternations or quantifiers and few ways to split a match between bounded quantifiers pass,
+    anything the check can't vouch for is treated as risky.
+
+    Returns:
+        Tuple[Optional[str], int]: why the pattern is risky or None if it's safe to run in-process,
+            and how many quantifiers it has
+    """
+    try:
+        unbounded, repeats, __, combinations = _scan(sre_parse.parse(pattern))
+    except Risky as e:
+        return str(e), 0
+    except Exception:
+        return "could not be analyzed", 0
+    if unbounded > MAX_UNBOUNDED:
+        return f"{unbounded} unbounded quantifiers", repeats
+    if combinations > (MAX_REPEAT if unbounded else MAX_COMBINATIONS):
+        return f"{combinations} ways to split a match between bounded quantifiers", repeats
+    return None, repeats
+
+
+def _looks_ahead(items) -> bool:
+    """Whether a parsed pattern has a positive lookahead, which can need text past the end of its match"""
+    for op, av in items:
+        name = str(op)
+        if name == "ASSERT" and av[0] == 1:
+            return True
+        if name in ("MAX_REPEAT", "MIN_REPEAT", "POSSESSIVE_REPEAT"):
+            subs = [av[2]]
+        elif name == "SUBPATTERN":
+            subs = [av[-1]]
+        elif name in ("ASSERT", "ASSERT_NOT"):
+            subs = [av[1]]
+        elif name == "ATOMIC_GROUP":
+            subs = [av]
+        elif name == "BRANCH":
+            subs = av[1]
+        else:
+            continue
+        if any(_looks_ahead(sub) for sub in subs):
+            return True
+    return False
+
+
+def max_width(pattern: str) -> Optional[int]:
+    """Most characters at the end of a partial text that a match could still grow from, None if there's no limit
+
+    That's the longest match plus one for assertions like `\\B` that peek at the next character.
+    """
+    try:
+        parsed = sre_parse.parse(pattern)
+        __, high = parsed.getwidth()
+    except Exception:
+        return None
+    if high >= sre_constants.MAXREPEAT - 1 or _looks_ahead(parsed):
+        return None
+    return high + 1
+
+
+class BlacklistPattern:
+    """A compiled regex blacklist entry and its timing stats"""
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.compiled = re.compile(pattern)
+        self.risk, self.repeats = analyze(pattern)
+        self.width = max_width(pattern)
+
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.timeouts = 0
+
+    @property
+    def sandboxed(self) -> bool:
+        return self.risk is not None
+
+    def inline(self, content: str) -> bool:
+        """Whether the pattern can run in-process on this content"""
+        return not self.sandboxed and (not self.repeats or len(content) <= INLINE_CHARS)
+
+    @property
+    def average(self) -> float:
+        return self.total / self.calls if self.calls else 0.0
+
+    def record(self, elapsed: float):
+        self.calls += 1
+        self.total += elapsed
+        self.worst = max(self.worst, elapsed)
+
+
+class RegexEngine:
+    """Compiles each guild's regex blacklist once and applies it to replies
+
+    Patterns that pass `analyze` run in-process, risky ones (and ones with any quantifier on long
+    replies) run in the worker pool so a runaway pattern can be abandoned after `REGEX_TIMEOUT` seconds.
+    """
+
+    def __init__(self, timeout: float = REGEX_TIMEOUT):
+        self.timeout = timeout
+        # {guild_id: (source patterns, compiled patterns)}
+        self.guilds: Dict[int, Tuple[Tuple[str, ...], List[BlacklistPattern]]] = {}
+
+    def get(self, guild_id: int, patterns: List[str]) -> List[BlacklistPattern]:
+        """Compiled patterns for a guild, recompiled only if its blacklist changed"""
+        cached = self.guilds.get(guild_id)
+        if cached is not None and cached[0] == tuple(patterns):
+            return cached[1]
+        return self.set(guild_id, patterns)
+
+    def set(self, guild_id: int, patterns: List[str]) -> List[BlacklistPattern]:
+        """Compile a guild's blacklist, keeping stats for patterns that didn't change"""
+        previous = {i.pattern: i for i in self.guilds.get(guild_id, ((), []))[1]}
+        compiled = []
+        for pattern in patterns:
+            if pattern in previous:
+                compiled.append(previous[pattern])
+                continue
+            try:
+                entry = BlacklistPattern(pattern)
+            except re.error as e:
+                log.error(f"Skipping invalid blacklist regex {pattern} in guild {guild_id}", exc_info=e)
+                continue
+            if entry.sandboxed:
+                log.debug(f"Blacklist regex {pattern} in guild {guild_id} will be sandboxed: {entry.risk}")
+            compiled.append(entry)
+        self.guilds[guild_id] = (tuple(patterns), compiled)
+        return compiled
+
+    async def sub(self, entry: BlacklistPattern, content: str, workers: WorkerPool) -> str:
+        """Remove a pattern's matches from the content
+
+        Raises:
+            asyncio.TimeoutError: if a sandboxed pattern didn't finish in time
+        """
+        start = perf_counter()
+        if entry.inline(content):
+            subbed = entry.compiled.sub("", content)
+            entry.record(perf_counter() - start)
+            return subbed
+
+        try:
+            subbed = await asyncio.wait_for(workers.apply(re.sub, entry.pattern, "", content), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            entry.timeouts += 1
+            entry.record(perf_counter() - start)
+            # The worker is still stuck on the pattern, replace the pool so it doesn't hold a worker forever
+            workers.recycle()
+            raise
+        entry.record(perf_counter() - start)
+        return subbed
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Deque, Dict, Optional
+
+log = logging.getLogger("red.vrt.assistant.scheduler")
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of queued"""
+
+
+class GuildQueue:
+    def __init__(self):
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.active = 0
+        self.weight = 1
+        # Virtual time of the guild's next turn, advances by 1/weight per request served
+        self.vtime = 0.0
+
+        self.served = 0
+        self.shed = 0
+        self.total_wait = 0.0
+
+
+class FairScheduler:
+    """Admits chat requests under global and per guild concurrency caps
+
+    Waiting requests are served by weighted fair queuing across guilds, a guild with weight 2
+    gets twice the turns of a guild with weight 1 while both have requests waiting.
+    Requests are shed with `Overloaded` once a guild's queue is full or a request waited too long.
+    """
+
+    def __init__(self, max_active: int, max_per_guild: int, max_queued: int, max_wait: float):
+        self.max_active = max_active
+        self.max_per_guild = max_per_guild
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+
+        self.guilds: Dict[int, GuildQueue] = {}
+        self.active = 0
+        self.vtime = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q.waiters) for q in self.guilds.values())
+
+    def configure(self, max_active: int, max_per_guild: int, max_queued: int, max_wait: float):
+        self.max_active = max_active
+        self.max_per_guild = max_per_guild
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, guild_id: int, weight: int = 1) -> AsyncIterator[None]:
+        """Hold one of the guild's slots for the duration of a request
+
+        Raises:
+            Overloaded: if the request was shed
+        """
+        await self.acquire(guild_id, weight)
+        try:
+            yield
+        finally:
+            self.release(guild_id)
+
+    async def acquire(self, guild_id: int, weight: int = 1):
+        queue = self.guilds.setdefault(guild_id, GuildQueue())
+        queue.weight = max(1, weight)
+        if not queue.waiters and self._has_room(queue):
+            self._grant(queue)
+            return
+        if len(queue.waiters) >= self.max_queued:
+            queue.shed += 1
+            raise Overloaded
+
+        start = monotonic()
+        future = asyncio.get_running_loop().create_future()
+        queue.waiters.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_wait or None)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted right as the wait ran out
+                queue.total_wait += monotonic() - start
+                return
+            future.cancel()
+            self._forget(queue, future)
+            queue.shed += 1
+            raise Overloaded
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was granted but the caller is gone, hand it to someone else
+                self.release(guild_id)
+            else:
+                future.cancel()
+                self._forget(queue, future)
+            raise
+        queue.total_wait += monotonic() - start
+
+    def release(self, guild_id: int):
+        queue = self.guilds[guild_id]
+        queue.active -= 1
+        self.active -= 1
+        self._dispatch()
+
+    def _has_room(self, queue: GuildQueue) -> bool:
+        return self.active < self.max_active and queue.active < self.max_per_guild
+
+    def _grant(self, queue: GuildQueue):
+        queue.active += 1
+        queue.served += 1
+        self.active += 1
+        # An idle guild can't bank turns, it starts from the current virtual time
+        start = max(queue.vtime, self.vtime)
+        self.vtime = start
+        queue.vtime = start + 1 / queue.weight
+
+    def _dispatch(self):
+        while self.active < self.max_active:
+            ready = [q for q in self.guilds.values() if q.waiters and q.active < self.max_per_guild]
+            if not ready:
+                return
+            queue = min(ready, key=lambda q: q.vtime)
+            future = queue.waiters.popleft()
+            if future.done():
+                continue
+            self._grant(queue)
+            future.set_result(None)
+
+    @staticmethod
+    def _forget(queue: GuildQueue, future: asyncio.Future):
+        try:
+            queue.waiters.remove(future)
+        except ValueError:
+            pass
+
+    def stats(self, guild_id: int) -> Optional[GuildQueue]:
+        return self.guilds.get(guild_id)
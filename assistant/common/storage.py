@@ -0,0 +1,282 @@
+import logging
+import os
+import shutil
+from contextlib import suppress
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, Iterable, List, Tuple
+
+import msgpack
+import numpy as np
+import orjson
+
+from .models import DB, Embedding, GuildSettings
+from .vectors import Vector
+
+log = logging.getLogger("red.vrt.assistant.storage")
+
+STORE_VERSION = 1
+# DB fields whose entries are persisted individually, everything else is written as a top level key
+COLLECTIONS = ("configs", "conversations", "functions")
+
+
+class EmbeddingStore:
+    """Binary sidecar storage for embeddings, kept out of Red's Config
+
+    Each guild gets its own folder in the cog's data path containing:
+    - `meta.msgpack`: entry names, text and metadata, plus where each vector lives
+    - `vectors_<dim>_<dtype>_<gen>.npy`: one matrix per dimension/dtype
+
+    Matrices are loaded memory-mapped so vectors are paged in by the OS instead of parsed.
+    Every write goes to a new generation of files and the metadata is swapped in atomically,
+    the old generation is removed afterwards (or on next load if it was still mapped).
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        # {guild_id: signature of the embeddings at the time they were last written/loaded}
+        self.signatures: Dict[int, Tuple[int, Tuple[Vector, ...]]] = {}
+
+    def guild_dir(self, guild_id: int) -> Path:
+        return self.root / str(guild_id)
+
+    @staticmethod
+    def signature(embeddings: Dict[str, Embedding]) -> Tuple[int, Tuple[Vector, ...]]:
+        """Hash of the entries plus the vectors themselves
+
+        The vectors are hashed by id, keeping them referenced stops a replaced vector's address from being
+        reused by a new one, which would make an edited entry look unchanged.
+        """
+        vectors = tuple(em.embedding for em in embeddings.values())
+        digest = hash(
+            tuple(
+                (name, id(em.embedding), em.text, em.model, em.ai_created, em.created, em.modified)
+                for name, em in embeddings.items()
+            )
+        )
+        return digest, vectors
+
+    def stored_guilds(self) -> List[int]:
+        if not self.root.exists():
+            return []
+        return [int(i.name) for i in self.root.iterdir() if i.is_dir() and i.name.isdigit()]
+
+    def load(self, guild_id: int) -> Dict[str, Embedding]:
+        """Load a guild's embeddings with their vectors memory-mapped"""
+        folder = self.guild_dir(guild_id)
+        meta_path = folder / "meta.msgpack"
+        if not meta_path.exists():
+            return {}
+        meta = msgpack.unpackb(meta_path.read_bytes(), strict_map_key=False)
+        self._remove_stale(folder, meta["files"].values())
+
+        matrices: Dict[str, np.ndarray] = {}
+        for key, filename in meta["files"].items():
+            # asarray drops the memmap subclass but keeps the mapping
+            matrices[key] = np.asarray(np.load(folder / filename, mmap_mode="r"))
+
+        embeddings = {}
+        converted = False
+        for name, (text, ai_created, created, modified, model, key, row, scale) in meta["entries"].items():
+            vector = Vector(matrices[key][row], scale)
+            if vector.dtype != Vector.precision:
+                # Stored before the precision was changed
+                vector = Vector.from_values(vector)
+                converted = True
+            embeddings[name] = Embedding(
+                text=text,
+                embedding=vector,
+                ai_created=ai_created,
+                created=datetime.fromtimestamp(created, tz=timezone.utc),
+                modified=datetime.fromtimestamp(modified, tz=timezone.utc),
+                model=model,
+            )
+        if converted:
+            # Leave it unsigned so the next save rewrites it in the new precision
+            self.signatures.pop(guild_id, None)
+        else:
+            self.signatures[guild_id] = self.signature(embeddings)
+        return embeddings
+
+    def save(self, guild_id: int, embeddings: Dict[str, Embedding]) -> bool:
+        """Write a guild's embeddings if they changed since the last save/load
+
+        Returns:
+            bool: whether anything was written
+        """
+        signature = self.signature(embeddings)
+        if self.signatures.get(guild_id) == signature:
+            return False
+        if not embeddings:
+            existed = self.guild_dir(guild_id).exists()
+            self.delete(guild_id)
+            self.signatures[guild_id] = signature
+            return existed
+
+        folder = self.guild_dir(guild_id)
+        folder.mkdir(parents=True, exist_ok=True)
+        meta_path = folder / "meta.msgpack"
+        generation = 0
+        if meta_path.exists():
+            with suppress(Exception):
+                generation = msgpack.unpackb(meta_path.read_bytes(), strict_map_key=False)["generation"] + 1
+
+        groups: Dict[str, List[np.ndarray]] = {}
+        entries: Dict[str, Tuple] = {}
+        for name, em in embeddings.items():
+            vector = em.embedding
+            key = f"{len(vector)}_{vector.dtype}"
+            rows = groups.setdefault(key, [])
+            entries[name] = (
+                em.text,
+                em.ai_created,
+                em.created.timestamp(),
+                em.modified.timestamp(),
+                em.model,
+                key,
+                len(rows),
+                vector.scale,
+            )
+            rows.append(vector.data)
+
+        files = {}
+        for key, rows in groups.items():
+            filename = f"vectors_{key}_{generation}.npy"
+            tmp = folder / f"{filename}.tmp"
+            with tmp.open("wb") as f:
+                np.save(f, np.stack(rows))
+            os.replace(tmp, folder / filename)
+            files[key] = filename
+
+        meta = {"version": STORE_VERSION, "generation": generation, "files": files, "entries": entries}
+        tmp = folder / "meta.msgpack.tmp"
+        tmp.write_bytes(msgpack.packb(meta))
+        os.replace(tmp, meta_path)
+
+        self._remove_stale(folder, files.values())
+        self.signatures[guild_id] = signature
+        return True
+
+    def save_all(self, configs: Dict[int, GuildSettings], guild_ids: Iterable[int]) -> int:
+        """Write every loaded guild with changed embeddings and remove data for guilds that no longer exist
+
+        Args:
+            configs (Dict[int, GuildSettings]): loaded guild settings
+            guild_ids (Iterable[int]): every guild that still has settings, loaded or not
+
+        Returns:
+            int: amount of guilds written
+        """
+        start = perf_counter()
+        written = 0
+        for guild_id, conf in list(configs.items()):
+            written += self.save(guild_id, conf.embeddings)
+        guild_ids = set(guild_ids)
+        for guild_id in self.stored_guilds():
+            if guild_id not in guild_ids:
+                self.delete(guild_id)
+        if written:
+            log.debug(f"Saved embeddings for {written} guild(s) in {round((perf_counter() - start) * 1000, 2)}ms")
+        return written
+
+    def delete(self, guild_id: int):
+        self.signatures.pop(guild_id, None)
+        folder = self.guild_dir(guild_id)
+        if folder.exists():
+            shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    def _remove_stale(folder: Path, keep):
+        keep = set(keep)
+        for path in folder.glob("vectors_*.npy*"):
+            if path.name not in keep:
+                # Windows won't delete a file that is still mapped, it'll get picked up next time
+                with suppress(OSError):
+                    path.unlink()
+
+
+class ConfigSnapshot:
+    """Last written state of every entry in Config, used to only write what actually changed
+
+    Guild settings, conversations and custom functions are each their own entry keyed by
+    `(collection, key)`, remaining DB fields are keyed by `(field,)`. Only objects flagged as
+    dirty get re-serialized, and they're only written if their dump differs from the last write.
+    """
+
+    def __init__(self):
+        # {path: (digest, value)}
+        self.entries: Dict[Tuple[str, ...], Tuple[int, Any]] = {}
+
+    @staticmethod
+    def digest(value: Any) -> int:
+        return hash(orjson.dumps(value, option=orjson.OPT_SORT_KEYS))
+
+    def load(self, data: dict):
+        """Baseline from the raw data as it currently sits in Config"""
+        self.entries.clear()
+        for key, value in data.items():
+            if key in COLLECTIONS and isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    self.entries[(key, str(sub_key))] = (self.digest(sub_value), sub_value)
+            else:
+                self.entries[(key,)] = (self.digest(value), value)
+
+    def diff(self, db: DB, exclude: dict) -> Tuple[Dict[Tuple[str, ...], Any], List[Tuple[str, ...]]]:
+        """Serialize whatever may have changed and compare it against the last write
+
+        Args:
+            db (DB): the live DB
+            exclude (dict): model_dump exclusions for guild settings
+
+        Returns:
+            Tuple[Dict[Tuple[str, ...], Any], List[Tuple[str, ...]]]: changed entries and removed paths.
+            The snapshot is updated to the new state.
+        """
+        changed: Dict[Tuple[str, ...], Any] = {}
+        # Guilds that were never loaded are still exactly as they sit in Config
+        current = {("configs", str(guild_id)) for guild_id in db.deferred_configs()}
+
+        collections = {
+            "configs": (db.configs, exclude),
+            "conversations": (db.conversations, None),
+            "functions": (db.functions, None),
+        }
+        for collection, (items, item_exclude) in collections.items():
+            for key, obj in list(items.items()):
+                path = (collection, str(key))
+                current.add(path)
+                if not obj.is_dirty and path in self.entries:
+                    continue
+                obj.mark_clean()
+                value = obj.model_dump(exclude=item_exclude)
+                digest = self.digest(value)
+                if self.entries.get(path, (None,))[0] != digest:
+                    self.entries[path] = (digest, value)
+                    changed[path] = value
+
+        top = db.model_dump(exclude=set(COLLECTIONS))
+        for key, value in top.items():
+            path = (key,)
+            current.add(path)
+            digest = self.digest(value)
+            if self.entries.get(path, (None,))[0] != digest:
+                self.entries[path] = (digest, value)
+                changed[path] = value
+
+        removed = [path for path in self.entries if path not in current]
+        for path in removed:
+            del self.entries[path]
+        return changed, removed
+
+    def assemble(self, db: DB) -> dict:
+        """Full Config dump built from the snapshot without re-serializing anything"""
+        data = {}
+        for path, (__, value) in self.entries.items():
+            if len(path) == 1:
+                data[path[0]] = value
+            else:
+                data.setdefault(path[0], {})[path[1]] = value
+        for guild_id, raw in db.deferred_configs().items():
+            data.setdefault("configs", {}).setdefault(str(guild_id), raw)
+        return data
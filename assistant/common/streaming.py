@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from contextlib import suppress
+from time import monotonic
+from typing import Awaitable, Callable, List, Optional
+
+import discord
+from redbot.core.utils.chat_formatting import pagify
+
+log = logging.getLogger("red.vrt.assistant.streaming")
+
+# Minimum seconds between edits, Discord allows roughly 5 edits per 5 seconds per channel
+EDIT_INTERVAL = 1.5
+DELIMS = ("```", "\n")
+
+
+def reply_pages(content: str, embed_perms: bool) -> List[dict]:
+    """Split a reply into message payloads
+
+    Up to 2000 characters goes in the message content, up to 4000 in a single embed,
+    anything longer is split across multiple embeds (or messages without embed perms)
+    """
+    if len(content) <= 2000:
+        return [{"content": content, "embed": None}]
+    if len(content) <= 4000 and embed_perms:
+        return [{"content": None, "embed": discord.Embed(description=content)}]
+    if embed_perms:
+        return [
+            {"content": None, "embed": discord.Embed(description=p)}
+            for p in pagify(content, page_length=3950, delims=DELIMS)
+        ]
+    return [{"content": p, "embed": None} for p in pagify(content, page_length=2000, delims=DELIMS)]
+
+
+class StreamedReply:
+    """Reply that is posted as soon as content starts arriving and edited as more of it streams in
+
+    Edits are throttled to one every `EDIT_INTERVAL` seconds, updates in between only replace the
+    pending text. Once the reply outgrows a message it continues in new ones, split the same way
+    `send_reply` splits a finished reply.
+
+    A transform (the regex blacklist) is applied to the partial text before each flush, if it returns None
+    the reply is held back until `finish` shows the final text.
+    """
+
+    def __init__(
+        self,
+        message: discord.Message,
+        mention: bool,
+        interval: float = EDIT_INTERVAL,
+        transform: Optional[Callable[[str], Awaitable[Optional[str]]]] = None,
+    ):
+        self.message = message
+        self.mention = mention
+        self.interval = interval
+        self.transform = transform
+        self.embed_perms = message.channel.permissions_for(message.guild.me).embed_links
+
+        self.text = ""
+        self.messages: List[discord.Message] = []
+        # Last payload sent for each message, to skip edits that wouldn't change anything
+        self.sent: List[dict] = []
+        self.last_flush = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+        # Final text is already transformed, held means the transform refused the partial text
+        self.final = False
+        self.held = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self.messages)
+
+    async def update(self, text: str):
+        """Set the reply so far, it'll be shown on the next flush"""
+        self.text = text
+        if not text.strip() or self.held:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._flush_later())
+
+    async def finish(self, text: str):
+        """Show the final reply, removing any leftover messages if it ended up shorter"""
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self.task
+        self.text = text
+        self.final = True
+        await self.flush()
+        async with self.lock:
+            pages = len(reply_pages(self.text, self.embed_perms)) if self.text.strip() else 0
+            for message in self.messages[pages:]:
+                with suppress(discord.HTTPException):
+                    await message.delete()
+            del self.messages[pages:]
+            del self.sent[pages:]
+
+    async def _flush_later(self):
+        wait = self.interval - (monotonic() - self.last_flush)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            text = self.text
+            if self.transform is not None and not self.final:
+                if self.held:
+                    return
+                text = await self.transform(text)
+                if text is None:
+                    self.held = True
+                    return
+            if not text.strip():
+                return
+            for index, page in enumerate(reply_pages(text, self.embed_perms)):
+                try:
+                    if index < len(self.messages):
+                        if self._same(self.sent[index], page):
+                            continue
+                        await self.messages[index].edit(**page)
+                        self.sent[index] = page
+                    else:
+                        self.messages.append(await self._send(page, first=index == 0))
+                        self.sent.append(page)
+                except discord.HTTPException as e:
+                    log.warning("Failed to update streamed reply", exc_info=e)
+                    break
+            self.last_flush = monotonic()
+
+    async def _send(self, page: dict, first: bool) -> discord.Message:
+        if first:
+            try:
+                return await self.message.reply(**page, mention_author=self.mention)
+            except discord.HTTPException:
+                pass
+        return await self.message.channel.send(**page)
+
+    @staticmethod
+    def _same(old: dict, new: dict) -> bool:
+        if old["content"] != new["content"]:
+            return False
+        if (old["embed"] is None) != (new["embed"] is None):
+            return False
+        return old["embed"] is None or old["embed"].description == new["embed"].description
@@ -0,0 +1,27 @@
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+# Recent runs kept for the averages
+WINDOW = 200
+
+
+class StepTimings:
+    """Rolling per-step durations of a multi-step stage, in seconds
+
+    Steps that run concurrently overlap, so `total` is the wall time of the whole stage rather than the sum of its steps.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.steps: Dict[str, Deque[float]] = {}
+        self.totals: Deque[float] = deque(maxlen=window)
+        self.window = window
+
+    def record(self, steps: Dict[str, float], total: float):
+        for step, took in steps.items():
+            self.steps.setdefault(step, deque(maxlen=self.window)).append(took)
+        self.totals.append(total)
+
+    def summary(self) -> List[Tuple[str, float, float, int]]:
+        """(step, average, worst, samples) for each step, the stage's wall time listed first as `total`"""
+        rows = [("total", self.totals)] + sorted(self.steps.items())
+        return [(step, sum(times) / len(times), max(times), len(times)) for step, times in rows if times]
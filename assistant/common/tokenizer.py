@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
+
+import orjson
+import tiktoken
+
+log = logging.getLogger("red.vrt.assistant.tokenizer")
+
+T = TypeVar("T")
+
+FALLBACK_ENCODING = "o200k_base"
+# Below this many characters encoding is cheaper than the thread hop, so it runs inline
+INLINE_CHARS = 2000
+# tiktoken's batch encode spins up its own thread pool, only worth it for big batches
+BATCH_THREADS_MIN = 64
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+_lock = threading.Lock()
+# {(schema digest, (overhead family, encoding)): tokens}
+_function_costs: Dict[Tuple[int, Tuple[str, str]], int] = {}
+# Models already warned about not having known function overheads
+_warned: Set[str] = set()
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Resolve and cache the encoding for a model"""
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+    with _lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding(FALLBACK_ENCODING)
+        return _encodings[model]
+
+
+def warm(models: Iterable[str]) -> None:
+    """Resolve encodings ahead of time so the first chat doesn't pay for loading the BPE files"""
+    for model in models:
+        get_encoding(model)
+    log.debug(f"Tokenizer warmed for {len(_encodings)} models")
+
+
+def encode(text: str, model: str) -> List[int]:
+    return get_encoding(model).encode_ordinary(text)
+
+
+def encode_batch(texts: List[str], model: str) -> List[List[int]]:
+    encoding = get_encoding(model)
+    if len(texts) >= BATCH_THREADS_MIN:
+        return encoding.encode_ordinary_batch(texts)
+    return [encoding.encode_ordinary(text) for text in texts]
+
+
+def encoding_name(model: str) -> str:
+    return get_encoding(model).name
+
+
+def decode(tokens: List[int], model: str) -> str:
+    return get_encoding(model).decode(tokens)
+
+
+def count(text: str, model: str) -> int:
+    if not text:
+        return 0
+    return len(encode(text, model))
+
+
+def count_batch(texts: List[str], model: str) -> List[int]:
+    return [len(tokens) for tokens in encode_batch(texts, model)]
+
+
+def message_fingerprint(message: dict, values: List[str]) -> int:
+    return hash((tuple(message), tuple(values)))
+
+
+def count_messages(messages: List[dict], model: str, cache: Optional[Dict[int, int]] = None) -> List[int]:
+    """Token cost of each message, including the per message overhead
+
+    Args:
+        messages (List[dict]): chat messages
+        model (str): model to count for
+        cache (Optional[Dict[int, int]]): {message fingerprint: tokens} for this model's encoding.
+            Only messages that are new or changed since they were last counted get encoded.
+    """
+    tokens_per_message = 3
+    tokens_per_name = 1
+    costs: List[int] = [0] * len(messages)
+    misses = []  # (index, fingerprint, values)
+    fingerprints = []
+    for idx, message in enumerate(messages):
+        values = [str(value) for value in message.values()]
+        if cache is None:
+            misses.append((idx, None, values))
+            continue
+        fingerprint = message_fingerprint(message, values)
+        fingerprints.append(fingerprint)
+        cost = cache.get(fingerprint)
+        if cost is None:
+            misses.append((idx, fingerprint, values))
+        else:
+            costs[idx] = cost
+
+    if misses:
+        counts = iter(count_batch([text for __, __, values in misses for text in values], model))
+        for idx, fingerprint, values in misses:
+            cost = tokens_per_message + sum(next(counts) for __ in values)
+            if "name" in messages[idx]:
+                cost += tokens_per_name
+            costs[idx] = cost
+            if fingerprint is not None:
+                cache[fingerprint] = cost
+
+    if cache is not None and len(cache) > len(messages) * 2 + 16:
+        # Drop entries for messages that were removed or edited
+        current = set(fingerprints)
+        for fingerprint in [i for i in cache if i not in current]:
+            cache.pop(fingerprint, None)
+    return costs
+
+
+def count_payload(messages: List[dict], model: str, cache: Optional[Dict[int, int]] = None) -> int:
+    """Token count of a list of chat messages"""
+    if not messages:
+        return 0
+    num_tokens = sum(count_messages(messages, model, cache))
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+def payload_size(messages: List[dict]) -> int:
+    """Rough character count of a payload, used to decide whether counting it is worth a thread hop"""
+    size = 0
+    for message in messages:
+        content = message.get("content")
+        # Multipart content (images etc) always gets offloaded
+        size += len(content) if isinstance(content, str) else INLINE_CHARS + 1
+    return size
+
+
+FUNCTION_OVERHEADS = {
+    "gpt-4o": {"func_init": 7, "prop_init": 3, "prop_key": 3, "enum_init": -3, "enum_item": 3, "func_end": 12},
+    "gpt-4": {"func_init": 10, "prop_init": 3, "prop_key": 3, "enum_init": -3, "enum_item": 3, "func_end": 12},
+    "unknown": {"func_init": 0, "prop_init": 0, "prop_key": 0, "enum_init": 0, "enum_item": 0, "func_end": 0},
+}
+
+
+def function_family(model: str) -> str:
+    """Which function overhead table a model uses"""
+    if model in [
+        "gpt-4o",
+        "gpt-4o-2024-05-13",
+        "gpt-4o-2024-08-06",
+        "gpt-4o-2024-11-20",
+        "gpt-4o-mini",
+        "gpt-4o-mini-2024-07-18",
+        "o1-preview",
+        "o1-preview-2024-09-12",
+        "o1",
+        "o1-2024-12-17",
+        "o1-mini",
+        "o1-mini-2024-09-12",
+    ]:
+        return "gpt-4o"
+    if model in [
+        "gpt-3.5-turbo-1106",
+        "gpt-3.5-turbo-0125",
+        "gpt-4",
+        "gpt-4-turbo",
+        "gpt-4-turbo-preview",
+        "gpt-4-0125-preview",
+        "gpt-4-1106-preview",
+    ]:
+        return "gpt-4"
+    if model not in _warned:
+        _warned.add(model)
+        log.warning(f"Incompatible model: {model}")
+    return "unknown"
+
+
+def function_overhead(model: str) -> Dict[str, int]:
+    """Per function/property/enum token overhead for a model family"""
+    return FUNCTION_OVERHEADS[function_family(model)]
+
+
+def schema_digest(schema: dict) -> int:
+    return hash(orjson.dumps(schema, option=orjson.OPT_SORT_KEYS))
+
+
+def count_function(schema: dict, model: str) -> int:
+    """Token cost of a single function schema, excluding the one time `func_end` overhead"""
+    overhead = function_overhead(model)
+    if "function" not in schema.keys():
+        schema = {"function": schema, "name": schema["name"], "description": schema["description"]}
+    func_token_count = overhead["func_init"]  # Add tokens for start of each function
+    texts = []
+    function = schema["function"]
+    f_name = function["name"]
+    f_desc = function["description"]
+    if f_desc.endswith("."):
+        f_desc = f_desc[:-1]
+    texts.append(f_name + ":" + f_desc)  # Add tokens for set name and description
+    properties = function["parameters"]["properties"]
+    if len(properties) > 0:
+        func_token_count += overhead["prop_init"]  # Add tokens for start of each property
+        for key, prop in properties.items():
+            func_token_count += overhead["prop_key"]  # Add tokens for each set property
+            p_type = prop.get("type", "")
+            p_desc = prop.get("description", "")
+            if "enum" in prop.keys():
+                func_token_count += overhead["enum_init"]  # Add tokens if property has enum list
+                for item in prop["enum"]:
+                    func_token_count += overhead["enum_item"]
+                    texts.append(item)
+            if p_desc.endswith("."):
+                p_desc = p_desc[:-1]
+            texts.append(f"{key}:{p_type}:{p_desc}")
+    func_token_count += sum(count_batch(texts, model))
+    return func_token_count
+
+
+def count_functions(functions: List[dict], model: str) -> int:
+    """Token count of the function schemas available to the model
+
+    Each schema's cost is memoized by its content and the model's overhead family/encoding,
+    so unchanged schemas are only tokenized once.
+    """
+    if not functions:
+        return 0
+    family = (function_family(model), encoding_name(model))
+    func_token_count = 0
+    for schema in functions:
+        key = (schema_digest(schema), family)
+        cost = _function_costs.get(key)
+        if cost is None:
+            cost = _function_costs[key] = count_function(schema, model)
+        func_token_count += cost
+    func_token_count += function_overhead(model)["func_end"]
+    return func_token_count
+
+
+def functions_memoized(functions: List[dict], model: str) -> bool:
+    """Whether every schema's cost is already memoized, making a count cheap enough to run inline"""
+    family = (function_family(model), encoding_name(model))
+    return all((schema_digest(schema), family) in _function_costs for schema in functions)
+
+
+def forget_functions(schemas: Iterable[dict]) -> None:
+    """Drop memoized costs for schemas that were changed or removed"""
+    digests = {schema_digest(schema) for schema in schemas if schema}
+    if not digests:
+        return
+    for key in [i for i in _function_costs if i[0] in digests]:
+        _function_costs.pop(key, None)
+
+
+async def offload(size: int, func: Callable[..., T], *args: Any) -> T:
+    """Run a tokenizer call inline if the input is small, otherwise in a worker thread
+
+    Args:
+        size (int): rough amount of characters being tokenized
+        func (Callable): tokenizer function to call
+    """
+    if size <= INLINE_CHARS:
+        return func(*args)
+    return await asyncio.to_thread(func, *args)
@@ -155,6 +155,10 @@ def json_schema_invalid(schema: dict) -> str:
     return missing
 
 
+# Prompt placeholders that change from one message to the next without anything else changing
+TIME_PARAMS = ("timestamp", "day", "date", "time", "timetz", "datetime", "members")
+
+
 def get_params(
     bot: Red,
     guild: discord.Guild,
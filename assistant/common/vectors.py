@@ -0,0 +1,463 @@
+import logging
+import threading
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import orjson
+
+log = logging.getLogger("red.vrt.assistant.vectors")
+
+# Float32 scores can drift slightly from the float64 scores used for the final ranking,
+# so candidates are gathered with a bit of slack and rescored exactly by the caller
+SCORE_TOLERANCE = 1e-3
+# Blocks smaller than this are always searched exactly, a full scan is already cheap
+ANN_MIN_ROWS = 1024
+# Rows per matmul when assigning clusters, keeps the temporary score matrix small
+ASSIGN_CHUNK = 8192
+
+
+PRECISIONS = ("float32", "float16", "int8")
+
+
+class Vector:
+    """Compact array-backed embedding vector
+
+    A list of 1536 Python floats costs ~49KB, the same vector as a float32 array is ~6KB
+    (~3KB as float16, ~1.5KB as int8). Behaves like a read-only sequence of floats, numpy
+    picks it up through `__array__`, and pydantic validates it from/serializes it to a plain
+    list of floats so the stored JSON format does not change.
+    """
+
+    __slots__ = ("data", "scale")
+
+    # Storage precision for newly validated vectors, set from DB.embedding_precision on load
+    precision: str = "float32"
+
+    def __init__(self, data: np.ndarray, scale: float = 0.0):
+        self.data = data
+        # Only used by int8 vectors, value = data * scale
+        self.scale = scale
+
+    @classmethod
+    def from_values(
+        cls,
+        values: Union["Vector", Sequence[float], np.ndarray],
+        precision: Optional[str] = None,
+    ) -> "Vector":
+        precision = precision or cls.precision
+        if isinstance(values, Vector):
+            if values.dtype == precision:
+                return values
+            values = values.array()
+        arr = np.asarray(values, dtype=np.float32)
+        if arr.ndim != 1:
+            raise ValueError("Embedding must be a flat list of floats")
+        if precision == "int8":
+            peak = float(np.abs(arr).max()) if arr.size else 0.0
+            scale = peak / 127 if peak else 1.0
+            return cls(np.round(arr / scale).astype(np.int8), scale)
+        if precision == "float16":
+            return cls(arr.astype(np.float16))
+        return cls(arr)
+
+    @classmethod
+    def validate(cls, value: Any) -> "Vector":
+        if isinstance(value, cls):
+            return cls.from_values(value)
+        if not isinstance(value, (list, tuple, np.ndarray)):
+            raise ValueError(f"Expected a list of floats, got {type(value).__name__}")
+        return cls.from_values(value)
+
+    @classmethod
+    def __get_validators__(cls):
+        # Pydantic v1
+        yield cls.validate
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any):
+        # Pydantic v2
+        from pydantic_core import core_schema
+
+        return core_schema.no_info_plain_validator_function(
+            cls.validate,
+            serialization=core_schema.plain_serializer_function_ser_schema(cls.tolist, when_used="always"),
+        )
+
+    @property
+    def dtype(self) -> str:
+        return self.data.dtype.name
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    def array(self) -> np.ndarray:
+        """The vector as a float32 array"""
+        if self.data.dtype == np.int8:
+            return self.data.astype(np.float32) * np.float32(self.scale)
+        if self.data.dtype != np.float32:
+            return self.data.astype(np.float32)
+        return self.data
+
+    def tolist(self) -> List[float]:
+        # Round trip through orjson so floats keep their short float32 repr instead of 17 digits
+        return orjson.loads(orjson.dumps(np.ascontiguousarray(self.array()), option=orjson.OPT_SERIALIZE_NUMPY))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        arr = self.array()
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self) -> Iterator[float]:
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.array()[index].tolist()
+        return float(self.array()[index])
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (Vector, list, tuple, np.ndarray)):
+            return len(self) == len(other) and bool(np.array_equal(self.array(), np.asarray(other, dtype=np.float32)))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Vector(dim={len(self)}, dtype={self.dtype})"
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def train_centroids(data: np.ndarray, nlist: int, iterations: int = 8, seed: int = 0) -> np.ndarray:
+    """Spherical k-means over a sample of the rows
+
+    Args:
+        data (np.ndarray): float32 matrix of vectors
+        nlist (int): amount of clusters to train
+        iterations (int): k-means iterations
+
+    Returns:
+        np.ndarray: unit length centroids of shape (nlist, dim)
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(data), nlist * 32)
+    sample = data[np.sort(rng.choice(len(data), sample_size, replace=False))]
+    sample = normalize(sample)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for __ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        empty = np.bincount(assign, minlength=nlist) == 0
+        if empty.any():
+            # Reseed dead clusters with random rows
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class _Block:
+    """Contiguous float32 matrix holding every embedding of a single dimension"""
+
+    __slots__ = (
+        "dim",
+        "matrix",
+        "norms",
+        "names",
+        "refs",
+        "seqs",
+        "size",
+        "centroids",
+        "clusters",
+        "trained_size",
+    )
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.matrix = np.empty((16, dim), dtype=np.float32)
+        self.norms = np.empty(16, dtype=np.float32)
+        self.names: List[str] = []
+        self.refs: List[Sequence[float]] = []
+        self.seqs: List[int] = []
+        self.size = 0
+
+        # Inverted file (IVF) for approximate search, only built when requested
+        self.centroids: Optional[np.ndarray] = None
+        self.clusters = np.empty(16, dtype=np.int32)
+        self.trained_size = 0
+
+    def _grow(self):
+        capacity = self.matrix.shape[0] * 2
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        matrix[: self.size] = self.matrix[: self.size]
+        norms = np.empty(capacity, dtype=np.float32)
+        norms[: self.size] = self.norms[: self.size]
+        clusters = np.empty(capacity, dtype=np.int32)
+        clusters[: self.size] = self.clusters[: self.size]
+        self.matrix, self.norms, self.clusters = matrix, norms, clusters
+
+    def set(self, row: int, vector: Sequence[float]):
+        self.matrix[row] = vector
+        self.norms[row] = np.linalg.norm(self.matrix[row])
+        self.refs[row] = vector
+        if self.centroids is not None:
+            # Scaling doesn't change the argmax so the raw row can be compared to the unit centroids
+            self.clusters[row] = np.argmax(self.centroids @ self.matrix[row])
+
+    @property
+    def needs_training(self) -> bool:
+        if self.size < ANN_MIN_ROWS:
+            return False
+        if self.centroids is None:
+            return True
+        # Retrain once the data has drifted far from what the centroids were fit on
+        return self.size > self.trained_size * 2 or self.size < self.trained_size // 2
+
+    def train(self):
+        start = perf_counter()
+        nlist = min(max(int(np.sqrt(self.size)), 8), 1024)
+        self.centroids = train_centroids(self.matrix[: self.size], nlist)
+        for i in range(0, self.size, ASSIGN_CHUNK):
+            chunk = self.matrix[i : min(i + ASSIGN_CHUNK, self.size)]
+            self.clusters[i : i + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        self.trained_size = self.size
+        log.debug(f"Trained {nlist} clusters for {self.size} rows in {round(perf_counter() - start, 2)}s")
+
+    def drop_ivf(self):
+        self.centroids = None
+        self.trained_size = 0
+
+    def search(self, query: np.ndarray, probes: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Score the query against the block
+
+        Args:
+            query (np.ndarray): float32 query vector
+            probes (int): amount of clusters to scan, 0 for an exact scan
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: scanned row indexes and their cosine scores
+        """
+        if probes and self.centroids is not None and probes < len(self.centroids):
+            probe = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+            rows = np.flatnonzero(np.isin(self.clusters[: self.size], probe))
+            matrix, norms = self.matrix[rows], self.norms[rows]
+        else:
+            rows = np.arange(self.size)
+            matrix, norms = self.matrix[: self.size], self.norms[: self.size]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = matrix @ query
+            scores /= norms * np.linalg.norm(query)
+        return rows, scores
+
+    def append(self, name: str, vector: Sequence[float], seq: int) -> int:
+        if self.size == self.matrix.shape[0]:
+            self._grow()
+        row = self.size
+        self.names.append(name)
+        self.refs.append(vector)
+        self.seqs.append(seq)
+        self.size += 1
+        self.set(row, vector)
+        return row
+
+    def remove(self, row: int) -> str:
+        """Swap the last row into the removed slot, returns the name of the moved row (if any)"""
+        last = self.size - 1
+        moved = ""
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.norms[row] = self.norms[last]
+            self.names[row] = self.names[last]
+            self.refs[row] = self.refs[last]
+            self.seqs[row] = self.seqs[last]
+            self.clusters[row] = self.clusters[last]
+            moved = self.names[row]
+        self.names.pop()
+        self.refs.pop()
+        self.seqs.pop()
+        self.size -= 1
+        return moved
+
+
+class EmbeddingIndex:
+    """Per-guild cache of embedding vectors grouped by dimension
+
+    Each dimension gets its own contiguous float32 matrix with precomputed norms so that a
+    query is a single matrix-vector product. The index is synced incrementally against the
+    guild's embeddings dict, only rows that were added, edited or deleted are touched.
+
+    When approximate search is enabled, large blocks also keep an inverted file index (IVF):
+    rows are bucketed by their nearest k-means centroid and a query only scans the rows in
+    the closest few buckets. New and edited rows are assigned to a bucket as they sync, and
+    the centroids are retrained when a block doubles or halves in size.
+    """
+
+    def __init__(self):
+        self.blocks: Dict[int, _Block] = {}
+        # {entry_name: (dimensions, row)}
+        self.rows: Dict[str, Tuple[int, int]] = {}
+        self.lock = threading.RLock()
+        self._seq = 0
+        # Bumped whenever a sync changes anything, lets dependents tell the embeddings changed
+        self.revision = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.rows.clear()
+            self.revision += 1
+
+    def _add(self, name: str, vector: Sequence[float], seq: int):
+        dim = len(vector)
+        block = self.blocks.get(dim)
+        if block is None:
+            block = self.blocks[dim] = _Block(dim)
+        self.rows[name] = (dim, block.append(name, vector, seq))
+
+    def _remove(self, name: str) -> int:
+        dim, row = self.rows.pop(name)
+        block = self.blocks[dim]
+        seq = block.seqs[row]
+        if moved := block.remove(row):
+            self.rows[moved] = (dim, row)
+        if not block.size:
+            del self.blocks[dim]
+        return seq
+
+    def sync(self, embeddings: dict, approximate: bool = False) -> int:
+        """Bring the index up to date with the embeddings dict
+
+        Entries are compared by the identity of their vector, so reassigning `Embedding.embedding`
+        or replacing the entry counts as an edit.
+
+        Args:
+            embeddings (dict): the guild's embeddings
+            approximate (bool): whether to build/maintain the IVF index for approximate search
+
+        Returns:
+            int: the amount of rows that were added, updated or removed
+        """
+        changed = 0
+        with self.lock:
+            for name, em in embeddings.items():
+                vector = em.embedding
+                location = self.rows.get(name)
+                if location is not None:
+                    dim, row = location
+                    block = self.blocks[dim]
+                    if block.refs[row] is vector:
+                        continue
+                    changed += 1
+                    if len(vector) == dim:
+                        block.set(row, vector)
+                        continue
+                    # Dimensions changed, move it to the right block but keep its place in line
+                    self._add(name, vector, self._remove(name))
+                    continue
+                changed += 1
+                self._seq += 1
+                self._add(name, vector, self._seq)
+
+            if len(self.rows) != len(embeddings):
+                stale = [name for name in self.rows if name not in embeddings]
+                for name in stale:
+                    self._remove(name)
+                changed += len(stale)
+
+            for block in self.blocks.values():
+                if not approximate:
+                    block.drop_ivf()
+                elif block.needs_training:
+                    block.train()
+
+        if changed:
+            self.revision += 1
+            log.debug(f"Synced {changed} embedding rows")
+        return changed
+
+    def candidates(
+        self,
+        query: Sequence[float],
+        top_n: int,
+        min_relatedness: float,
+        probes: int = 0,
+    ) -> List[str]:
+        """Get the names of the entries that could make the top N for a query
+
+        The caller is expected to rescore the (small) candidate list exactly.
+
+        Args:
+            query (Sequence[float]): query embedding
+            top_n (int): amount of results wanted
+            min_relatedness (float): minimum cosine similarity
+            probes (int): IVF clusters to scan, 0 for an exact search
+
+        Returns:
+            List[str]: entry names ordered by the order they were first added
+        """
+        with self.lock:
+            block = self.blocks.get(len(query))
+            if block is None or not block.size or top_n <= 0:
+                return []
+            rows, scores = block.search(np.asarray(query, dtype=np.float32), probes)
+
+            keep = np.flatnonzero(scores >= min_relatedness - SCORE_TOLERANCE)
+            if len(keep) > top_n:
+                top = np.argpartition(-scores[keep], top_n - 1)[:top_n]
+                cutoff = scores[keep[top]].min() - SCORE_TOLERANCE
+                keep = keep[scores[keep] >= cutoff]
+
+            seqs = block.seqs
+            names = block.names
+            return [names[i] for i in sorted(rows[keep].tolist(), key=lambda i: seqs[i])]
+
+    def measure_recall(self, samples: int, top_n: int, probes: int) -> Optional[Tuple[float, float, float, int]]:
+        """Compare approximate search against an exact scan using stored entries as queries
+
+        Returns:
+            Optional[Tuple[float, float, float, int]]: recall, avg exact ms, avg approximate ms, queries ran.
+            None if no block has an IVF index
+        """
+        with self.lock:
+            blocks = [b for b in self.blocks.values() if b.centroids is not None]
+            if not blocks:
+                return None
+            rng = np.random.default_rng()
+            found = total = 0
+            exact_time = approx_time = 0.0
+            ran = 0
+            per_block = max(1, samples // len(blocks))
+            for block in blocks:
+                for row in rng.choice(block.size, min(per_block, block.size), replace=False):
+                    query = block.matrix[row]
+
+                    start = perf_counter()
+                    rows, scores = block.search(query)
+                    exact_time += perf_counter() - start
+                    # Skip the query itself since it will always be its own best match
+                    order = np.argsort(-scores)
+                    expected = set(rows[order[: top_n + 1]].tolist()) - {int(row)}
+
+                    start = perf_counter()
+                    rows, scores = block.search(query, probes)
+                    approx_time += perf_counter() - start
+                    order = np.argsort(-scores)
+                    got = set(rows[order[: top_n + 1]].tolist()) - {int(row)}
+
+                    found += len(expected & got)
+                    total += len(expected)
+                    ran += 1
+
+            recall = found / total if total else 1.0
+            return recall, exact_time * 1000 / ran, approx_time * 1000 / ran, ran
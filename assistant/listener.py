@@ -1,5 +1,6 @@
 import logging
 import typing as t
+from contextlib import suppress
 from io import StringIO
 
 import discord
@@ -9,6 +10,8 @@ from redbot.core.i18n import Translator
 from .abc import MixinMeta
 from .common.calls import create_memory_call
 from .common.constants import REACT_SUMMARY_MESSAGE
+from .common.models import GuildSettings
+from .common.scheduler import Overloaded
 from .common.utils import can_use, embed_to_content
 
 log = logging.getLogger("red.vrt.assistant.listener")
@@ -51,7 +54,7 @@ class AssistantListener(MixinMeta):
         if not message.channel.permissions_for(message.guild.me).embed_links:
             return
 
-        conf = self.db.get_conf(message.guild)
+        conf = await self.db.load_conf(message.guild)
         if not conf.enabled or (not conf.api_key and not self.db.endpoint_override):
             return
 
@@ -96,16 +99,38 @@ class AssistantListener(MixinMeta):
             return
         self.responding_to.add(message.author.id)
         try:
-            async with channel.typing():
-                await self.handle_message(message, message.content, conf, listener=True)
+            await self.handle_in_turn(message, message.content, conf, listener=True)
         finally:
             self.responding_to.remove(message.author.id)
 
+    async def handle_in_turn(
+        self,
+        message: discord.Message,
+        question: str,
+        conf: GuildSettings,
+        listener: bool = False,
+    ) -> None:
+        """Wait for the scheduler to give the guild a turn, then reply
+
+        When the bot is too busy the message gets a short reply instead of waiting indefinitely
+        """
+        try:
+            async with self.scheduler.slot(message.guild.id, conf.priority):
+                async with message.channel.typing():
+                    await self.handle_message(message, question, conf, listener=listener)
+        except Overloaded:
+            log.debug(f"Shed a message in {message.guild.name}, too many requests queued")
+            with suppress(discord.HTTPException):
+                await message.reply(
+                    _("I'm answering a lot of messages right now, please try again in a moment!"),
+                    mention_author=False,
+                )
+
     @commands.Cog.listener("on_guild_remove")
     async def cleanup(self, guild: discord.Guild):
-        if guild.id in self.db.configs:
+        if self.db.has_conf(guild.id):
             log.info(f"Bot removed from {guild.name}, cleaning up...")
-            del self.db.configs[guild.id]
+            self.db.drop_conf(guild.id)
             await self.save_conf()
 
     @commands.Cog.listener("on_raw_reaction_add")
@@ -136,7 +161,7 @@ class AssistantListener(MixinMeta):
             return
         if not message.content:
             return
-        conf = self.db.get_conf(guild)
+        conf = await self.db.load_conf(guild)
         if not conf.enabled:
             return
         if not conf.api_key and not self.db.endpoint_override:
@@ -12,6 +12,7 @@ from redbot.core import commands
 from redbot.core.i18n import Translator
 from redbot.core.utils.chat_formatting import box, pagify, text_to_file
 
+from .common import tokenizer
 from .common.models import DB, CustomFunction, Embedding, GuildSettings
 from .common.utils import (
     code_string_valid,
@@ -657,6 +658,8 @@ class CodeMenu(discord.ui.View):
 
         entry = CustomFunction(code=code, jsonschema=schema)
         if function_name in self.db.functions:
+            tokenizer.forget_functions([self.db.functions[function_name].jsonschema])
+            self.db.functions[function_name].forget()
             await interaction.followup.send(_("`{}` has been overwritten!").format(function_name))
         else:
             await interaction.followup.send(_("`{}` has been created!").format(function_name))
@@ -717,6 +720,8 @@ class CodeMenu(discord.ui.View):
         if not code_string_valid(code):
             return await interaction.followup.send(_("Invalid function"), ephemeral=True)
 
+        tokenizer.forget_functions([self.db.functions[function_name].jsonschema])
+        self.db.functions[function_name].forget()
         if function_name != new_name:
             self.db.functions[new_name] = CustomFunction(code=code, jsonschema=schema)
             del self.db.functions[function_name]
@@ -744,6 +749,8 @@ class CodeMenu(discord.ui.View):
                 _("This function is managed by the `{}` cog and cannot be deleted").format(cog),
                 ephemeral=True,
             )
+        tokenizer.forget_functions([self.db.functions[function_name].jsonschema])
+        self.db.functions[function_name].forget()
         del self.db.functions[function_name]
         await self.get_pages()
         self.page %= len(self.pages)
@@ -762,6 +769,7 @@ class CodeMenu(discord.ui.View):
             self.conf.disabled_functions.remove(function_name)
         else:
             self.conf.disabled_functions.append(function_name)
+        self.conf.mark_dirty()
         self.update_button()
         await self.message.edit(view=self)
         await self.save()